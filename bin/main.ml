@@ -33,6 +33,8 @@ type content_block = { block : Block.t; raw : bytes; address : int }
 let opcode_length = 4
 let json_file = ref ""
 let serve = ref false
+let serve_json = ref false
+let compact = ref false
 let client = ref false
 let offline = ref false
 let shutdown_server = ref false
@@ -43,8 +45,15 @@ let speclist =
       Arg.Set_string json_file,
       "output json semantics to given file (default: none, use /dev/stderr for \
        stderr)" );
+    ( "--compact",
+      Arg.Set compact,
+      "Write deduplicated semantics to the astCompact auxdata instead of ast" );
     ("--serve", Arg.Set serve, "Start server process (in foreground)");
     ("--client", Arg.Set client, "Use client to server");
+    ( "--serve-json",
+      Arg.Set serve_json,
+      "Start newline-delimited JSON server on GTIRB_SEM_JSON_SOCKET (in \
+       foreground, lifting locally or with --client)" );
     ("--offline", Arg.Set offline, "Use offline lifter (implies --local)");
     ("--shutdown-server", Arg.Set shutdown_server, "Stop server process");
   ]
@@ -106,6 +115,91 @@ let do_block ~(need_flip : bool) ((b, c) : content_block * CodeBlock.t) :
 
 let ( let* ) = Lwt.bind
 
+let opcode_of_bytes (op : bytes) : Opcode.t =
+  Opcode.of_be_bytes (String.of_bytes op)
+
+(* Set by the JSON server, which lifts on a worker thread so that it can keep
+   accepting and answering requests while a lift is running. *)
+let detach_lifts = ref false
+
+(* Evaluate each instruction one by one with a new environment for each *)
+let lift_local (ops : (bytes * int) list) : opcode_sem list =
+  let offline = mode () = `LocalOffline in
+  List.map
+    (fun (op, addr) ->
+      let opcode = opcode_of_bytes op in
+      if offline then Server.lift_opcode_offline_lifter ~opcode addr
+      else Server.lift_opcode ~cache:true ~opcode addr)
+    ops
+
+let lift_pairs (ops : (bytes * int) list) : opcode_sem list Lwt.t =
+  match mode () with
+  | `Client ->
+      Client.lift_multi
+        ~opcodes:(List.map (fun (op, addr) -> (String.of_bytes op, addr)) ops)
+  | `LocalOnline | `LocalOffline ->
+      if !detach_lifts then Lwt_preemptive.detach lift_local ops
+      else Lwt.return (lift_local ops)
+
+(* Massage asli outputs into a format which can
+   be serialised and then deserialised by other tools  *)
+let json_of_sem (x : (string list, dis_error) result) : Yojson.Safe.t =
+  match x with
+  | Ok sl -> `List (List.map (fun s -> `String s) sl)
+  | Error err ->
+      (match mode () with
+      | `Client ->
+          Printf.eprintf "Decode error on op %s: %s\n" err.opcode err.error
+      | _ -> ());
+      `Assoc
+        [
+          ( "decode_error",
+            `Assoc
+              [ ("opcode", `String err.opcode); ("error", `String err.error) ]
+          );
+        ]
+
+let json_of_sems (asts : (string list, dis_error) result list) : Yojson.Safe.t =
+  `List (List.map json_of_sem asts)
+
+(* Compact form of the semantics, storing each distinct statement and each
+   distinct instruction once, with blocks as lists of instruction indices.
+   See scripts/gts_ast.py. *)
+let compact_json (blocks : ast_block list) : Yojson.Safe.t =
+  let intern tbl values key value =
+    match Hashtbl.find_opt tbl key with
+    | Some i -> i
+    | None ->
+        let i = Hashtbl.length tbl in
+        Hashtbl.add tbl key i;
+        values := value :: !values;
+        i
+  in
+  let stmts = Hashtbl.create 4096 and stmt_values = ref [] in
+  let isns = Hashtbl.create 4096 and isn_values = ref [] in
+  let isn (x : opcode_sem) =
+    let value =
+      match x with
+      | Ok sl ->
+          `List
+            (List.map (fun s -> `Int (intern stmts stmt_values s (`String s))) sl)
+      | Error _ -> json_of_sem x
+    in
+    `Int (intern isns isn_values (Yojson.Safe.to_string value) value)
+  in
+  let blocks =
+    List.map
+      (fun (b : ast_block) -> (b64_of_uuid b.auuid, `List (List.map isn b.asts)))
+      blocks
+  in
+  `Assoc
+    [
+      ("version", `Int 1);
+      ("statements", `List (List.rev !stmt_values));
+      ("instructions", `List (List.rev !isn_values));
+      ("blocks", `Assoc blocks);
+    ]
+
 let do_module (m : Module.t) : Module.t Lwt.t =
   let all_sects = m.sections in
   let intervals =
@@ -135,43 +229,8 @@ let do_module (m : Module.t) : Module.t Lwt.t =
   let need_flip = m.byte_order = ByteOrder.LittleEndian in
   let rblocks = List.map (do_block ~need_flip) cblocks in
 
-  (* Evaluate each instruction one by one with a new environment for each *)
-  let rec lift_online_local (opcodes : bytes list) (addr : int) =
-    match opcodes with
-    | [] -> []
-    | h :: t ->
-        Server.(
-          lift_opcode ~cache:true
-            ~opcode:(Opcode.of_be_bytes (String.of_bytes h)))
-          addr
-        :: lift_online_local t (addr + opcode_length)
-  in
-
-  let lift_offline_local (opcodes : bytes list) (addr : int) =
-    let lift_one_offline (op : bytes) (addr : int) =
-      Server.(
-        lift_opcode_offline_lifter
-          ~opcode:(Opcode.of_be_bytes (String.of_bytes op)))
-        addr
-    in
-    let with_addrs =
-      List.mapi (fun i op -> (op, addr + (i * opcode_length))) opcodes
-    in
-    let res =
-      List.map (fun (opcode, addr) -> lift_one_offline opcode addr) with_addrs
-    in
-    res
-  in
-  let rec ops opcodes addr =
-    match opcodes with
-    | [] -> []
-    | h :: t -> (String.of_bytes h, addr) :: ops t (addr + opcode_length)
-  in
   let asts opcodes addr =
-    match mode () with
-    | `Client -> Client.lift_multi ~opcodes:(ops opcodes addr)
-    | `LocalOnline -> Lwt.return @@ lift_online_local opcodes addr
-    | `LocalOffline -> Lwt.return @@ lift_offline_local opcodes addr
+    lift_pairs (List.mapi (fun i op -> (op, addr + (i * opcode_length))) opcodes)
   in
 
   (*
@@ -187,39 +246,14 @@ let do_module (m : Module.t) : Module.t Lwt.t =
       rblocks
   in
 
-  (* Massage asli outputs into a format which can
-     be serialised and then deserialised by other tools  *)
   let serialisable : string =
-    let to_list x = `List x in
-    let to_string x = `String x in
-    let jsoned (asts : (string list, dis_error) result list) : Yojson.Safe.t =
-      let toj (x : (string list, dis_error) result) : Yojson.Safe.t =
-        match x with
-        | Ok sl -> to_list @@ List.map to_string sl
-        | Error err ->
-            (match mode () with
-            | `Client ->
-                Printf.eprintf "Decode error on op %s: %s\n" err.opcode
-                  err.error
-            | _ -> ());
-            `Assoc
-              [
-                ( "decode_error",
-                  `Assoc
-                    [
-                      ("opcode", `String err.opcode);
-                      ("error", `String err.error);
-                    ] );
-              ]
-      in
-      to_list @@ List.map toj asts
-    in
-
     let paired : Yojson.Safe.t =
-      `Assoc
-        (List.map
-           (fun (b : ast_block) -> (b64_of_uuid b.auuid, jsoned b.asts))
-           with_asts)
+      if !compact then compact_json with_asts
+      else
+        `Assoc
+          (List.map
+             (fun (b : ast_block) -> (b64_of_uuid b.auuid, json_of_sems b.asts))
+             with_asts)
     in
 
     let json_str = Yojson.Safe.to_string paired in
@@ -231,9 +265,11 @@ let do_module (m : Module.t) : Module.t Lwt.t =
   in
 
   (* Sandwich ASTs into the IR amongst the other auxdata *)
-  let aux_key = "ast" in
-  (* Omit ast auxdata if it already exists. *)
-  let orig_auxes = List.filter (fun (k, _) -> k <> aux_key) m.aux_data in
+  let aux_key = if !compact then "astCompact" else "ast" in
+  (* Omit ast auxdata (in either format) if it already exists. *)
+  let orig_auxes =
+    List.filter (fun (k, _) -> k <> "ast" && k <> "astCompact") m.aux_data
+  in
   (* Turn the translation map + compressed semantics into auxdata and slide it in with the rest *)
   let ast_aux data =
     AuxData.make ?type_name:(Some aux_key)
@@ -245,20 +281,18 @@ let do_module (m : Module.t) : Module.t Lwt.t =
   let mod_fixed = { m with aux_data = full_auxes } in
   Lwt.return mod_fixed
 
-let gtirb_to_gts () : unit =
-  let bt = Sys.time () in
-  (* Read bytes from the file, skip first 8 *)
+let convert_gtirb ~(in_file : string) ~(out_file : string) : unit Lwt.t =
+  (* Read bytes from the file, skip the 8 byte magic if present. The file
+     is read and written with Lwt_io so that the JSON server keeps serving
+     other requests in the meantime. *)
+  let* bytes =
+    Lwt_io.with_file ~mode:Lwt_io.Input in_file (fun ic -> Lwt_io.read ic)
+  in
+  (* check for gtirb magic otherwise assume is raw protobuf *)
   let bytes =
-    let ic = open_in_bin !in_file in
-    let len = in_channel_length ic in
-    let magic = really_input_string ic 8 in
-    let res = really_input_string ic (len - 8) in
-    (* check for gtirb magic otherwise assume is raw protobuf *)
-    let res =
-      if String.starts_with ~prefix:"GTIRB" magic then res else magic ^ res
-    in
-    close_in ic;
-    res
+    if String.starts_with ~prefix:"GTIRB" bytes then
+      String.sub bytes 8 (String.length bytes - 8)
+    else bytes
   in
 
   (* Pull out interesting code bits *)
@@ -276,15 +310,18 @@ let gtirb_to_gts () : unit =
              (Ocaml_protoc_plugin.Result.show_error e))
   in
 
-  let modules' = Lwt_main.run @@ Lwt_list.map_p do_module ir.modules in
+  let* modules' = Lwt_list.map_p do_module ir.modules in
   let new_ir = { ir with modules = modules' } in
   let serial = IR.to_proto new_ir in
   let encoded = Writer.contents serial in
 
   (* Reserialise to disk *)
-  let out = open_out_bin !out_file in
-  output_string out encoded;
-  close_out out;
+  Lwt_io.with_file ~mode:Lwt_io.Output out_file (fun out ->
+      Lwt_io.write out encoded)
+
+let gtirb_to_gts () : unit =
+  let bt = Sys.time () in
+  Lwt_main.run @@ convert_gtirb ~in_file:!in_file ~out_file:!out_file;
   let et = Sys.time () in
   let usr_time_delta = et -. bt in
   let time_delta =
@@ -305,17 +342,149 @@ let gtirb_to_gts () : unit =
       (List.length stats.unique_failing_opcodes_le)
       cache
 
+(* JSON SERVER  *)
+
+(* Newline-delimited JSON front end, for tools which cannot link against
+   the OCaml client. Each request is an object with an "id" and a "method":
+
+     {"id": 1, "method": "lift", "opcodes": [["d503201f", 4196036], ...]}
+     {"id": 2, "method": "lift_file", "input": "a.gtirb", "output": "a.gts"}
+
+   where opcodes are big-endian hex strings. Each response carries the id of
+   its request and either a "result" (for "lift", a list of semantics in the
+   same format as the ast auxdata) or an "error" message. Requests on one
+   connection are handled concurrently, so responses may arrive out of order.
+
+   With --client, lifts are forwarded to a --serve server with
+   Client.lift_multi and overlap with each other; this is the setup to use
+   for concurrent lifting. Otherwise lifts run in-process one at a time on a
+   worker thread, which keeps other requests answered but does not lift
+   them in parallel. *)
+let json_socket () =
+  match Sys.getenv_opt "GTIRB_SEM_JSON_SOCKET" with
+  | Some path -> path
+  | None ->
+      Filename.concat (Filename.get_temp_dir_name ()) "gtirb_semantics_json.sock"
+
+let opcode_of_hex (hex : string) : bytes =
+  let hex =
+    if String.starts_with ~prefix:"0x" hex then
+      String.sub hex 2 (String.length hex - 2)
+    else hex
+  in
+  if String.length hex <> 2 * opcode_length then
+    failwith (Printf.sprintf "invalid opcode: %s" hex);
+  Bytes.init opcode_length (fun i ->
+      Char.chr (int_of_string ("0x" ^ String.sub hex (2 * i) 2)))
+
+let handle_json_request (req : Yojson.Safe.t) : Yojson.Safe.t Lwt.t =
+  let open Yojson.Safe.Util in
+  match member "method" req with
+  | `String "lift" ->
+      let pair x =
+        match to_list x with
+        | [ op; addr ] -> (opcode_of_hex (to_string op), to_int addr)
+        | _ -> failwith "expected [opcode, address] pairs"
+      in
+      let ops = List.map pair (to_list (member "opcodes" req)) in
+      let* sems = lift_pairs ops in
+      Lwt.return (json_of_sems sems)
+  | `String "lift_file" ->
+      let out_file = to_string (member "output" req) in
+      let* () =
+        convert_gtirb ~in_file:(to_string (member "input" req)) ~out_file
+      in
+      Lwt.return (`Assoc [ ("output", `String out_file) ])
+  | `String m -> failwith (Printf.sprintf "unknown method: %s" m)
+  | _ -> failwith "missing method"
+
+let start_json_server () : unit Lwt.t =
+  let path = json_socket () in
+  (try Unix.unlink path with Unix.Unix_error _ -> ());
+  (* The local lifter and its cache are not thread-safe, so local lifts run
+     on a single worker thread, one at a time. Forwarded lifts (--client) are
+     not detached. *)
+  detach_lifts := true;
+  Lwt_preemptive.set_bounds (1, 1);
+
+  let respond oc lock (line : string) =
+    let* resp =
+      match Yojson.Safe.from_string line with
+      | exception e ->
+          Lwt.return
+            (`Assoc [ ("id", `Null); ("error", `String (Printexc.to_string e)) ])
+      | req ->
+          let id =
+            match req with
+            | `Assoc kv -> Option.value ~default:`Null (List.assoc_opt "id" kv)
+            | _ -> `Null
+          in
+          Lwt.catch
+            (fun () ->
+              let* result = handle_json_request req in
+              Lwt.return (`Assoc [ ("id", id); ("result", result) ]))
+            (fun e ->
+              Lwt.return
+                (`Assoc [ ("id", id); ("error", `String (Printexc.to_string e)) ]))
+    in
+    (* The client may have gone away; nothing is waiting for the response. *)
+    Lwt.catch
+      (fun () ->
+        Lwt_mutex.with_lock lock (fun () ->
+            Lwt_io.write_line oc (Yojson.Safe.to_string resp)))
+      (fun _ -> Lwt.return_unit)
+  in
+
+  let handle_client _ (ic, oc) =
+    let lock = Lwt_mutex.create () in
+    let inflight = ref 0 in
+    let idle = Lwt_condition.create () in
+    let rec drain () =
+      if !inflight = 0 then Lwt.return_unit
+      else
+        let* () = Lwt_condition.wait idle in
+        drain ()
+    in
+    let rec loop () =
+      let* line = Lwt_io.read_line_opt ic in
+      match line with
+      | None -> drain ()
+      | Some line ->
+          incr inflight;
+          Lwt.async (fun () ->
+              Lwt.finalize
+                (fun () -> respond oc lock line)
+                (fun () ->
+                  decr inflight;
+                  if !inflight = 0 then Lwt_condition.broadcast idle ();
+                  Lwt.return_unit));
+          loop ()
+    in
+    loop ()
+  in
+
+  let* _server =
+    Lwt_io.establish_server_with_client_address (Unix.ADDR_UNIX path)
+      handle_client
+  in
+  Printf.printf "Serving JSON requests on %s\n%!" path;
+  fst (Lwt.wait ())
+
 (*  MAIN  *)
 let () =
   (* BEGINNING *)
   Arg.parse speclist handle_rest_arg usage_message;
   (* Printf.eprintf "gtirb-semantics: %s -> %s\n" !in_file !out_file; *)
-  if (not !serve) && (not !shutdown_server) && !count_pos_args <> 2 then (
+  if
+    (not !serve) && (not !serve_json) && (not !shutdown_server)
+    && !count_pos_args <> 2
+  then (
     output_string stderr usage_message;
     exit 1);
 
   if !shutdown_server then Lwt_main.run @@ Client.shutdown_server ()
   else if !serve then Server.start_server ()
+  else if !serve_json then Lwt_main.run @@ start_json_server ()
   else (
     output_string stdout "Lifting\n";
     gtirb_to_gts ())
@@ -1,95 +1,178 @@
-from sys import argv
-import gtirb
+from sys import argv, stderr
+from base64 import b64encode
 
-# Usage: python spelunk.py gtirb_file search_key
+import spelunk_loader as loader
+from spelunk_loader import BLOCKS, DROP
+from spelunk_index import SpelunkIndex
 
-# There's a LOT of duplicated code here; maybe clean it later
+import gts_ast  # from scripts/, which spelunk_loader adds to the path
+import gts_opcodes
 
-flatten = lambda ll: ll[0] if len(ll) == 1 else ll[0] + flatten(ll[1:])
+# Usage: python spelunk.py gtirb_file search_key [arguments]
+#
+# gtirb_file may be a .gtirb or .gts file. Each search key loads only the
+# parts of the IR it prints (see spelunk_loader.py).
+#
+# The IR is indexed once (see spelunk_index.py) and the index is saved beside
+# the input as gtirb_file.spelunkidx. Query keys (at, range, symbol) are
+# answered from a saved index without loading the IR.
 
-def dump_cfg(gtirb):
-    print(gtirb.cfg)
+WITH_CFG        = {**BLOCKS, "cfg": {}}
+WITH_CONTENTS   = {**BLOCKS, "modules": {"aux_data": DROP, "symbols": DROP,
+                   "sections": {"byte_intervals": {"symbolic_expressions": DROP}}}}
+SECTIONS        = {"aux_data": DROP, "cfg": DROP, "modules": {"aux_data": DROP}}
+INDEXED         = loader.with_aux(BLOCKS, ["functionBlocks", "functionNames"])
 
-def dump_code_blocks(gtirb):
+def dump_cfg(ir, index):
+    print(ir.cfg)
+
+def dump_code_blocks(ir, index):
     print("LOOK FOR: IR.modules.sections.byteIntervals.blocks \"code\"\n")
-    mods    = gtirb.modules
-    sects   = flatten(list(map(lambda m: m.sections, mods)))
-    texts   = filter(lambda s: s.name == ".text", sects)
-    ivals   = flatten(list(map(lambda t: t.byte_intervals, texts)))
-    blocks  = flatten(list(map(lambda i: i.blocks, ivals)))
-    codes   = filter(lambda t: str(t)[:4] == "Code", blocks)
-    for b in codes:
-        print(str(b))
-
-def dump_data_blocks(gtirb):
+    for b in index.code:
+        print(str(ir.get_by_uuid(b.uuid)))
+
+def dump_data_blocks(ir, index):
     print("LOOK FOR: IR.modules.sections.byteIntervals.blocks \"data\"\n")
-    mods    = gtirb.modules
-    sects   = flatten(list(map(lambda m: m.sections, mods)))
-    texts   = filter(lambda s: s.name == ".text", sects)
-    ivals   = flatten(list(map(lambda t: t.byte_intervals, texts)))
-    blocks  = flatten(list(map(lambda i: i.blocks, ivals)))
-    codes   = filter(lambda t: str(t)[:4] == "Data", blocks)
-    for b in codes:
-        print(str(b))
-
-def dump_function_blocks(gtirb):
+    for b in index.data:
+        print(str(ir.get_by_uuid(b.uuid)))
+
+def dump_function_blocks(ir, index):
     print("LOOK FOR: IR.modules.auxData[functionBlocks]\n")
-    mods    = gtirb.modules
-    auxes   = [dict(m.aux_data) for m in mods]
-    fblocks = [a['functionBlocks'].data for a in auxes]
-    for m in fblocks:
-        for k in m:
-            b = m[k]
-            print(k)
-            for cd in b:
-                print(f"\t{cd}")
-            print()
-
-def dump_instrs(gtirb):
+    for f, blocks in index.functions.items():
+        print(f)
+        for b in blocks:
+            print(f"\t{ir.get_by_uuid(b.uuid)}")
+        print()
+
+def dump_instrs(ir, index):
     print("LOOK FOR: IR.modules.sections.byteIntervals.contents\n")
-    mods        = gtirb.modules
-    sections    = flatten([m.sections for m in mods])
-    texts       = list(filter(lambda s: s.name == ".text", sections))
-    sectIds     = list(map(lambda s: s.uuid, texts))
-    byteIvals   = flatten(list(map(lambda t: t.byte_intervals, texts)))
-    raw         = list(map(lambda i: i.contents, byteIvals))
-    for u, r in zip(sectIds, raw):
-        print(u)
-        cuts = [r[i:i+4] for i in range(len(r) // 4)]
-        for i in cuts:
-            print(f"\t{i.hex()}")
-
-def dump_symbols(gtirb):
+    texts = [ir.get_by_uuid(s.uuid) for s in index.sections.get(".text", [])]
+    for t in texts:
+        for i in t.byte_intervals:
+            print(t.uuid)
+            words = gts_opcodes.words(i.contents, 0, len(i.contents), t.module.byte_order.name)
+            for w in words.tolist():
+                print(f"\t{w:08x}")
+
+def dump_opcodes(ir, index):
+    print("LOOK FOR: opcodes of IR.modules.sections.byteIntervals.blocks \"code\", most frequent first\n")
+    def block_words(b):
+        blk = ir.get_by_uuid(b.uuid)
+        order = blk.byte_interval.section.module.byte_order.name
+        return gts_opcodes.words(blk.byte_interval.contents, blk.offset, blk.size, order)
+    ops, counts = gts_opcodes.unique_counts(block_words(b) for b in index.code)
+    order = (-counts).argsort(kind="stable")
+    for op, n in zip(ops[order].tolist(), counts[order].tolist()):
+        print(f"{op:08x}\t{n}")
+
+def dump_symbols(ir, index):
     print("LOOK FOR: IR.modules.symbols\n")
-    mods    = gtirb.modules
+    mods    = ir.modules
     symbols = [m.symbols for m in mods]
     for ss in symbols:
         for s in ss:
             print(s)
         print(s)
 
-def dump_texts(gtirb):
+def dump_texts(ir, index):
     print("LOOK FOR: IR.modules.sections, .name == \".text\"\n")
-    mods        = gtirb.modules
-    sections    = flatten([m.sections for m in mods])
-    texts       = list(filter(lambda s: s.name == ".text", sections))
-    for t in texts:
-        print(t)
+    for s in index.sections.get(".text", []):
+        print(ir.get_by_uuid(s.uuid))
+
+def describe_block(index, b):
+    funcs = ", ".join(sorted(str(index.function_names.get(f, f)) for f in b.functions))
+    where = f"{b.module}:{b.section}" + (f" in {funcs}" if funcs else "")
+    return f"{b.kind}\t{b.address:#x}-{b.end:#x}\t{b.uuid}\t{where}"
+
+def describe_symbol(s):
+    address = "-" if s.address is None else f"{s.address:#x}"
+    return f"{address}\t{s.name}\t{s.uuid}\t{s.module}"
+
+def query_at(index, address):
+    print(f"LOOK FOR: blocks containing {address:#x}\n")
+    for b in index.blocks_at(address):
+        print(describe_block(index, b))
+    for s in index.symbols_at(address):
+        print(describe_symbol(s))
+
+def query_range(index, lo, hi):
+    print(f"LOOK FOR: blocks within [{lo:#x}, {hi:#x})\n")
+    for b in index.blocks_in(lo, hi):
+        print(describe_block(index, b))
+
+def query_symbol(index, prefix):
+    print(f"LOOK FOR: symbols starting with \"{prefix}\"\n")
+    for s in index.symbols_with_prefix(prefix):
+        print(describe_symbol(s))
+
+def dump_ast(path, index, address=None):
+    print("LOOK FOR: IR.modules.auxData[ast]\n")
+    sems = {}
+    for key in (gts_ast.COMPACT_KEY, gts_ast.AST_KEY):
+        for data in loader.aux_data(path, key):
+            sems.update(gts_ast.load_semantics(key, data))
+    blocks = index.code if address is None else index.code.containing(address)
+    for b in blocks:
+        isns = sems.get(b64encode(b.uuid.bytes).decode())
+        if isns is None:
+            continue
+        print(describe_block(index, b))
+        for i, isn in enumerate(isns):
+            if isinstance(isn, dict):
+                err = isn.get("decode_error", isn)
+                print(f"\t{i}: decode_error {err.get('opcode')}: {err.get('error')}")
+                continue
+            print(f"\t{i}:")
+            for stmt in isn:
+                print(f"\t\t{stmt}")
+
+def load_index(path):
+    index = SpelunkIndex.load(path)
+    if index is None:
+        index = SpelunkIndex.from_ir(loader.load_ir(path, INDEXED))
+        try:
+            index.save(path)
+        except OSError as e:
+            print(f"warning: could not save index: {e}", file=stderr)
+    return index
 
 def main():
-    ir      = gtirb.IR.load_protobuf(argv[1])
+    path    = argv[1]
     target  = argv[2]
+    args    = argv[3:]
+    queryTable = {
+            "at"        : (query_at     , [lambda x: int(x, 0)]),
+            "range"     : (query_range  , [lambda x: int(x, 0)] * 2),
+            "symbol"    : (query_symbol , [str])
+    }
+    # key: (dump function, fields of the IR which it needs)
     dumpTable = {
-            "cfg"       : dump_cfg              ,
-            "code"      : dump_code_blocks      ,
-            "data"      : dump_data_blocks      ,
-            "functions" : dump_function_blocks  ,
-            "instrs"    : dump_instrs           ,
-            "symbols"   : dump_symbols          ,
-            "texts"     : dump_texts
+            "cfg"       : (dump_cfg             , WITH_CFG      ),
+            "code"      : (dump_code_blocks     , BLOCKS        ),
+            "data"      : (dump_data_blocks     , BLOCKS        ),
+            "functions" : (dump_function_blocks , BLOCKS        ),
+            "instrs"    : (dump_instrs          , WITH_CONTENTS ),
+            "opcodes"   : (dump_opcodes         , WITH_CONTENTS ),
+            "symbols"   : (dump_symbols         , BLOCKS        ),
+            "texts"     : (dump_texts           , SECTIONS      )
     }
-    dump = dumpTable.get(target, lambda _: print("That target doesn't exist."))
-    dump(ir)
+    if target in queryTable:
+        query, types = queryTable[target]
+        if len(args) != len(types):
+            print(f"{target} takes {len(types)} argument(s).")
+            return
+        query(load_index(path), *[t(a) for t, a in zip(types, args)])
+    elif target == "ast":
+        if len(args) > 1:
+            print("ast takes at most 1 argument.")
+            return
+        dump_ast(path, load_index(path), *[int(a, 0) for a in args])
+    elif target in dumpTable:
+        dump, spec = dumpTable[target]
+        ir = loader.load_ir(path, spec)
+        dump(ir, load_index(path))
+    else:
+        print("That target doesn't exist.")
 
 if __name__ == "__main__":
 	main()
@@ -0,0 +1,222 @@
+import os
+import json
+import bisect
+import itertools
+from dataclasses import dataclass
+from uuid import UUID
+
+# An index over a GTIRB IR, built in one pass and queried in logarithmic time.
+#
+# Everything is stored as plain records (no gtirb objects), so the index can
+# be saved beside the input file (as JSON) and reused without loading the IR
+# again.
+
+INDEX_SUFFIX = ".spelunkidx"
+INDEX_VERSION = 2
+
+
+@dataclass(frozen=True)
+class SectionEntry:
+    name: str
+    module: str
+    uuid: UUID
+    address: int | None
+    size: int | None
+
+
+@dataclass(frozen=True)
+class BlockEntry:
+    address: int | None
+    size: int
+    kind: str  # "code" or "data"
+    uuid: UUID
+    module: str
+    section: str
+    functions: frozenset[UUID]  # a block may be shared by several functions
+
+    @property
+    def end(self):
+        return None if self.address is None else self.address + self.size
+
+
+@dataclass(frozen=True)
+class SymbolEntry:
+    name: str
+    address: int | None
+    uuid: UUID
+    referent: UUID | None
+    module: str
+
+
+class IntervalIndex:
+    """
+    Blocks sorted by address. ends_max[i] is the largest end address among
+    blocks[:i+1], which bounds the backwards scan for blocks containing an
+    address: with non-overlapping blocks, every query is a single bisection.
+    """
+
+    def __init__(self, blocks):
+        self.blocks = sorted(blocks, key=lambda b: (b.address, b.size))
+        self.starts = [b.address for b in self.blocks]
+        self.ends_max = list(itertools.accumulate((b.end for b in self.blocks), max))
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __iter__(self):
+        return iter(self.blocks)
+
+    def containing(self, address):
+        """All blocks with address <= X < address + size (or == for empty blocks)."""
+        out = []
+        i = bisect.bisect_right(self.starts, address) - 1
+        while i >= 0 and self.ends_max[i] >= address:
+            b = self.blocks[i]
+            if b.address <= address < b.end or b.address == address:
+                out.append(b)
+            i -= 1
+        return out[::-1]
+
+    def overlapping(self, lo, hi):
+        """All blocks intersecting [lo, hi), in address order."""
+        i = bisect.bisect_right(self.starts, lo) - 1
+        while i >= 0 and self.ends_max[i] > lo:
+            i -= 1
+        j = bisect.bisect_left(self.starts, hi)
+        return [b for b in self.blocks[i + 1:j] if b.end > lo or b.address >= lo]
+
+
+class SpelunkIndex:
+    def __init__(self, sections, blocks, symbols, function_names):
+        self.sections = {}
+        for s in sections:
+            self.sections.setdefault(s.name, []).append(s)
+        # Blocks without an address are kept for the functions they belong to,
+        # but cannot be found by address.
+        self.unplaced = [b for b in blocks if b.address is None]
+        self.code = IntervalIndex(b for b in blocks if b.kind == "code" and b.address is not None)
+        self.data = IntervalIndex(b for b in blocks if b.kind == "data" and b.address is not None)
+
+        self.symbols = symbols
+        self.symbols_by_name = sorted(symbols, key=lambda s: s.name)
+        self._names = [s.name for s in self.symbols_by_name]
+        self.symbols_by_address = sorted((s for s in symbols if s.address is not None),
+                                         key=lambda s: s.address)
+        self._addresses = [s.address for s in self.symbols_by_address]
+
+        self.function_names = function_names
+        self.functions = {}
+        for b in itertools.chain(self.code, (b for b in self.unplaced if b.kind == "code")):
+            for f in b.functions:
+                self.functions.setdefault(f, []).append(b)
+
+    @classmethod
+    def from_ir(cls, ir):
+        sections = []
+        blocks = []
+        symbols = []
+        function_names = {}
+        for m in ir.modules:
+            aux = dict(m.aux_data)
+            block_functions = {}
+            if "functionBlocks" in aux:
+                for func, blks in aux["functionBlocks"].data.items():
+                    for b in blks:
+                        block_functions.setdefault(b.uuid, set()).add(func)
+            if "functionNames" in aux:
+                function_names.update({f: s.name for f, s in aux["functionNames"].data.items()})
+
+            for s in m.sections:
+                sections.append(SectionEntry(s.name, m.name, s.uuid, s.address, s.size))
+                for b in s.byte_blocks:
+                    kind = "code" if type(b).__name__ == "CodeBlock" else "data"
+                    blocks.append(BlockEntry(b.address, b.size, kind, b.uuid, m.name, s.name,
+                                             frozenset(block_functions.get(b.uuid, ()))))
+
+            for sym in m.symbols:
+                referent = sym.referent
+                address = sym.value if sym.referent is None else getattr(referent, "address", None)
+                symbols.append(SymbolEntry(sym.name, address, sym.uuid,
+                                           referent.uuid if referent is not None else None, m.name))
+        return cls(sections, blocks, symbols, function_names)
+
+    # Queries
+
+    def blocks_at(self, address):
+        return self.code.containing(address) + self.data.containing(address)
+
+    def blocks_in(self, lo, hi):
+        return sorted(self.code.overlapping(lo, hi) + self.data.overlapping(lo, hi),
+                      key=lambda b: (b.address, b.kind))
+
+    def symbols_with_prefix(self, prefix):
+        i = bisect.bisect_left(self._names, prefix)
+        out = []
+        while i < len(self._names) and self._names[i].startswith(prefix):
+            out.append(self.symbols_by_name[i])
+            i += 1
+        return out
+
+    def symbols_at(self, address):
+        i = bisect.bisect_left(self._addresses, address)
+        j = bisect.bisect_right(self._addresses, address)
+        return self.symbols_by_address[i:j]
+
+    def symbol_before(self, address):
+        """The nearest symbol at or below an address, for labelling."""
+        i = bisect.bisect_right(self._addresses, address)
+        return self.symbols_by_address[i - 1] if i else None
+
+    def functions_of(self, address):
+        """The functions of every code block containing an address."""
+        return set().union(*(b.functions for b in self.code.containing(address)))
+
+    # Persistence
+
+    @staticmethod
+    def index_path(path):
+        return str(path) + INDEX_SUFFIX
+
+    @staticmethod
+    def _stamp(path):
+        st = os.stat(path)
+        return (INDEX_VERSION, st.st_size, st.st_mtime_ns)
+
+    def save(self, path, index=None):
+        index = index or self.index_path(path)
+        sections = [s for ss in self.sections.values() for s in ss]
+        blocks = [*self.code, *self.data, *self.unplaced]
+        data = {
+            "stamp": self._stamp(path),
+            "sections": [[s.name, s.module, s.uuid.hex, s.address, s.size] for s in sections],
+            "blocks": [[b.address, b.size, b.kind, b.uuid.hex, b.module, b.section,
+                        sorted(f.hex for f in b.functions)] for b in blocks],
+            "symbols": [[s.name, s.address, s.uuid.hex, s.referent and s.referent.hex, s.module]
+                        for s in self.symbols],
+            "function_names": {f.hex: name for f, name in self.function_names.items()},
+        }
+        tmp = f"{index}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(tmp, index)
+
+    @classmethod
+    def load(cls, path, index=None):
+        """Returns the saved index for path, or None if it is missing or stale."""
+        index = index or cls.index_path(path)
+        try:
+            with open(index) as f:
+                data = json.load(f)
+            if data["stamp"] != list(cls._stamp(path)):
+                return None
+            sections = [SectionEntry(name, module, UUID(uuid), address, size)
+                        for name, module, uuid, address, size in data["sections"]]
+            blocks = [BlockEntry(address, size, kind, UUID(uuid), module, section,
+                                 frozenset(map(UUID, functions)))
+                      for address, size, kind, uuid, module, section, functions in data["blocks"]]
+            symbols = [SymbolEntry(name, address, UUID(uuid), referent and UUID(referent), module)
+                       for name, address, uuid, referent, module in data["symbols"]]
+            function_names = {UUID(f): name for f, name in data["function_names"].items()}
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        return cls(sections, blocks, symbols, function_names)
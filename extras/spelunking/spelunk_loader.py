@@ -0,0 +1,123 @@
+import os
+import sys
+import mmap
+import contextlib
+
+import gtirb
+import gtirb.version
+from gtirb.proto import IR_pb2
+
+# Loading of .gtirb and .gts files for the spelunker.
+#
+# .gts files are .gtirb files without the 8-byte magic prefix. Files are
+# mapped rather than read, and the protobuf is parsed from a view starting
+# after the magic (if any), so neither kind is copied before parsing.
+#
+# Each search key only needs part of the IR. A spec names the fields to drop
+# from the serialised IR before it is parsed, e.g. byte interval contents or
+# the (potentially very large) auxdata tables of a lifted file:
+#
+#   {"modules": {"aux_data": DROP, "sections": {"byte_intervals": {"contents": DROP}}}}
+#
+# A frozenset in place of DROP keeps only the map entries with those keys.
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "scripts"))
+import gts_reader  # noqa: E402
+
+DROP = None
+
+# The magic of a .gtirb file of the protobuf version this gtirb package reads.
+MAGIC = b"GTIRB\0\0" + bytes([gtirb.version.PROTOBUF_VERSION])
+
+# Code and data blocks and symbols, without contents, auxdata or the CFG.
+BLOCKS = {
+    "aux_data": DROP,
+    "cfg": DROP,
+    "modules": {
+        "aux_data": DROP,
+        "sections": {"byte_intervals": {"contents": DROP, "symbolic_expressions": DROP}},
+    },
+}
+
+
+def with_aux(spec, keys):
+    """spec, keeping the module auxdata tables named in keys."""
+    return {**spec, "modules": {**spec["modules"], "aux_data": frozenset(keys)}}
+
+
+@contextlib.contextmanager
+def open_view(path):
+    """
+    Maps a .gtirb or .gts file, yielding a memoryview of its protobuf data
+    (after the magic, if present).
+    """
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        view = gts_reader.strip_magic(m)
+        try:
+            yield view
+        finally:
+            view.release()
+
+
+def _entry_key(buf, start, end):
+    # map entries are messages with key = 1 and value = 2.
+    for f, _, s, e in gts_reader.iter_fields(buf, start, end):
+        if f == 1:
+            return bytes(buf[s:e]).decode("utf-8")
+    return ""
+
+
+def prune(buf, start, end, descriptor, spec):
+    """Returns buf[start:end], a message of the given type, without the fields dropped by spec."""
+    out = []
+    prev = start
+    for f, _, s, e in gts_reader.iter_fields(buf, start, end):
+        field = descriptor.fields_by_number.get(f)
+        rule = spec.get(field.name, ...) if field else ...
+        if rule is ...:
+            out.append(buf[prev:e])
+        elif isinstance(rule, frozenset):
+            if _entry_key(buf, s, e) in rule:
+                out.append(buf[prev:e])
+        elif rule is not DROP:
+            sub = prune(buf, s, e, field.message_type, rule)
+            out.append(gts_reader.encode_field(f, sub))
+        prev = e
+    return b"".join(out)
+
+
+class _MagicStream:
+    """
+    A read-only stream of MAGIC followed by the protobuf data in buf, for
+    gtirb.IR.load_protobuf_file. Reading to the end returns buf itself
+    rather than a copy of it.
+    """
+
+    def __init__(self, buf):
+        self.magic = MAGIC
+        self.buf = buf
+
+    def read(self, size=-1):
+        if not self.magic and (size < 0 or size >= len(self.buf)):
+            out, self.buf = self.buf, b""
+            return out
+        if size < 0:
+            size = len(self.magic) + len(self.buf)
+        n = min(size, len(self.magic))
+        out = self.magic[:n] + bytes(self.buf[:size - n])
+        self.magic, self.buf = self.magic[n:], self.buf[size - n:]
+        return out
+
+
+def load_ir(path, spec=None):
+    """Loads the IR from a .gtirb or .gts file, without the fields dropped by spec."""
+    with open_view(path) as view:
+        if spec is not None:
+            return gtirb.IR.load_protobuf_file(_MagicStream(prune(view, 0, len(view), IR_pb2.IR.DESCRIPTOR, spec)))
+        return gtirb.IR.load_protobuf_file(_MagicStream(view))
+
+
+def aux_data(path, key):
+    """The data of the named auxdata table of each module which has it."""
+    with open_view(path) as view:
+        return [bytes(view[s:e]) for s, e in filter(None, gts_reader.aux_data_spans(view, key))]
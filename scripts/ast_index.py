@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# vim: ts=2 sts=2 et sw=2
+
+# /// script
+# requires-python = ">=3.11"
+# dependencies = [
+#   "protobuf",
+# ]
+# ///
+
+"""
+ast_index.py build GTS_FILE
+ast_index.py get [--module N] GTS_FILE (UUID | ADDRESS)...
+
+Random access to the `ast` semantics of a .gts file.
+
+The first use of a .gts file builds a sidecar index (GTS_FILE.astidx) which
+records, for each code block, the byte span of its semantics within the
+`ast` auxdata, along with its address and size. Lookups then mmap the .gts
+and parse only the requested block's semantics.
+
+example:
+
+  with AstIndex('a.gts') as idx:
+    idx.semantics_for('ByM62E8HQg2Gm/cINLiC+g==')
+    idx.semantics_at(0x400684, module=0)
+"""
+
+import re
+import sys
+import json
+import mmap
+import base64
+import sqlite3
+import pathlib
+import argparse
+import dataclasses
+
+import gts_reader
+
+INDEX_SUFFIX = '.astidx'
+INDEX_VERSION = 3
+
+# the top-level keys of the `ast` JSON object are base64 block uuids. each
+# is found by the `=="` which ends it (a fast literal search), then checked
+# to be 22 base64 characters after a quote which follows the object's '{' or
+# ','. no string within the statement lists can pass this, since their
+# quotes are escaped, and a string value cannot be followed by a ':'.
+KEY_END_RE = re.compile(rb'=="\s*:')
+KEY_CHARS_RE = re.compile(rb'[A-Za-z0-9+/]{22}')
+WHITESPACE = b' \t\r\n'
+
+@dataclasses.dataclass(frozen=True)
+class BlockEntry:
+  uuid: bytes
+  module: int
+  address: int | None
+  size: int
+  start: int  # span of the block's semantics within the .gts file
+  end: int
+
+def to_uuid(x: bytes | str) -> bytes:
+  """accepts a uuid as either raw bytes or a base64 string."""
+  return base64.b64decode(x) if isinstance(x, str) else x
+
+def ast_spans(buf, start: int, end: int) -> dict[bytes, tuple[int, int]]:
+  """
+  returns the span of each block's value within the `ast` JSON stored at
+  buf[start:end], keyed by the block's raw uuid.
+  """
+  out = {}
+  prev = None
+  for m in KEY_END_RE.finditer(buf, start, end):
+    quote = m.start() - 23
+    if quote <= start or buf[quote] != ord('"') or not KEY_CHARS_RE.fullmatch(buf, quote + 1, m.start()):
+      continue
+    sep = quote - 1
+    while sep > start and buf[sep] in WHITESPACE:
+      sep -= 1
+    if buf[sep] not in b'{,':
+      continue
+    if prev:
+      out[prev[0]] = (prev[1], sep)
+    prev = (base64.b64decode(buf[quote + 1:m.start() + 2]), m.end())
+  if prev:
+    # the value of the last key is followed by the object's closing '}'.
+    close = bytes(buf[prev[1]:end]).rstrip().rindex(b'}')
+    out[prev[0]] = (prev[1], prev[1] + close)
+  return out
+
+class AstIndex:
+  def __init__(self, gts: str | pathlib.Path, index: str | pathlib.Path | None = None, rebuild: bool = False):
+    self.gts = pathlib.Path(gts)
+    self.index = pathlib.Path(index) if index else self.gts.with_name(self.gts.name + INDEX_SUFFIX)
+
+    self._file = open(self.gts, 'rb')
+    self.mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+    self.db = sqlite3.connect(self.index)
+    if rebuild or not self._fresh():
+      self.build()
+
+  def _stamp(self) -> tuple[int, int]:
+    st = self.gts.stat()
+    return st.st_size, st.st_mtime_ns
+
+  def _fresh(self) -> bool:
+    try:
+      meta = dict(self.db.execute('SELECT key, value FROM meta'))
+    except sqlite3.Error:
+      return False
+    return meta.get('version') == INDEX_VERSION and \
+      (meta.get('size'), meta.get('mtime')) == self._stamp()
+
+  def build(self):
+    """(re)builds the sidecar index from the .gts file."""
+    ir = gts_reader.parse(self.mm, aux_keys=())
+    spans = gts_reader.aux_data_spans(self.mm, 'ast')
+    if not any(spans) and any(gts_reader.aux_data_spans(self.mm, 'astCompact')):
+      raise ValueError(f'{self.gts} has compact semantics, which cannot be indexed. '
+                       'convert it with: gts_ast.py expand')
+
+    rows = []
+    for i, (mod, span) in enumerate(zip(ir.modules, spans)):
+      if span is None: continue
+      blocks = {blk.uuid: blk for blk in mod.code_blocks}
+      for uuid, (s, e) in ast_spans(self.mm, *span).items():
+        blk = blocks.get(uuid)
+        rows.append((uuid, i, blk and blk.address, blk.size if blk else 0, s, e))
+    del ir
+
+    size, mtime = self._stamp()
+    max_size = max((max(r[3], 1) for r in rows), default=1)
+    with self.db:
+      self.db.execute('DROP TABLE IF EXISTS meta')
+      self.db.execute('DROP TABLE IF EXISTS blocks')
+      self.db.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value)')
+      # a uuid can appear in more than one module.
+      self.db.execute('CREATE TABLE blocks (uuid BLOB, module INTEGER, address INTEGER, '
+                      'size INTEGER, start INTEGER, end INTEGER, PRIMARY KEY (module, uuid))')
+      self.db.execute('CREATE INDEX blocks_uuid ON blocks (uuid)')
+      self.db.execute('CREATE INDEX blocks_address ON blocks (address)')
+      self.db.executemany('INSERT INTO blocks VALUES (?, ?, ?, ?, ?, ?)', rows)
+      self.db.executemany('INSERT INTO meta VALUES (?, ?)',
+                          [('version', INDEX_VERSION), ('size', size), ('mtime', mtime),
+                           ('max_size', max_size)])
+
+  def close(self):
+    self.db.close()
+    self.mm.close()
+    self._file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *_):
+    self.close()
+
+  def __len__(self) -> int:
+    return self.db.execute('SELECT COUNT(*) FROM blocks').fetchone()[0]
+
+  def blocks(self) -> list[BlockEntry]:
+    return [BlockEntry(*x) for x in self.db.execute('SELECT * FROM blocks ORDER BY module, address')]
+
+  def blocks_for(self, uuid: bytes | str, module: int | None = None) -> list[BlockEntry]:
+    """returns the blocks with the given uuid (in the given module index, if any), by module."""
+    rows = self.db.execute('SELECT * FROM blocks WHERE uuid = ? AND (? IS NULL OR module = ?) ORDER BY module',
+                           (to_uuid(uuid), module, module))
+    return [BlockEntry(*row) for row in rows]
+
+  def block(self, uuid: bytes | str, module: int | None = None) -> BlockEntry | None:
+    """returns the first of blocks_for(uuid, module), if any."""
+    blks = self.blocks_for(uuid, module)
+    return blks[0] if blks else None
+
+  def blocks_at(self, address: int, module: int | None = None) -> list[BlockEntry]:
+    """
+    returns every block containing the given address (of the given module
+    index, if any), by module and then innermost (highest start) first.
+    """
+    # no block is larger than max_size, so this bounds the candidates.
+    max_size = self.db.execute("SELECT value FROM meta WHERE key = 'max_size'").fetchone()[0]
+    rows = self.db.execute('SELECT * FROM blocks WHERE address BETWEEN ? AND ? AND (? IS NULL OR module = ?) '
+                           'ORDER BY module, address DESC',
+                           (address - max_size + 1, address, module, module))
+    return [blk for blk in (BlockEntry(*row) for row in rows) if address < blk.address + max(blk.size, 1)]
+
+  def block_at(self, address: int, module: int | None = None) -> BlockEntry | None:
+    """returns the first of blocks_at(address, module), if any."""
+    blks = self.blocks_at(address, module)
+    return blks[0] if blks else None
+
+  def raw(self, blk: BlockEntry) -> bytes:
+    return self.mm[blk.start:blk.end]
+
+  def semantics(self, blk: BlockEntry) -> list:
+    return json.loads(self.raw(blk))
+
+  def semantics_for(self, uuid: bytes | str, module: int | None = None) -> list:
+    blk = self.block(uuid, module)
+    if blk is None:
+      raise KeyError(uuid)
+    return self.semantics(blk)
+
+  def semantics_at(self, address: int, module: int | None = None) -> list:
+    blk = self.block_at(address, module)
+    if blk is None:
+      raise KeyError(hex(address))
+    return self.semantics(blk)
+
+def main():
+  argp = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  argp.add_argument('--index', help=f'index file (default: GTS_FILE{INDEX_SUFFIX})')
+  sub = argp.add_subparsers(dest='cmd', required=True)
+
+  b = sub.add_parser('build', help='(re)build the index for a .gts file')
+  b.add_argument('gts_input', help='.gts input file')
+
+  g = sub.add_parser('get', help='print the semantics of blocks by uuid or containing address')
+  g.add_argument('gts_input', help='.gts input file')
+  g.add_argument('keys', nargs='+', help='base64 block uuid, or address (e.g. 0x400684)')
+  g.add_argument('--module', type=int, help='only find blocks in the module with this index')
+
+  args = argp.parse_args()
+
+  with AstIndex(args.gts_input, args.index, rebuild=args.cmd == 'build') as idx:
+    if args.cmd == 'build':
+      print(f'indexed {len(idx)} blocks to {idx.index}', file=sys.stderr)
+      return 0
+
+    ret = 0
+    for key in args.keys:
+      try:
+        if key.endswith('=='):
+          blks = idx.blocks_for(key, args.module)
+        else:
+          blks = idx.blocks_at(int(key, 0), args.module)
+      except ValueError:
+        print(f'invalid key {key!r}: expected a base64 block uuid or an address', file=sys.stderr)
+        ret = 1
+        continue
+      if not blks:
+        print(f'no block found for {key!r}', file=sys.stderr)
+        ret = 1
+      for blk in blks:
+        b64 = base64.b64encode(blk.uuid).decode('ascii')
+        addr = None if blk.address is None else f'0x{blk.address:08x}'
+        json.dump({'uuid': b64, 'module': blk.module, 'address': addr, 'semantics': idx.semantics(blk)},
+                  sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    return ret
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,497 @@
+#!/usr/bin/env python3
+# vim: ts=2 sts=2 et sw=2
+
+# /// script
+# requires-python = ">=3.11"
+# dependencies = [
+#   "protobuf",
+# ]
+# ///
+
+"""
+bench.py gen OUTPUT_PREFIX [--modules N --sections N --blocks N --isns N]
+bench.py run [--size small|medium|large] [--repeat N]
+bench.py compare [--base COMMIT] [--head COMMIT]
+
+Benchmarks for the Python tooling on synthetic GTIRB files.
+
+`gen` writes OUTPUT_PREFIX.gtirb and OUTPUT_PREFIX.gts, generated from the
+bundled descriptor set with the given numbers of modules, code sections per
+module, blocks per section and instructions per block. The .gts has an `ast`
+auxdata table with synthetic semantics.
+
+`run` generates (or reuses) a fixture and times each case in a fresh
+process, recording wall time, CPU time and peak RSS. The cases are:
+
+  phase:*       load, traversal, auxdata decoding and JSON emission using
+                gts_reader, each timed alone after any setup
+  proto-json:*  scripts/proto-json.py conversions
+  debug-gts     scripts/debug-gts.py, with llvm-mc replaced by a stub
+  spelunk:*     extras/spelunking/spelunk.py (if `gtirb` is installed)
+
+Results are appended to a JSON lines file, tagged with the git commit, and
+`compare` shows the change between two runs on the same fixture.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import base64
+import struct
+import hashlib
+import pathlib
+import argparse
+import platform
+import resource
+import tempfile
+import datetime
+import subprocess
+import importlib.util
+
+import google.protobuf.message_factory
+import google.protobuf.descriptor_pb2
+
+from gtirb_fdset import gtirb_fdset_bytes
+
+SCRIPTS = pathlib.Path(__file__).resolve().parent
+REPO = SCRIPTS.parent
+DEFAULT_RESULTS = REPO / 'bench-results.jsonl'
+
+GTIRB_VERSION = 4
+MAGIC = b'GTIRB\0\0' + bytes([GTIRB_VERSION])
+ISN_SIZE = 4
+TEXT_ADDRESS = 0x400000
+
+SIZES = {
+  'small': dict(modules=1, sections=2, blocks=500, isns=6),
+  'medium': dict(modules=2, sections=4, blocks=4000, isns=8),
+  'large': dict(modules=4, sections=8, blocks=20000, isns=8),
+}
+
+# instruction templates: (mnemonic, base encoding, randomised field bits).
+# the fields are kept small so opcodes repeat as they do in real code.
+TEMPLATES = [
+  ('nop', 0xd503201f, []),
+  ('ret', 0xd65f03c0, []),
+  ('stp', 0xa9bf7bfd, []),
+  ('ldp', 0xa8c17bfd, []),
+  ('add', 0x91000000, [(0, 5), (5, 5), (10, 6)]),
+  ('sub', 0xd1000000, [(0, 5), (5, 5), (10, 6)]),
+  ('mov', 0xaa0003e0, [(0, 5), (16, 5)]),
+  ('ldr', 0xf9400000, [(0, 5), (5, 5), (10, 6)]),
+  ('str', 0xf9000000, [(0, 5), (5, 5), (10, 6)]),
+  ('cmp', 0xeb00001f, [(5, 5), (16, 5)]),
+  ('b.cond', 0x54000000, [(0, 4), (5, 8)]),
+  ('bl', 0x94000000, [(0, 10)]),
+]
+
+# decode errors are rare in practice.
+DECODE_ERROR_RATE = 0.001
+
+STUB_LLVM_MC = '''#!/usr/bin/env python3
+# llvm-mc stand-in for benchmarks. prints one line per 4-byte opcode.
+import sys
+if '--version' in sys.argv:
+  print('LLVM (http://llvm.org/):\\n  LLVM version 0.0.0-bench-stub')
+  sys.exit(0)
+data = bytes(int(x, 16) for x in sys.stdin.read().split())
+print('\\t.text')
+for i in range(0, len(data) - 3, 4):
+  print(f'\\tstub\\t#0x{int.from_bytes(data[i:i+4], "little"):08x}')
+'''
+
+def message_classes() -> dict[str, type]:
+  fds = google.protobuf.descriptor_pb2.FileDescriptorSet.FromString(gtirb_fdset_bytes())
+  return google.protobuf.message_factory.GetMessages(fds.file)
+
+def random_opcode(rng: random.Random) -> tuple[str, int]:
+  name, op, fields = rng.choice(TEMPLATES)
+  for shift, bits in fields:
+    op |= rng.getrandbits(bits) << shift
+  return name, op
+
+def semantics(name: str, op: int) -> list[str]:
+  """plausible ASL statements for an opcode, deterministic in the opcode."""
+  rd, rn, imm = op & 31, (op >> 5) & 31, (op >> 10) & 0xfff
+  reg = lambda r: f'Expr_Array(Expr_Var("_R"),Expr_LitInt("{r}"))'
+  out = [f'Stmt_Assign(LExpr_Array(LExpr_Var("_R"),Expr_LitInt("{rd}")),'
+         f'Expr_TApply("{name}_bits.0",[Expr_LitInt("64")],[{reg(rn)};Expr_LitBits("{imm:064b}")]))']
+  if name in ('ldr', 'str', 'stp', 'ldp'):
+    out.append(f'Stmt_TCall("Mem.set.0",[Expr_LitInt("8")],[{reg(rn)};Expr_LitInt("8");'
+               f'Expr_Var("AccType_NORMAL");{reg(rd)}])')
+  if name in ('b.cond', 'bl', 'ret'):
+    out.append(f'Stmt_Assign(LExpr_Var("_PC"),Expr_TApply("add_bits.0",[Expr_LitInt("64")],'
+               f'[Expr_Var("_PC");Expr_LitBits("{imm:064b}")]))')
+  return out
+
+def encode_uuid_map(m: dict[bytes, bytes]) -> bytes:
+  """serialises a mapping<UUID,UUID> auxdata table."""
+  return struct.pack('<Q', len(m)) + b''.join(k + v for k, v in m.items())
+
+def encode_uuid_set_map(m: dict[bytes, list[bytes]]) -> bytes:
+  """serialises a mapping<UUID,set<UUID>> auxdata table."""
+  out = [struct.pack('<Q', len(m))]
+  for k, vs in m.items():
+    out += [k, struct.pack('<Q', len(vs)), *vs]
+  return b''.join(out)
+
+def generate(modules: int, sections: int, blocks: int, isns: int,
+             function_size: int = 8, seed: int = 0) -> tuple[bytes, bytes]:
+  """returns the serialised .gtirb and .gts data of a synthetic IR."""
+  rng = random.Random(seed)
+  uuid = lambda: rng.randbytes(16)
+  mc = message_classes()
+  P = lambda name, **kw: mc['gtirb.proto.' + name](**kw)
+  Module = mc['gtirb.proto.Module']
+  EdgeType = mc['gtirb.proto.EdgeLabel'].DESCRIPTOR.fields_by_name['type'].enum_type
+
+  ir = P('IR', uuid=uuid(), version=GTIRB_VERSION)
+  asts = []
+  for m in range(modules):
+    mod = ir.modules.add(
+      uuid=uuid(), name=f'bench{m}', binary_path=f'bench{m}',
+      isa=Module.DESCRIPTOR.fields_by_name['isa'].enum_type.values_by_name['ARM64'].number,
+      file_format=Module.DESCRIPTOR.fields_by_name['file_format'].enum_type.values_by_name['ELF'].number,
+      byte_order=Module.DESCRIPTOR.fields_by_name['byte_order'].enum_type.values_by_name['LittleEndian'].number,
+    )
+    sems = {}
+    names, entries, fblocks = {}, {}, {}
+    address = TEXT_ADDRESS
+    for s in range(sections):
+      sec = mod.sections.add(uuid=uuid(), name='.text' if s == 0 else f'.text.{s}')
+      contents = bytearray()
+      bi = sec.byte_intervals.add(uuid=uuid(), has_address=True, address=address)
+      block_uuids = []
+      for b in range(blocks):
+        blk = bi.blocks.add(offset=len(contents))
+        blk.code.uuid = uuid()
+        blk.code.size = isns * ISN_SIZE
+        block_uuids.append(blk.code.uuid)
+        block_sems = []
+        for _ in range(isns):
+          name, op = random_opcode(rng)
+          contents += op.to_bytes(ISN_SIZE, 'little')
+          if rng.random() < DECODE_ERROR_RATE:
+            block_sems.append({'decode_error': {'opcode': f'0x{op:08x}', 'error': 'synthetic decode error'}})
+          else:
+            block_sems.append(semantics(name, op))
+        sems[blk.code.uuid] = block_sems
+      bi.size = len(contents)
+      bi.contents = bytes(contents)
+      address += len(contents) + 0x1000
+
+      # functions are runs of consecutive blocks, each named by a symbol.
+      funcs = [block_uuids[i:i+function_size] for i in range(0, len(block_uuids), function_size)]
+      for i, fn in enumerate(funcs):
+        fid = uuid()
+        sym = mod.symbols.add(uuid=uuid(), name=f'fn_{m}_{s}_{i}', referent_uuid=fn[0])
+        names[fid] = sym.uuid
+        entries[fid] = [fn[0]]
+        fblocks[fid] = fn
+        for a, b in zip(fn, fn[1:]):
+          ir.cfg.edges.add(source_uuid=a, target_uuid=b, label=P('EdgeLabel',
+            conditional=False, direct=True, type=EdgeType.values_by_name['Type_Fallthrough'].number))
+        if len(fn) > 2:
+          ir.cfg.edges.add(source_uuid=fn[1], target_uuid=rng.choice(fn), label=P('EdgeLabel',
+            conditional=True, direct=True, type=EdgeType.values_by_name['Type_Branch'].number))
+        if i + 1 < len(funcs):
+          ir.cfg.edges.add(source_uuid=fn[0], target_uuid=funcs[i+1][0], label=P('EdgeLabel',
+            conditional=False, direct=True, type=EdgeType.values_by_name['Type_Call'].number))
+      ir.cfg.vertices.extend(block_uuids)
+
+    data = mod.sections.add(uuid=uuid(), name='.data')
+    dbi = data.byte_intervals.add(uuid=uuid(), has_address=True, address=address, size=64 * blocks)
+    dbi.contents = rng.randbytes(64 * blocks)
+    for b in range(blocks):
+      blk = dbi.blocks.add(offset=64 * b)
+      blk.data.uuid = uuid()
+      blk.data.size = 64
+
+    mod.aux_data['functionNames'].CopyFrom(P('AuxData', type_name='mapping<UUID,UUID>', data=encode_uuid_map(names)))
+    mod.aux_data['functionEntries'].CopyFrom(P('AuxData', type_name='mapping<UUID,set<UUID>>', data=encode_uuid_set_map(entries)))
+    mod.aux_data['functionBlocks'].CopyFrom(P('AuxData', type_name='mapping<UUID,set<UUID>>', data=encode_uuid_set_map(fblocks)))
+    asts.append(sems)
+
+  gtirb = MAGIC + ir.SerializeToString()
+  for mod, sems in zip(ir.modules, asts):
+    data = {base64.b64encode(k).decode('ascii'): v for k, v in sems.items()}
+    mod.aux_data['ast'].CopyFrom(P('AuxData', type_name='ast', data=json.dumps(data, separators=(',', ':')).encode()))
+  return gtirb, ir.SerializeToString()
+
+def fixture(params: dict, fixtures: pathlib.Path) -> pathlib.Path:
+  """returns the prefix of a (cached) fixture generated with the given parameters."""
+  key = hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+  prefix = fixtures / f'bench-{key}'
+  if not (prefix.with_suffix('.gtirb').exists() and prefix.with_suffix('.gts').exists()):
+    fixtures.mkdir(parents=True, exist_ok=True)
+    print(f'generating fixture {prefix} {params}', file=sys.stderr)
+    gtirb, gts = generate(**params)
+    prefix.with_suffix('.gtirb').write_bytes(gtirb)
+    prefix.with_suffix('.gts').write_bytes(gts)
+  return prefix
+
+
+# phases timed in-process, each run in its own process by `run`. setup is
+# done before timing starts; the returned value is discarded.
+
+def _load(gts):
+  import gts_reader
+  return gts_reader, gts_reader.load(gts)
+
+def phase_load(gts):
+  t = time.perf_counter(), time.process_time()
+  _load(gts)
+  return t
+
+def phase_traverse(gts):
+  _, ir = _load(gts)
+  t = time.perf_counter(), time.process_time()
+  n = 0
+  for mod in ir.modules:
+    for blk in mod.code_blocks:
+      n += len(blk.contents) + len(ir.outgoing.get(blk.uuid, ()))
+      mod.references.get(blk.uuid)
+  return t
+
+def phase_decode(gts):
+  _, ir = _load(gts)
+  import gts_ast
+  t = time.perf_counter(), time.process_time()
+  for mod in ir.modules:
+    mod.function_names, mod.function_entries, mod.function_blocks
+    dict(gts_ast.semantics(mod))
+  return t
+
+def phase_emit(gts):
+  _, ir = _load(gts)
+  import gts_ast
+  sems = [dict(gts_ast.semantics(mod)) for mod in ir.modules]
+  t = time.perf_counter(), time.process_time()
+  with open(os.devnull, 'w') as f:
+    json.dump(sems, f, indent=2)
+  return t
+
+PHASES = {
+  'load': phase_load,
+  'traverse': phase_traverse,
+  'decode': phase_decode,
+  'emit': phase_emit,
+}
+
+def run_phase(name: str, gts: str):
+  sys.path.insert(0, str(SCRIPTS))
+  w, c = PHASES[name](gts)
+  json.dump({
+    'wall': time.perf_counter() - w,
+    'cpu': time.process_time() - c,
+    'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+  }, sys.stdout)
+
+
+def measure(argv: list[str], env: dict) -> dict:
+  """runs argv to completion, returning its wall time, CPU time and peak RSS."""
+  # stderr goes to a file, so that only stdout needs draining (and neither
+  # pipe can fill up while the other is read). the child is reaped with
+  # wait4 rather than communicate() for its own resource usage.
+  with tempfile.TemporaryFile() as errf:
+    start = time.perf_counter()
+    proc = subprocess.Popen(argv, env=env, stdout=subprocess.PIPE, stderr=errf)
+    out = io.BytesIO()
+    while chunk := proc.stdout.read(1 << 16):
+      out.write(chunk)
+    _, status, ru = os.wait4(proc.pid, 0)
+    wall = time.perf_counter() - start
+    errf.seek(0)
+    err = errf.read()
+  proc.returncode = os.waitstatus_to_exitcode(status)
+  if proc.returncode != 0:
+    raise RuntimeError(f'{argv[1:3]} exited with {proc.returncode}: {err.decode(errors="replace")[-2000:]}')
+  return {
+    'wall': wall,
+    'cpu': ru.ru_utime + ru.ru_stime,
+    'peak_rss_mb': ru.ru_maxrss / 1024,
+    'stdout': out.getvalue(),
+  }
+
+def cases(prefix: pathlib.Path, work: pathlib.Path) -> list[tuple[str, list[str]]]:
+  py = sys.executable
+  gts, gtirb = str(prefix.with_suffix('.gts')), str(prefix.with_suffix('.gtirb'))
+  pj = str(SCRIPTS / 'proto-json.py')
+  out = [(f'phase:{p}', [py, __file__, '_phase', p, gts]) for p in PHASES]
+  out += [
+    ('proto-json:gts', [py, pj, gts, str(work / 'a.json')]),
+    ('proto-json:stream', [py, pj, '--stream', gts, str(work / 'b.json')]),
+    ('proto-json:omit', [py, pj, '--contents', 'omit', gts, str(work / 'c.json')]),
+    ('proto-json:json-to-gts', [py, pj, '--from', 'json', str(work / 'a.json'), str(work / 'a.gts')]),
+    ('debug-gts', [py, str(SCRIPTS / 'debug-gts.py'), '--no-cache', gts, str(work / 'debug.json')]),
+  ]
+  if importlib.util.find_spec('gtirb'):
+    spelunk = str(REPO / 'extras' / 'spelunking' / 'spelunk.py')
+    out += [(f'spelunk:{k}', [py, spelunk, gtirb, k]) for k in ('code', 'functions', 'instrs')]
+  else:
+    print('warning: `gtirb` package not found, skipping spelunk.py', file=sys.stderr)
+  return out
+
+def git_commit() -> tuple[str | None, bool]:
+  try:
+    sha = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO, encoding='ascii',
+                                  stderr=subprocess.DEVNULL).strip()
+    dirty = bool(subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                         cwd=REPO, encoding='ascii'))
+    return sha, dirty
+  except (OSError, subprocess.CalledProcessError):
+    return None, False
+
+def run(args) -> int:
+  params = dict(SIZES[args.size])
+  for k in ('modules', 'sections', 'blocks', 'isns'):
+    if getattr(args, k) is not None:
+      params[k] = getattr(args, k)
+  prefix = fixture(params, pathlib.Path(args.fixtures))
+
+  with tempfile.TemporaryDirectory(prefix='gtirb-bench-') as work:
+    work = pathlib.Path(work)
+    stub = work / 'bin' / 'llvm-mc'
+    stub.parent.mkdir()
+    stub.write_text(STUB_LLVM_MC)
+    stub.chmod(0o755)
+    env = dict(os.environ, PATH=f'{stub.parent}{os.pathsep}{os.environ.get("PATH", "")}',
+               XDG_CACHE_HOME=str(work / 'cache'), PYTHONHASHSEED='0')
+
+    results = {}
+    for name, argv in cases(prefix, work):
+      if args.filter and args.filter not in name:
+        continue
+      best = None
+      for _ in range(args.repeat):
+        try:
+          r = measure(argv, env)
+        except RuntimeError as e:
+          print(f'{name}: failed: {e}', file=sys.stderr)
+          best = None
+          break
+        if name.startswith('phase:'):
+          r.update(json.loads(r['stdout']))
+        del r['stdout']
+        if best is None:
+          best = r
+        else:
+          best = {'wall': min(best['wall'], r['wall']), 'cpu': min(best['cpu'], r['cpu']),
+                  'peak_rss_mb': max(best['peak_rss_mb'], r['peak_rss_mb'])}
+      if best is None:
+        continue
+      results[name] = {k: round(v, 4) for k, v in best.items()}
+      print(f'{name:24} {best["wall"]:8.3f}s wall {best["cpu"]:8.3f}s cpu {best["peak_rss_mb"]:8.1f} MB',
+            file=sys.stderr)
+
+  sha, dirty = git_commit()
+  record = {
+    'time': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+    'commit': sha,
+    'dirty': dirty,
+    'label': args.label,
+    'python': platform.python_version(),
+    'host': platform.node(),
+    'fixture': params,
+    'repeat': args.repeat,
+    'results': results,
+  }
+  with open(args.results, 'a') as f:
+    f.write(json.dumps(record, sort_keys=True) + '\n')
+  print(f'results appended to {args.results}', file=sys.stderr)
+  return 0
+
+def compare(args) -> int:
+  with open(args.results) as f:
+    records = [json.loads(x) for x in f if x.strip()]
+
+  def find(commit: str | None, before: int) -> int | None:
+    for i in reversed(range(before)):
+      if commit is None or (records[i]['commit'] or '').startswith(commit) or records[i]['label'] == commit:
+        return i
+    return None
+
+  head = find(args.head, len(records))
+  if head is None:
+    print('no matching head run', file=sys.stderr)
+    return 1
+  same = [i for i in range(head) if records[i]['fixture'] == records[head]['fixture']]
+  base = find(args.base, head) if args.base else (same[-1] if same else None)
+  if base is None or records[base]['fixture'] != records[head]['fixture']:
+    print('no earlier run with the same fixture to compare against', file=sys.stderr)
+    return 1
+
+  b, h = records[base], records[head]
+  print(f"base: {(b['commit'] or '?')[:10]}{'+' if b['dirty'] else ''} {b['time']}  "
+        f"head: {(h['commit'] or '?')[:10]}{'+' if h['dirty'] else ''} {h['time']}  fixture: {h['fixture']}")
+  print(f"{'case':24} {'base':>9} {'head':>9} {'change':>8} {'peak MB':>9} {'change':>8}")
+  ret = 0
+  for name in sorted(set(b['results']) | set(h['results'])):
+    x, y = b['results'].get(name), h['results'].get(name)
+    if not x or not y:
+      print(f'{name:24} {"-" if not x else format(x["wall"], "9.3f"):>9} {"-" if not y else format(y["wall"], "9.3f"):>9}')
+      continue
+    dt = y['wall'] / x['wall'] - 1 if x['wall'] else 0
+    dm = y['peak_rss_mb'] / x['peak_rss_mb'] - 1 if x['peak_rss_mb'] else 0
+    flag = ''
+    if dt > args.threshold or dm > args.threshold:
+      flag = '  <- regression'
+      ret = 1
+    print(f"{name:24} {x['wall']:9.3f} {y['wall']:9.3f} {dt:+8.1%} {y['peak_rss_mb']:9.1f} {dm:+8.1%}{flag}")
+  return ret
+
+def main():
+  if len(sys.argv) > 1 and sys.argv[1] == '_phase':
+    return run_phase(sys.argv[2], sys.argv[3])
+
+  argp = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  sub = argp.add_subparsers(dest='cmd', required=True)
+
+  def add_size_args(p):
+    p.add_argument('--modules', type=int, help='modules in the IR')
+    p.add_argument('--sections', type=int, help='code sections per module')
+    p.add_argument('--blocks', type=int, help='code blocks per section')
+    p.add_argument('--isns', type=int, help='instructions per block')
+
+  g = sub.add_parser('gen', help='write a synthetic .gtirb and .gts')
+  g.add_argument('output', help='output prefix; writes OUTPUT.gtirb and OUTPUT.gts')
+  g.add_argument('--size', choices=SIZES, default='small', help='preset sizes, overridden by the options below')
+  add_size_args(g)
+  g.add_argument('--seed', type=int, default=0)
+
+  r = sub.add_parser('run', help='run the benchmarks and record the results')
+  r.add_argument('--size', choices=SIZES, default='small', help='preset fixture size, overridden by the options below')
+  add_size_args(r)
+  r.add_argument('--repeat', type=int, default=3, help='runs of each case; the fastest is kept')
+  r.add_argument('--filter', help='only run cases whose name contains this')
+  r.add_argument('--label', help='label stored with the results')
+  r.add_argument('--results', default=str(DEFAULT_RESULTS), help='results file (JSON lines)')
+  r.add_argument('--fixtures', default=os.path.join(tempfile.gettempdir(), 'gtirb-bench-fixtures'),
+                 help='directory for cached fixtures')
+
+  c = sub.add_parser('compare', help='compare two recorded runs on the same fixture')
+  c.add_argument('--base', help='commit prefix or label of the base run (default: the previous run)')
+  c.add_argument('--head', help='commit prefix or label of the head run (default: the latest run)')
+  c.add_argument('--threshold', type=float, default=0.1, help='relative slowdown reported as a regression')
+  c.add_argument('--results', default=str(DEFAULT_RESULTS), help='results file (JSON lines)')
+
+  args = argp.parse_args()
+  if args.cmd == 'gen':
+    params = dict(SIZES[args.size])
+    for k in ('modules', 'sections', 'blocks', 'isns'):
+      if getattr(args, k) is not None:
+        params[k] = getattr(args, k)
+    gtirb, gts = generate(**params, seed=args.seed)
+    pathlib.Path(args.output + '.gtirb').write_bytes(gtirb)
+    pathlib.Path(args.output + '.gts').write_bytes(gts)
+    print(f'wrote {args.output}.gtirb ({len(gtirb)} bytes) and {args.output}.gts ({len(gts)} bytes)', file=sys.stderr)
+    return 0
+  if args.cmd == 'run':
+    return run(args)
+  return compare(args)
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -4,12 +4,14 @@
 # /// script
 # requires-python = ">=3.11"
 # dependencies = [
-#   "gtirb~=2.0.0",
+#   "numpy",
+#   "protobuf",
 # ]
 # ///
 
 # Requirements:
-#  gtirb
+#  numpy
+#  protobuf
 
 """
 debug-gts.py [GTS FILE]
@@ -49,47 +51,55 @@ example output:
 """
 
 
-import io
 import sys
-import uuid
 import json
 import shlex
+import typing
 try:
-  import gtirb
+  import numpy
+  import gts_ast
+  import gts_opcodes
+  import gts_profile
+  import gts_reader
 except ImportError:
-  print('ERROR: `gtirb` python package not found! to run this script and automatically download dependencies, you can use `pipx`:', file=sys.stderr)
+  print('ERROR: `protobuf` or `numpy` python package not found! to run this script and automatically download dependencies, you can use `pipx`:', file=sys.stderr)
   print('', file=sys.stderr)
   print('    pipx run', sys.argv[0], file=sys.stderr)
   print('', file=sys.stderr)
-  print('or, alternatively, create a virtual environment and install gtirb there:', file=sys.stderr)
+  print('or, alternatively, create a virtual environment and install protobuf there:', file=sys.stderr)
   print('', file=sys.stderr)
   print('    python3 -m venv path/to/venv', file=sys.stderr)
   print('    source path/to/venv/bin/activate', file=sys.stderr)
-  print('    pip install gtirb', file=sys.stderr)
+  print('    pip install protobuf numpy', file=sys.stderr)
   print('', file=sys.stderr)
   print('If you are seeing this error within a Nix package, this has been incorrectly packaged.', file=sys.stderr)
   print('', file=sys.stderr)
   raise
+import os
+import time
 import base64
 import shutil
-import gtirb.ir
+import sqlite3
+import hashlib
+import pathlib
 import argparse
 import warnings
 import subprocess
 import dataclasses
 import collections
+import concurrent.futures
 import collections.abc
 
 @dataclasses.dataclass
 class Arguments:
   llvmmc_args: list[str]
   chunk_size: int
+  jobs: int
+  debug: bool
+  cache: 'IsnCache | None' = None
 
 arguments: Arguments  # global command-line arguments object....
 
-
-PROTO_VERSION = gtirb.version.PROTOBUF_VERSION
-
 llvm_mc = shutil.which('llvm-mc')
 assert llvm_mc, "could not find llvm-mc in PATH, check that llvm is installed."
 
@@ -102,134 +112,290 @@ def chunks(lst, n):
 def format_address(addr: int):
   return f'0x{addr:08x} ({addr})'
 
+def default_cache_path() -> pathlib.Path:
+  base = os.environ.get('XDG_CACHE_HOME') or pathlib.Path.home() / '.cache'
+  return pathlib.Path(base) / 'gtirb-semantics' / 'llvm-mc.sqlite3'
+
+class IsnCache:
+  """
+  Persistent opcode -> assembly cache, stored in an sqlite database.
+
+  Entries are keyed by the opcode bytes together with a namespace derived
+  from the llvm-mc version and its extra arguments (e.g. -mattr), so the
+  cached text is exactly what llvm-mc would print for that opcode.
+  Opcodes which llvm-mc fails to disassemble are cached too, with NULL
+  assembly, so they are not retried on every run.
+  The cache holds at most `max_entries` rows; the least recently used
+  rows are evicted beyond that.
+  """
+
+  def __init__(self, path: pathlib.Path, llvmmc_args: list[str], max_entries: int):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    self.db = sqlite3.connect(path)
+    self.db.execute('CREATE TABLE IF NOT EXISTS isns '
+                    '(ns TEXT, opcode BLOB, assembly TEXT, used INTEGER, PRIMARY KEY (ns, opcode))')
+    self.db.execute('CREATE INDEX IF NOT EXISTS isns_used ON isns (used)')
+    self.max_entries = max_entries
+    self.ns = self.namespace(llvmmc_args)
+    self.evict()
+
+  @staticmethod
+  def namespace(llvmmc_args: list[str]) -> str:
+    version = subprocess.check_output([llvm_mc, '--version'], encoding='ascii')
+    version = [x.strip() for x in version.splitlines() if 'version' in x.lower()]
+    key = '\0'.join([llvm_mc, *version, *llvmmc_args])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+
+  def get(self, isns: collections.abc.Sequence[bytes]) -> dict[bytes, str | None]:
+    out = {}
+    for x in chunks(isns, 500):
+      q = 'SELECT opcode, assembly FROM isns WHERE ns = ? AND opcode IN ({})'.format(','.join('?' * len(x)))
+      out |= dict(self.db.execute(q, (self.ns, *x)))
+    with self.db:
+      now = time.time_ns()
+      self.db.executemany('UPDATE isns SET used = ? WHERE ns = ? AND opcode = ?',
+                          ((now, self.ns, k) for k in out))
+    return out
+
+  def put(self, isn_names: dict[bytes, str | None]):
+    with self.db:
+      now = time.time_ns()
+      self.db.executemany('INSERT OR REPLACE INTO isns VALUES (?, ?, ?, ?)',
+                          ((self.ns, k, v, now) for k, v in isn_names.items()))
+    self.evict()
+
+  def evict(self):
+    with self.db:
+      count, = self.db.execute('SELECT COUNT(*) FROM isns').fetchone()
+      if count > self.max_entries:
+        self.db.execute('DELETE FROM isns WHERE rowid IN (SELECT rowid FROM isns ORDER BY used LIMIT ?)',
+                        (count - self.max_entries,))
+
+class DecodeError(Exception):
+  pass
+
+def bad_isn(opcode_bytes: bytes) -> str:
+  """placeholder assembly for opcodes which llvm-mc fails to disassemble."""
+  return f'<llvm-mc decode failed: {opcode_bytes.hex()}>'
+
 def _decode_isns(isns: collections.abc.Iterable[bytes]):
   isns = list(isns)
   if not isns: return {}
 
   hex = ' '.join(f'0x{x:02x}' for opcode_bytes in isns for x in opcode_bytes)
-  out = subprocess.check_output([llvm_mc, '--disassemble', '--arch=arm64'] + arguments.llvmmc_args,
-                                input=hex, encoding='ascii')
-
-  out = out.replace('.text', '', 1).strip()  # discard first .text
-  assert out, f"llvm-mc returned empty output. {isns=}"  # should never be empty since len(isns) != 0
-  outs = (x.strip().replace('\t', ' ') for x in out.split('\n'))
-
-  ret = dict(zip(isns, outs))
-  assert len(isns) == len(ret), f"llvm-mc isn count mismatch. {len(isns)=} {len(ret)=}"
-  return ret
-
-def decode_isns(isns: collections.abc.Iterable[bytes]):
-  out = {}
-  for x in chunks(isns, arguments.chunk_size):
-    out |= _decode_isns(x)
-  return out 
-
-def do_block(uuid: str, blk: gtirb.CodeBlock, contents: bytes, sem, isn_names: dict[bytes, str]):
-  blksize = blk.size
-  # offset within the byte interval. many code blocks may point into one byte interval.
-  off = blk.offset
-
-  isize = 32 // 8  # == 4 bytes per instruction
-  def slice(i: int):
-    i *= isize
-    assert 0 <= i and i + isize <= blksize
-    i += off
-    assert 0 <= i and i + isize <= len(contents)
-    return contents[i:i+isize]
-
-  if len(sem) * isize != blksize:
-    warnings.warn(f"semantics and gtirb instruction counts differ in block {uuid!r}. "
-                  f"semantics: {len(sem)}, gtirb: {blksize / isize}")
-
-  ret = [
-    {
-      "address": format_address(blk.address + i * isize),
-      "assembly": isn_names[slice(i)],
-      "semantics": sem,
-    }
-    for i, sem in enumerate(sem)
-  ]
-  return ret
-
-def b64_uuid(uuid: uuid.UUID) -> str:
-  return base64.b64encode(uuid.bytes).decode('ascii')
-
-def compute_friendly_names(mod: gtirb.Module) -> dict[uuid.UUID, str]:
-  funnames = mod.aux_data['functionNames'].data
-  funentries = mod.aux_data['functionEntries'].data
-  funblocks = mod.aux_data['functionBlocks'].data
+  with gts_profile.phase('llvm-mc', opcodes=len(isns)):
+    proc = subprocess.run([llvm_mc, '--disassemble', '--arch=arm64'] + arguments.llvmmc_args,
+                          input=hex, encoding='ascii', capture_output=True)
+  if proc.returncode != 0:
+    raise DecodeError(f"llvm-mc exited with code {proc.returncode}: {proc.stderr.strip()}")
+
+  out = proc.stdout.replace('.text', '', 1).strip()  # discard first .text
+  outs = [x.strip().replace('\t', ' ') for x in out.split('\n')] if out else []
+
+  # llvm-mc skips invalid encodings with only a warning, so a short output
+  # means some opcode in this chunk could not be decoded.
+  if len(isns) != len(outs):
+    raise DecodeError(f"llvm-mc isn count mismatch. {len(isns)=} {len(outs)=}: {proc.stderr.strip()}")
+  return dict(zip(isns, outs))
+
+def _decode_bisect(isns: collections.abc.Sequence[bytes]) -> tuple[dict[bytes, str], list[bytes]]:
+  """
+  decodes the given opcodes, bisecting the chunk on failure to isolate
+  the opcodes which llvm-mc cannot decode. returns the successfully decoded
+  opcodes and a list of failing opcodes.
+  """
+  try:
+    return _decode_isns(isns), []
+  except DecodeError as e:
+    if len(isns) == 1:
+      if arguments.debug:
+        warnings.warn(f"failed to decode opcode {isns[0].hex()}: {e}")
+      return {}, list(isns)
+    mid = len(isns) // 2
+    good1, bad1 = _decode_bisect(isns[:mid])
+    good2, bad2 = _decode_bisect(isns[mid:])
+    return good1 | good2, bad1 + bad2
+
+def decode_isns(isns: collections.abc.Sequence[bytes]):
+  cache = arguments.cache
+  with gts_profile.phase('cache get', opcodes=len(isns)):
+    cached = cache.get(isns) if cache else {}
+  out = {k: v for k, v in cached.items() if v is not None}
+  known_bad = [k for k, v in cached.items() if v is None]
+  todo = [x for x in isns if x not in cached]
+
+  # spread the work evenly across the pool, but keep chunks small enough
+  # that a failing chunk is cheap to bisect.
+  size = max(1, min(arguments.chunk_size, -(-len(todo) // arguments.jobs)))
+  new = {}
+  bad = []
+  with concurrent.futures.ThreadPoolExecutor(arguments.jobs) as pool:
+    for good, failed in pool.map(_decode_bisect, chunks(todo, size)):
+      new |= good
+      bad += failed
+
+  if cache and (new or bad):
+    with gts_profile.phase('cache put', opcodes=len(new) + len(bad)):
+      cache.put(new | dict.fromkeys(bad))
+  if arguments.debug:
+    for x in known_bad:
+      warnings.warn(f"failed to decode opcode {x.hex()} (cached)")
+  if bad or known_bad:
+    warnings.warn(f"llvm-mc failed to decode {len(bad) + len(known_bad)} opcodes"
+                  + ('' if arguments.debug else ', use --debug for details'))
+
+  return out | new | {x: bad_isn(x) for x in bad + known_bad}
+
+ISN_SIZE = 32 // 8  # == 4 bytes per instruction
+
+def b64_uuid(uuid: bytes) -> str:
+  return base64.b64encode(uuid).decode('ascii')
+
+def compute_friendly_names(ir: gts_reader.IR, mod: gts_reader.Module) -> dict[bytes, str]:
+  funnames = mod.function_names
+  funentries = mod.function_entries
+  funblocks = mod.function_blocks
+  addresses = {blk.uuid: blk.address for blk in mod.code_blocks}
 
   out = {}
   for func, blks in funblocks.items():
     l = str(len(blks))
 
-    blks = sorted(blks, key=lambda blk: blk.address) # type: ignore
+    blks = sorted(blks, key=lambda blk: addresses[blk]) # type: ignore
     for i, blk in enumerate(blks, 1):
       entry = ' [entry]' if blk in funentries[func] else ''
-      outgoing = next(blk.outgoing_edges, None)
+      outgoing = next(iter(ir.outgoing.get(blk, ())), None)
       proxy_name = ''
-      if outgoing:
-        proxy = outgoing.target
-        proxy_ref = next(proxy.references, None) if isinstance(proxy, gtirb.ProxyBlock) else None
-        proxy_name = f" ({proxy_ref.name})" if proxy_ref else ''
-      out[blk.uuid] = funnames[func].name + proxy_name + entry + ' [{i:>{w}}/{l}]'.format(i=i, l=l, w=len(l))
+      if outgoing and outgoing.target in mod.proxies:
+        proxy_ref = next(iter(mod.references.get(outgoing.target, ())), None)
+        proxy_name = f" ({mod.symbol_names[proxy_ref]})" if proxy_ref else ''
+      out[blk] = mod.symbol_names[funnames[func]] + proxy_name + entry + ' [{i:>{w}}/{l}]'.format(i=i, l=l, w=len(l))
 
   return out
 
-def friendly_block(mod: gtirb.Module, blk: gtirb.Block, with_uuid=False, *, _block_to_func: dict[uuid.UUID, str] = {}):
-  if not _block_to_func:
-    _block_to_func |= compute_friendly_names(mod)
-
-  uuid = blk.uuid
+@dataclasses.dataclass
+class ModuleIndex:
+  """
+  everything needed to render a module, collected in a single traversal of
+  the module. indexes are built one module at a time, as each is written.
+  """
+  ir: gts_reader.IR
+  mod: gts_reader.Module
+  names: dict[bytes, str]  # code block -> friendly function name
+  blocks: list[gts_reader.CodeBlock]
+  opcodes: dict[bytes, numpy.ndarray]  # code block -> uint32 instruction words
+  sems: collections.abc.Mapping[str, list]  # semantics keyed by base64 uuid
+
+def block_opcodes(mod: gts_reader.Module) -> dict[bytes, numpy.ndarray]:
+  """each code block's instruction words, as views of the module's contents."""
+  return {blk.uuid: gts_opcodes.block_words(blk, mod.byte_order) for blk in mod.code_blocks}
+
+def index_module(ir: gts_reader.IR, mod: gts_reader.Module, opcodes: dict[bytes, numpy.ndarray]) -> ModuleIndex:
+  sems = gts_ast.semantics(mod)
+  blocks = mod.code_blocks
+  with gts_profile.phase('compute_friendly_names', module=mod.name):
+    names = compute_friendly_names(ir, mod)
+  return ModuleIndex(ir, mod, names, blocks, opcodes, sems)
+
+def friendly_block(idx: ModuleIndex, uuid: bytes, with_uuid=False):
   prefix = '' if not with_uuid else b64_uuid(uuid) + ' / '
-  if isinstance(blk, gtirb.CodeBlock):
-    return prefix + _block_to_func[uuid]
-  elif isinstance(blk, gtirb.ProxyBlock):
-    ref = next(blk.references, None)
+  if uuid in idx.names:
+    return prefix + idx.names[uuid]
+  elif uuid in idx.mod.proxies:
+    ref = next(iter(idx.mod.references.get(uuid, ())), None)
     if ref is not None: 
-      return prefix + f'({type(blk).__name__})' + ' / ' + ref.name
+      return prefix + '(ProxyBlock)' + ' / ' + idx.mod.symbol_names[ref]
     else :
-      return prefix + "Unresolved " + f'{type(blk).__name__}' 
+      return prefix + "Unresolved ProxyBlock"
+
+  return prefix + '(CodeBlock)'
 
-  return prefix + f'({type(blk).__name__})'
+def do_block(uuid: str, blk: gts_reader.CodeBlock, opcodes: list[int], sem, isn_names: dict[int, str]):
+  if len(sem) * ISN_SIZE != blk.size:
+    warnings.warn(f"semantics and gtirb instruction counts differ in block {uuid!r}. "
+                  f"semantics: {len(sem)}, gtirb: {blk.size / ISN_SIZE}")
+  assert len(sem) <= len(opcodes)
 
-def do_module(mod: gtirb.Module, isn_names: dict[bytes, str]):
-  sems = mod.aux_data['ast'].data
-  sems = json.loads(sems)
+  ret = [
+    {
+      "address": format_address(blk.address + i * ISN_SIZE),
+      "assembly": isn_names[opcodes[i]],
+      "semantics": sem,
+    }
+    for i, sem in enumerate(sem)
+  ]
+  return ret
 
+def do_module(idx: ModuleIndex, isn_names: dict[int, str]) -> collections.abc.Iterator[tuple[str, dict]]:
+  """
+  yields the rendered blocks of the module one at a time, in address order.
+  a block with no semantics is rendered with null "code".
+  """
+  sems = idx.sems
 
   gtirb_ids = set()
   sem_ids = set(sems.keys())
-  out = {}
-  for sec in mod.sections:
-    for blk in sec.code_blocks:
-      if not isinstance(blk, gtirb.CodeBlock): continue
-
-      uuid = blk.uuid
-
-      b64 = b64_uuid(uuid)
-      friendly = friendly_block(mod, blk)
-      out[b64] = {
-        'name': friendly,
-        'address': format_address(blk.address),
-        'code': do_block(friendly, blk, bytes(blk.byte_interval.contents), sems[b64], isn_names), # type: ignore
-        'successors': {
-          b64_uuid(x.target.uuid): friendly_block(mod, x.target) + ' / ' + str(x.label)
-          for x in blk.outgoing_edges
-        },
-      }
-      gtirb_ids.add(b64)
-
-  out = list(out.items())
-  out.sort(key=lambda x: x[1]['address'])
-  out = dict(out)
+  for blk in sorted(idx.blocks, key=lambda blk: blk.address):
+    b64 = b64_uuid(blk.uuid)
+    friendly = friendly_block(idx, blk.uuid)
+    if b64 in sems:
+      code = do_block(friendly, blk, idx.opcodes[blk.uuid].tolist(), sems[b64], isn_names)
+    else:
+      warnings.warn(f'no semantics for block {b64} ({friendly}), writing null "code"')
+      code = None
+    yield b64, {
+      'name': friendly,
+      'address': format_address(blk.address),
+      'code': code,
+      'successors': {
+        b64_uuid(x.target): friendly_block(idx, x.target) + ' / ' + x.label()
+        for x in idx.ir.outgoing.get(blk.uuid, ())
+      },
+    }
+    gtirb_ids.add(b64)
 
   if gtirb_ids != sem_ids:
     warnings.warn(f'semantics and gtirb block uuids differ.\n'
                   f'  in gtirb but not semantics: {gtirb_ids - sem_ids}.\n'
                   f'  in semantics but not gtirb: {sem_ids - gtirb_ids}')
 
-  return out
+def write_json(f: typing.TextIO, indexes: collections.abc.Iterable[ModuleIndex], isn_names: dict[int, str]):
+  """
+  writes a list of per-module objects, formatted identically to
+  json.dump(..., indent=2) but rendering and writing one block at a time.
+  """
+  f.write('[')
+  i = -1
+  for i, idx in enumerate(indexes):
+    f.write(',\n  {' if i else '\n  {')
+    empty = True
+    with gts_profile.phase('write module', module=idx.mod.name):
+      for b64, blk in do_module(idx, isn_names):
+        f.write('\n    ' if empty else ',\n    ')
+        f.write(json.dumps(b64) + ': ' + json.dumps(blk, indent=2).replace('\n', '\n    '))
+        empty = False
+    f.write('}' if empty else '\n  }')
+  f.write('\n]\n' if i >= 0 else ']\n')
+
+def write_jsonl(f: typing.TextIO, indexes: collections.abc.Iterable[ModuleIndex], isn_names: dict[int, str]):
+  """
+  writes one compact JSON object per line for each block, tagged with its
+  module and uuid.
+  """
+  for idx in indexes:
+    with gts_profile.phase('write module', module=idx.mod.name):
+      for b64, blk in do_module(idx, isn_names):
+        f.write(json.dumps({'module': idx.mod.name, 'uuid': b64} | blk, separators=(',', ':')))
+        f.write('\n')
+
+def write_histogram(f: typing.TextIO, ops: numpy.ndarray, counts: numpy.ndarray, isn_names: dict[int, str]):
+  """writes each opcode with its count and assembly, most frequent first."""
+  order = numpy.argsort(-counts, kind='stable')
+  json.dump([
+    {'opcode': f'{op:08x}', 'count': n, 'assembly': isn_names[op]}
+    for op, n in zip(ops[order].tolist(), counts[order].tolist())
+  ], f, indent=2)
+  f.write('\n')
 
 def main():
 
@@ -238,45 +404,76 @@ def main():
   argp.add_argument('json_output', nargs='?', type=argparse.FileType('w'),
                     help='.json output file',
                     default=sys.stdout)
+  argp.add_argument('--format', choices=['json', 'jsonl'], default='json',
+                    help='output format. jsonl writes one compact line per block.')
   argp.add_argument('--debug', action='store_true',
-                    help='prioritise debugging failing opcodes instead of performance.')
+                    help='report each opcode which llvm-mc fails to decode.')
+  argp.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                    help='number of llvm-mc processes to run concurrently.')
   argp.add_argument('--args', dest='llvmmc_args', default='-mattr=v9.3a',
                     help='extra arguments to pass to llvm-mc. will be shell split.')
+  argp.add_argument('--cache', type=pathlib.Path, default=default_cache_path(),
+                    help='persistent opcode -> assembly cache file.')
+  argp.add_argument('--cache-size', type=int, default=1_000_000,
+                    help='maximum number of opcodes kept in the cache.')
+  argp.add_argument('--no-cache', action='store_true',
+                    help='always decode every opcode with llvm-mc.')
+  argp.add_argument('--histogram', metavar='JSON', type=argparse.FileType('w'), default=None,
+                    help='write the opcodes in the file, with their counts and assembly, most frequent first.')
+  argp.add_argument('--profile', metavar='TRACE_JSON', default=None,
+                    help='write per-phase timings and memory use as a Chrome trace-event file.')
 
   args = argp.parse_args()
-
+  if args.profile:
+    gts_profile.enable()
+  try:
+    return run(args)
+  finally:
+    if args.profile:
+      gts_profile.write(args.profile)
+      print(f'wrote profile to {args.profile}', file=sys.stderr)
+
+def run(args) -> int:
   global arguments
   arguments = Arguments(
     llvmmc_args = shlex.split(args.llvmmc_args),
-    chunk_size = 1 if args.debug else 1000,
+    chunk_size = 1000,
+    jobs = max(1, args.jobs),
+    debug = args.debug,
   )
+  if not args.no_cache:
+    try:
+      arguments.cache = IsnCache(args.cache, arguments.llvmmc_args, args.cache_size)
+    except (OSError, sqlite3.Error) as e:
+      warnings.warn(f"opcode cache disabled, could not open {str(args.cache)!r}: {e}")
 
-  # make a .gtirb file with appropriate magic number
-  bio = io.BytesIO()
-  bio.write(b'GTIRB\0\0' + bytes([PROTO_VERSION]))
-  with open(args.gts_input, 'rb') as f:
-    bio.write(f.read())
-  bio.seek(0)
-
-  ir = gtirb.IR.load_protobuf_file(bio)
-  del bio
+  ir = gts_reader.load(args.gts_input)
 
-  out = []
-  # traverse protobuf twice. first, to find all isn bytes, then to apply them.
-  isns = collections.defaultdict(str)
-  for mod in ir.modules:
-    do_module(mod, isns)
+  # the words are views of the file, so are kept for indexing each module.
+  with gts_profile.phase('block opcodes'):
+    opcodes = [block_opcodes(mod) for mod in ir.modules]
+  with gts_profile.phase('unique opcodes'):
+    ops, counts = gts_opcodes.unique_counts(a for words in opcodes for a in words.values())
+    isns = gts_opcodes.to_bytes(ops)
 
   print('decoding', len(isns), 'opcodes...', file=sys.stderr, end=' ', flush=True)
-  isn_names = decode_isns(tuple(isns.keys()))
+  with gts_profile.phase('decode_isns', opcodes=len(isns)):
+    isn_names = decode_isns(isns)
   print('done', file=sys.stderr)
-  assert isn_names.keys() == isns.keys(), f"llvm-mc instruction count mismatch {len(isn_names)=} {len(isns)=}"
-
-  for mod in ir.modules:
-    out.append(do_module(mod, isn_names))
-
-  json.dump(out, args.json_output, indent=2)
-  args.json_output.write('\n')
+  assert isn_names.keys() == set(isns), f"llvm-mc instruction count mismatch {len(isn_names)=} {len(isns)=}"
+  # opcode -> assembly, as looked up by do_block.
+  names = dict(zip(ops.tolist(), (isn_names[x] for x in isns)))
+
+  if args.histogram:
+    write_histogram(args.histogram, ops, counts, names)
+
+  # each module is indexed (decoding its semantics) only as it is written,
+  # so only one module's semantics are held at a time.
+  indexes = (index_module(ir, mod, words) for mod, words in zip(ir.modules, opcodes))
+  if args.format == 'jsonl':
+    write_jsonl(args.json_output, indexes, names)
+  else:
+    write_json(args.json_output, indexes, names)
 
   return 0
 
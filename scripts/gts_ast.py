@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# vim: ts=2 sts=2 et sw=2
+
+# /// script
+# requires-python = ">=3.11"
+# dependencies = [
+#   "protobuf",
+# ]
+# ///
+
+"""
+gts_ast.py compact INPUT.gts OUTPUT.gts
+gts_ast.py expand INPUT.gts OUTPUT.gts
+
+Reading, writing and converting the semantics auxdata of .gts files.
+
+By default, gtirb_semantics stores semantics under the `ast` key as a JSON
+object mapping each block's base64 uuid to a list of statement lists, one per
+instruction. With --compact, it instead writes the `astCompact` key, where
+each distinct statement and each distinct instruction is stored once:
+
+  {
+    "version": 1,
+    "statements": [stmt_0, stmt_1, ...],
+    "instructions": [[0, 1], [2], {"decode_error": {...}}, ...],
+    "blocks": {uuid: [instruction index, ...], ...}
+  }
+
+Instructions are lists of indices into `statements`, or decode_error objects
+as in the `ast` format.
+
+example:
+
+  sems = gts_ast.semantics(mod)  # either format, keyed by base64 uuid
+  sems['ByM62E8HQg2Gm/cINLiC+g==']
+"""
+
+import sys
+import json
+import argparse
+import collections.abc
+
+import gts_reader
+import gts_profile
+
+AST_KEY = 'ast'
+COMPACT_KEY = 'astCompact'
+COMPACT_VERSION = 1
+
+def compact(sems: collections.abc.Mapping[str, list]) -> dict:
+  """converts `ast` semantics to the compact format."""
+  stmts: dict[str, int] = {}
+  isns: dict[str, int] = {}
+  isn_list = []
+
+  def isn(x) -> int:
+    if isinstance(x, list):
+      x = [stmts.setdefault(s, len(stmts)) for s in x]
+    key = json.dumps(x, separators=(',', ':'))
+    i = isns.get(key)
+    if i is None:
+      i = isns[key] = len(isn_list)
+      isn_list.append(x)
+    return i
+
+  blocks = {uuid: [isn(x) for x in block] for uuid, block in sems.items()}
+  return {
+    'version': COMPACT_VERSION,
+    'statements': list(stmts),
+    'instructions': isn_list,
+    'blocks': blocks,
+  }
+
+class CompactAst(collections.abc.Mapping):
+  """
+  a read-only view of compact semantics with the same shape as the `ast`
+  format. blocks are expanded on access, and instructions with the same
+  semantics share one list of statements.
+  """
+
+  def __init__(self, data: dict):
+    if data.get('version') != COMPACT_VERSION:
+      raise ValueError(f"unsupported {COMPACT_KEY} version: {data.get('version')!r}")
+    stmts = data['statements']
+    self.instructions = [
+      [stmts[i] for i in x] if isinstance(x, list) else x
+      for x in data['instructions']
+    ]
+    self.blocks: dict[str, list[int]] = data['blocks']
+
+  def __getitem__(self, uuid: str) -> list:
+    isns = self.instructions
+    return [isns[i] for i in self.blocks[uuid]]
+
+  def __iter__(self):
+    return iter(self.blocks)
+
+  def __len__(self) -> int:
+    return len(self.blocks)
+
+def expand(data: dict) -> dict[str, list]:
+  """converts compact semantics to the `ast` format."""
+  return dict(CompactAst(data))
+
+def dumps(x) -> bytes:
+  """serialises as gtirb_semantics does, without whitespace."""
+  return json.dumps(x, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+def semantics(mod: gts_reader.Module) -> collections.abc.Mapping[str, list]:
+  """
+  returns the semantics of a module, keyed by base64 block uuid, from either
+  the `ast` or `astCompact` auxdata. the module must have been loaded with
+  the chosen table in its aux_keys.
+  """
+  for key in (AST_KEY, COMPACT_KEY):
+    if key in mod.aux_data:
+      with gts_profile.phase(f'{key} json.loads', module=mod.name):
+        return load_semantics(key, mod.aux_data[key].data)
+  raise KeyError(f'module {mod.name!r} has no {AST_KEY} or {COMPACT_KEY} auxdata')
+
+def load_semantics(key: str, data: bytes | memoryview) -> collections.abc.Mapping[str, list]:
+  """decodes the data of the `ast` or `astCompact` auxdata table named by key."""
+  if key == AST_KEY:
+    return json.loads(str(data, 'utf-8'))
+  if key == COMPACT_KEY:
+    return CompactAst(json.loads(str(data, 'utf-8')))
+  raise ValueError(f'not a semantics auxdata key: {key!r}')
+
+
+# rewriting of auxdata tables in the serialised IR. this works on the wire
+# format so that every other field of the file is copied through untouched.
+
+def rewrite_aux_data(buf, update: collections.abc.Callable[[dict[str, gts_reader.AuxData]], dict[str, gts_reader.AuxData]]) -> bytes:
+  """
+  serialises buf (a .gtirb or .gts file) with each module's auxdata tables
+  replaced by update(tables). tables not returned by update are removed.
+  """
+  modules = gts_reader.field_number('gtirb.proto.IR', 'modules')
+  aux_data = gts_reader.field_number('gtirb.proto.Module', 'aux_data')
+  type_name = gts_reader.field_number('gtirb.proto.AuxData', 'type_name')
+  data = gts_reader.field_number('gtirb.proto.AuxData', 'data')
+  field = gts_reader.encode_field
+
+  buf = memoryview(buf)
+  start = gts_reader.magic_size(buf)
+  out = [buf[:start]]
+  prev = start
+  for f, _, s, e in gts_reader.iter_fields(buf, start, len(buf)):
+    if f != modules:
+      out.append(buf[prev:e])
+      prev = e
+      continue
+    prev = e
+
+    mod = []
+    tables = {}
+    mprev = s
+    for f, _, ms, me in gts_reader.iter_fields(buf, s, e):
+      if f == aux_data:
+        key, aux = gts_reader.aux_entry(buf, ms, me)
+        tables[key] = aux
+      else:
+        mod.append(buf[mprev:me])
+      mprev = me
+
+    for key, aux in update(tables).items():
+      value = field(type_name, aux.type_name.encode('utf-8')) + field(data, aux.data)
+      mod.append(field(aux_data, field(1, key.encode('utf-8')) + field(2, value)))
+    out.append(field(modules, b''.join(mod)))
+  return b''.join(out)
+
+def to_compact(tables: dict[str, gts_reader.AuxData]) -> dict[str, gts_reader.AuxData]:
+  if AST_KEY in tables:
+    sems = load_semantics(AST_KEY, tables.pop(AST_KEY).data)
+    tables[COMPACT_KEY] = gts_reader.AuxData(COMPACT_KEY, dumps(compact(sems)))
+  return tables
+
+def to_ast(tables: dict[str, gts_reader.AuxData]) -> dict[str, gts_reader.AuxData]:
+  if COMPACT_KEY in tables:
+    sems = expand(json.loads(str(tables.pop(COMPACT_KEY).data, 'utf-8')))
+    tables[AST_KEY] = gts_reader.AuxData(AST_KEY, dumps(sems))
+  return tables
+
+def main():
+  argp = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  argp.add_argument('cmd', choices=['compact', 'expand'],
+                    help=f'convert `{AST_KEY}` to `{COMPACT_KEY}`, or back')
+  argp.add_argument('gts_input', help='.gts input file')
+  argp.add_argument('gts_output', help='.gts output file')
+  args = argp.parse_args()
+
+  buf = gts_reader.map_file(args.gts_input)
+  out = rewrite_aux_data(buf, to_compact if args.cmd == 'compact' else to_ast)
+  with open(args.gts_output, 'wb') as f:
+    f.write(out)
+  print(f'{args.gts_input}: {len(buf)} -> {len(out)} bytes', file=sys.stderr)
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+# vim: ts=2 sts=2 et sw=2
+
+# /// script
+# requires-python = ">=3.11"
+# dependencies = [
+#   "protobuf",
+# ]
+# ///
+
+"""
+gts_batch.py --outdir DIR SOURCE...
+
+Lifts a corpus of .gtirb files to .gts against one warm gtirb_semantics
+server, with at most --jobs files being lifted at once. Files are sent to a
+JSON server (see gts_client.py) which forwards their lifts to a `--serve`
+server. When no JSON server is running, this starts `--serve-json --client`
+and, unless one is running on --serve-socket, `--serve`, and stops them
+when done. A JSON server which is already running should also have been
+started with --client, as otherwise it lifts one file at a time.
+
+Sources are .gtirb files, directories (searched recursively), globs, or @list
+files with one path per line. Outputs mirror the input layout below --outdir.
+
+Each input is keyed by the hash of its contents and of the lifter binary, and
+the keys of finished outputs are kept in DIR/.gts-batch.json. Inputs whose key
+matches an existing output are skipped, and inputs whose contents match an
+output lifted elsewhere in the corpus are copied from it, so a re-run after a
+small change only lifts the files which changed. The binary of a server which
+is already running is not known, so --lifter-version must be given to use one.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import hashlib
+import logging
+import pathlib
+import argparse
+import tempfile
+import subprocess
+import dataclasses
+
+import gts_client
+import gts_sources
+
+MANIFEST = '.gts-batch.json'
+MANIFEST_VERSION = 1
+SERVE_SOCKET_ENV = 'GTIRB_SEM_SOCKET'
+
+@dataclasses.dataclass
+class Job:
+  input: pathlib.Path
+  output: pathlib.Path
+  rel: str  # output path relative to --outdir, the manifest key
+  key: str = ''
+
+def lifter_version(exe: str, extra: str = '') -> str:
+  """
+  identifies the lifter by its binary's path, size and mtime, along with any
+  options which change its output.
+  """
+  path = shutil.which(exe)
+  if not path:
+    raise FileNotFoundError(f'could not find {exe!r} in PATH')
+  st = os.stat(path)
+  return f'{os.path.realpath(path)}\0{st.st_size}\0{st.st_mtime_ns}\0{extra}'
+
+def input_key(path: pathlib.Path, version: str) -> str:
+  with open(path, 'rb') as f:
+    h = hashlib.file_digest(f, 'sha256')
+  h.update(b'\0' + version.encode('utf-8'))
+  return h.hexdigest()
+
+def load_manifest(outdir: pathlib.Path) -> dict[str, dict]:
+  try:
+    with open(outdir / MANIFEST) as f:
+      data = json.load(f)
+  except (OSError, ValueError):
+    return {}
+  return data['outputs'] if data.get('version') == MANIFEST_VERSION else {}
+
+def save_manifest(outdir: pathlib.Path, outputs: dict[str, dict]):
+  tmp = outdir / (MANIFEST + '.tmp')
+  with open(tmp, 'w') as f:
+    json.dump({'version': MANIFEST_VERSION, 'outputs': outputs}, f, indent=2, sort_keys=True)
+  os.replace(tmp, outdir / MANIFEST)
+
+def copy_output(src: pathlib.Path, j: Job):
+  """reuses the output of an identical input."""
+  j.output.parent.mkdir(parents=True, exist_ok=True)
+  shutil.copyfile(src, j.output)
+  print(f'{j.input}: copied from {src}', file=sys.stderr)
+
+async def reachable(path: str) -> bool:
+  try:
+    _, w = await asyncio.open_unix_connection(path)
+  except OSError:
+    return False
+  w.close()
+  return True
+
+async def start_server(exe: str, args: list[str], env: dict, socket: str, timeout: float) -> subprocess.Popen:
+  """starts `exe args...` and waits until it accepts connections on socket."""
+  cmd = ' '.join([exe, *args])
+  proc = subprocess.Popen([exe, *args], env=env, stdout=subprocess.DEVNULL)
+  deadline = time.monotonic() + timeout
+  while not await reachable(socket):
+    if proc.poll() is not None:
+      raise RuntimeError(f'{cmd} exited with status {proc.returncode}')
+    if time.monotonic() > deadline:
+      stop_server(proc)
+      raise TimeoutError(f'{cmd} did not start within {timeout}s')
+    await asyncio.sleep(0.1)
+  return proc
+
+async def start_servers(args, serve_socket: str) -> list[subprocess.Popen]:
+  """
+  starts `--serve-json --client` on args.socket, in front of a `--serve`
+  server on serve_socket, which is started too unless it is running.
+  """
+  env = dict(os.environ, **{gts_client.SOCKET_ENV: args.socket, SERVE_SOCKET_ENV: serve_socket})
+  procs = []
+  try:
+    if not await reachable(serve_socket):
+      print(f'starting {args.gtirb_semantics} --serve on {serve_socket}', file=sys.stderr)
+      procs.append(await start_server(args.gtirb_semantics, ['--serve'], env,
+                                      serve_socket, args.server_timeout))
+    print(f'starting {args.gtirb_semantics} --serve-json --client on {args.socket}', file=sys.stderr)
+    procs.append(await start_server(args.gtirb_semantics, ['--serve-json', '--client'], env,
+                                    args.socket, args.server_timeout))
+  except BaseException:
+    stop_servers(procs)
+    raise
+  return procs
+
+def stop_server(proc: subprocess.Popen):
+  proc.terminate()
+  try:
+    proc.wait(timeout=10)
+  except subprocess.TimeoutExpired:
+    proc.kill()
+    proc.wait()
+
+def stop_servers(procs: list[subprocess.Popen]):
+  """stops the front end before the server it forwards to."""
+  for proc in reversed(procs):
+    stop_server(proc)
+
+async def run(args) -> int:
+  outdir = pathlib.Path(args.outdir)
+  outdir.mkdir(parents=True, exist_ok=True)
+
+  if args.jobs < 1:
+    print('error: --jobs must be at least 1', file=sys.stderr)
+    return 2
+
+  running = await reachable(args.socket)
+  serve_running = bool(args.serve_socket) and await reachable(args.serve_socket)
+  if args.lifter_version:
+    version = args.lifter_version
+  elif running or serve_running:
+    print(f'error: a server is already running on {args.socket if running else args.serve_socket}; '
+          f'give --lifter-version to identify its lifter', file=sys.stderr)
+    return 2
+  else:
+    try:
+      version = lifter_version(args.gtirb_semantics)
+    except FileNotFoundError as e:
+      print(f'error: {e}', file=sys.stderr)
+      return 2
+
+  jobs = [Job(src, outdir / rel.with_suffix(args.suffix), str(rel.with_suffix(args.suffix)))
+          for src, rel in gts_sources.batch_sources(args.sources, args.pattern)]
+  if not jobs:
+    print('no inputs found', file=sys.stderr)
+    return 1
+
+  keys = await asyncio.gather(*(asyncio.to_thread(input_key, j.input, version) for j in jobs))
+  for j, k in zip(jobs, keys):
+    j.key = k
+
+  manifest = {} if args.force else load_manifest(outdir)
+  done = {}  # key -> existing output with that key
+  for rel, entry in manifest.items():
+    if (outdir / rel).exists():
+      done.setdefault(entry['key'], outdir / rel)
+
+  todo: list[Job] = []
+  copies: list[tuple[Job, Job]] = []
+  lifting = {}
+  skipped = copied = 0
+  for j in jobs:
+    if manifest.get(j.rel, {}).get('key') == j.key and j.output.exists():
+      skipped += 1
+    elif j.key in done:
+      copy_output(done[j.key], j)
+      manifest[j.rel] = {'key': j.key, 'input': str(j.input)}
+      copied += 1
+    elif j.key in lifting:
+      copies.append((j, lifting[j.key]))
+    else:
+      lifting[j.key] = j
+      todo.append(j)
+  save_manifest(outdir, manifest)
+
+  failed = 0
+  start = time.perf_counter()
+  if todo:
+    # without --serve-socket, a --serve server is started on a socket of its own.
+    serve_socket = args.serve_socket or os.path.join(
+      tempfile.gettempdir(), f'gtirb_semantics_batch_{os.getpid()}.sock')
+    procs = [] if running else await start_servers(args, serve_socket)
+    try:
+      sem = asyncio.Semaphore(args.jobs)
+      async with gts_client.Client(args.socket, connections=min(args.jobs, len(todo))) as client:
+        async def lift(j: Job):
+          nonlocal failed
+          j.output.parent.mkdir(parents=True, exist_ok=True)
+          tmp = j.output.with_name(j.output.name + '.tmp')
+          async with sem:
+            t = time.perf_counter()
+            try:
+              await client.lift_file(j.input, tmp)
+              os.replace(tmp, j.output)
+            except Exception as e:
+              tmp.unlink(missing_ok=True)
+              failed += 1
+              manifest.pop(j.rel, None)
+              print(f'{j.input}: failed: {e}', file=sys.stderr)
+              return
+            dt = time.perf_counter() - t
+          size = j.input.stat().st_size
+          manifest[j.rel] = {'key': j.key, 'input': str(j.input), 'seconds': round(dt, 3)}
+          save_manifest(outdir, manifest)
+          print(f'{j.input}: {size / 1e6:.2f} MB in {dt:.2f}s ({size / 1e6 / max(dt, 1e-9):.2f} MB/s)',
+                file=sys.stderr)
+
+        await asyncio.gather(*(lift(j) for j in todo))
+    finally:
+      stop_servers(procs)
+      if procs and not args.serve_socket:
+        pathlib.Path(serve_socket).unlink(missing_ok=True)
+
+  for j, src in copies:
+    if src.rel in manifest and src.output.exists():
+      copy_output(src.output, j)
+      manifest[j.rel] = {'key': j.key, 'input': str(j.input)}
+      copied += 1
+    else:
+      failed += 1
+  save_manifest(outdir, manifest)
+
+  lifted = len(todo) + len(copies) - copied - failed
+  print(f'lifted {lifted}, copied {copied} duplicates, skipped {skipped} unchanged, '
+        f'failed {failed} of {len(jobs)} files '
+        f'in {time.perf_counter() - start:.2f}s', file=sys.stderr)
+  return 1 if failed else 0
+
+def main():
+  argp = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  argp.add_argument('sources', nargs='+', metavar='SOURCE', help='.gtirb file, directory, glob, or @list file')
+  argp.add_argument('--outdir', required=True, help='output directory (mirrors the input layout)')
+  argp.add_argument('--pattern', default='*.gtirb', help='file pattern matched in directory sources')
+  argp.add_argument('--suffix', default='.gts', help='output file suffix')
+  argp.add_argument('-j', '--jobs', type=int, default=4, help='maximum number of files being lifted at once')
+  argp.add_argument('--force', action='store_true', help='lift all inputs, ignoring previous results')
+  argp.add_argument('--socket', default=gts_client.default_socket(), help=f'server socket (${gts_client.SOCKET_ENV})')
+  argp.add_argument('--serve-socket', default=os.environ.get(SERVE_SOCKET_ENV),
+                    help=f'socket of the --serve server to forward to (${SERVE_SOCKET_ENV}; default: start one on a temporary socket)')
+  argp.add_argument('--gtirb-semantics', default='gtirb_semantics', help='gtirb_semantics executable, used to start the servers')
+  argp.add_argument('--server-timeout', type=float, default=120, help='seconds to wait for a started server')
+  argp.add_argument('--lifter-version', help='lifter version string used in input keys (default: identify the gtirb_semantics binary; required to use a running server)')
+  args = argp.parse_args()
+  logging.basicConfig(level=logging.WARN)
+  return asyncio.run(run(args))
+
+if __name__ == '__main__':
+  sys.exit(main())
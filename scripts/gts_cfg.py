@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# vim: ts=2 sts=2 et sw=2
+
+# /// script
+# requires-python = ">=3.11"
+# dependencies = [
+#   "numpy",
+#   "protobuf",
+# ]
+# ///
+
+"""
+gts_cfg.py reach FILE START... [--backward] [--intraprocedural] [--export OUT.json]
+gts_cfg.py callgraph FILE [FUNCTION...]
+
+The control flow graph of a .gtirb or .gts file as compressed sparse row
+(CSR) arrays over integer block ids, for reachability queries which do not
+walk Python objects.
+
+START may be a function name, a block address, or a base64 block uuid.
+`reach` lists the code blocks reachable from (or, with --backward, which
+reach) the start blocks. A function name starts from all of its entries.
+--export writes the semantics of just those blocks, in the format of the
+`ast` auxdata: {module name: {uuid: [[statement, ...], ...]}}.
+
+`callgraph` collapses the CFG to functions using functionEntries and
+functionBlocks, and prints each function with its callees, or the
+functions reachable through calls from the given functions.
+
+example:
+
+  cfg = gts_cfg.CFG.from_ir(ir)
+  ids = cfg.reachable([cfg.ids[uuid]], gts_cfg.INTRAPROCEDURAL)
+  [cfg.uuids[i] for i in ids]
+"""
+
+import sys
+import json
+import base64
+import argparse
+import collections.abc
+
+import numpy as np
+
+import gts_ast
+import gts_reader
+from gts_reader import EdgeType
+
+# edge types followed within a function, and when following calls.
+# return edges are never followed forwards, as they lead back to every caller.
+INTRAPROCEDURAL = frozenset({EdgeType.Branch, EdgeType.Fallthrough})
+INTERPROCEDURAL = INTRAPROCEDURAL | {EdgeType.Call, EdgeType.Syscall}
+
+AUX_KEYS = ('functionNames', 'functionEntries', 'functionBlocks', gts_ast.AST_KEY, gts_ast.COMPACT_KEY)
+
+def csr(src: np.ndarray, dst: np.ndarray, n: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+  """
+  returns (indptr, indices, edges) such that the neighbours of node i are
+  indices[indptr[i]:indptr[i+1]], reached through the edges numbered
+  edges[indptr[i]:indptr[i+1]].
+  """
+  edges = np.argsort(src, kind='stable')
+  indptr = np.zeros(n + 1, dtype=np.int64)
+  np.cumsum(np.bincount(src, minlength=n), out=indptr[1:])
+  return indptr, dst[edges], edges
+
+def gather(indptr: np.ndarray, nodes: np.ndarray) -> np.ndarray:
+  """the positions in a CSR indices array of every neighbour of the given nodes."""
+  starts = indptr[nodes]
+  lens = indptr[nodes + 1] - starts
+  total = int(lens.sum())
+  if not total:
+    return np.empty(0, dtype=np.int64)
+  # for each position, the start of its node's range minus the number of
+  # positions before that range.
+  return np.repeat(starts - (np.cumsum(lens) - lens), lens) + np.arange(total)
+
+def bfs(indptr: np.ndarray, indices: np.ndarray, n: int, starts: np.ndarray,
+        allowed: np.ndarray | None = None) -> np.ndarray:
+  """
+  the sorted ids of the nodes reachable from starts, following the edges at
+  CSR positions where allowed is true (or all edges if allowed is None).
+  the search expands a whole frontier per step.
+  """
+  seen = np.zeros(n, dtype=bool)
+  frontier = np.unique(np.asarray(starts, dtype=np.int64))
+  seen[frontier] = True
+  while frontier.size:
+    pos = gather(indptr, frontier)
+    if allowed is not None:
+      pos = pos[allowed[pos]]
+    nxt = indices[pos]
+    nxt = np.unique(nxt[~seen[nxt]])
+    seen[nxt] = True
+    frontier = nxt
+  return np.flatnonzero(seen)
+
+class CFG:
+  """
+  the CFG over block ids 0..n-1 (cfg.uuids[i] is the uuid of block i).
+  edge i goes from src[i] to dst[i] and has the label type[i],
+  conditional[i] and direct[i].
+  """
+
+  def __init__(self, uuids: list[bytes], src: np.ndarray, dst: np.ndarray,
+               type: np.ndarray, conditional: np.ndarray, direct: np.ndarray):
+    self.uuids = uuids
+    self.ids = {u: i for i, u in enumerate(uuids)}
+    self.src = src
+    self.dst = dst
+    self.type = type
+    self.conditional = conditional
+    self.direct = direct
+    n = len(uuids)
+    self.indptr, self.indices, self.edges = csr(src, dst, n)
+    self.rindptr, self.rindices, self.redges = csr(dst, src, n)
+
+  @classmethod
+  def from_ir(cls, ir: gts_reader.IR) -> 'CFG':
+    ids = {u: i for i, u in enumerate(ir.vertices)}
+    def node(u: bytes) -> int:
+      return ids.setdefault(u, len(ids))
+    n = len(ir.edges)
+    src = np.fromiter((node(e.source) for e in ir.edges), dtype=np.int64, count=n)
+    dst = np.fromiter((node(e.target) for e in ir.edges), dtype=np.int64, count=n)
+    return cls(
+      list(ids),
+      src, dst,
+      np.fromiter((e.type for e in ir.edges), dtype=np.uint8, count=n),
+      np.fromiter((e.conditional for e in ir.edges), dtype=bool, count=n),
+      np.fromiter((e.direct for e in ir.edges), dtype=bool, count=n),
+    )
+
+  def __len__(self) -> int:
+    return len(self.uuids)
+
+  def successors(self, node: int) -> np.ndarray:
+    return self.indices[self.indptr[node]:self.indptr[node + 1]]
+
+  def predecessors(self, node: int) -> np.ndarray:
+    return self.rindices[self.rindptr[node]:self.rindptr[node + 1]]
+
+  def type_mask(self, types: collections.abc.Collection[EdgeType], backward: bool = False) -> np.ndarray:
+    """for each CSR position, whether its edge has one of the given types."""
+    edges = self.redges if backward else self.edges
+    return np.isin(self.type, np.fromiter(types, dtype=np.uint8))[edges]
+
+  def reachable(self, starts: collections.abc.Iterable[int],
+                types: collections.abc.Collection[EdgeType] | None = None,
+                backward: bool = False) -> np.ndarray:
+    """
+    the sorted ids of the blocks reachable from starts (including them)
+    along edges of the given types, or from which starts are reachable if
+    backward is true.
+    """
+    allowed = None if types is None else self.type_mask(types, backward)
+    indptr, indices = (self.rindptr, self.rindices) if backward else (self.indptr, self.indices)
+    return bfs(indptr, indices, len(self), np.fromiter(starts, dtype=np.int64), allowed)
+
+class CallGraph:
+  """
+  the CFG collapsed to functions. function f is functions[f], a
+  (module index, function uuid) pair; block_function[b] is the function
+  containing block b, or -1.
+  """
+
+  def __init__(self, ir: gts_reader.IR, cfg: CFG):
+    self.cfg = cfg
+    self.functions: list[tuple[int, bytes]] = []
+    self.names: list[str] = []
+    self.entries: list[np.ndarray] = []
+    self.block_function = np.full(len(cfg), -1, dtype=np.int64)
+    for m, mod in enumerate(ir.modules):
+      if 'functionBlocks' not in mod.aux_data:
+        continue
+      names = mod.function_names if 'functionNames' in mod.aux_data else {}
+      entries = mod.function_entries if 'functionEntries' in mod.aux_data else {}
+      for func, blocks in mod.function_blocks.items():
+        f = len(self.functions)
+        self.functions.append((m, func))
+        self.names.append(mod.symbol_names.get(names.get(func, b''), base64.b64encode(func).decode('ascii')))
+        self.entries.append(np.fromiter((cfg.ids[b] for b in entries.get(func, ()) if b in cfg.ids), dtype=np.int64))
+        ids = [cfg.ids[b] for b in blocks if b in cfg.ids]
+        self.block_function[ids] = f
+
+    # a call is an edge between blocks of different functions, other than a return.
+    calls = np.isin(cfg.type, np.array([EdgeType.Return, EdgeType.Sysret], dtype=np.uint8), invert=True)
+    caller = self.block_function[cfg.src]
+    callee = self.block_function[cfg.dst]
+    calls &= (caller >= 0) & (callee >= 0) & (caller != callee)
+    n = len(self.functions)
+    pairs = np.unique(caller[calls] * max(n, 1) + callee[calls])
+    self.src = pairs // max(n, 1)
+    self.dst = pairs % max(n, 1)
+    self.indptr, self.indices, _ = csr(self.src, self.dst, n)
+    self.rindptr, self.rindices, _ = csr(self.dst, self.src, n)
+    self.by_name = {name: f for f, name in reversed(list(enumerate(self.names)))}
+
+  def __len__(self) -> int:
+    return len(self.functions)
+
+  def callees(self, f: int) -> np.ndarray:
+    return self.indices[self.indptr[f]:self.indptr[f + 1]]
+
+  def callers(self, f: int) -> np.ndarray:
+    return self.rindices[self.rindptr[f]:self.rindptr[f + 1]]
+
+  def reachable(self, funcs: collections.abc.Iterable[int], backward: bool = False) -> np.ndarray:
+    """the sorted functions reachable through calls from funcs, or which reach them."""
+    indptr, indices = (self.rindptr, self.rindices) if backward else (self.indptr, self.indices)
+    return bfs(indptr, indices, len(self), np.fromiter(funcs, dtype=np.int64))
+
+  def blocks(self, funcs: collections.abc.Iterable[int]) -> np.ndarray:
+    """the sorted ids of the blocks of the given functions."""
+    return np.flatnonzero(np.isin(self.block_function, np.fromiter(funcs, dtype=np.int64)))
+
+def block_addresses(ir: gts_reader.IR) -> dict[bytes, int | None]:
+  return {blk.uuid: blk.address for mod in ir.modules for blk in mod.code_blocks}
+
+def resolve(ir: gts_reader.IR, cfg: CFG, calls: CallGraph, start: str) -> list[int]:
+  """the block ids named by a function name, block address or base64 block uuid."""
+  if start in calls.by_name:
+    f = calls.by_name[start]
+    return calls.entries[f].tolist() or calls.blocks([f]).tolist()
+  try:
+    address = int(start, 0)
+  except ValueError:
+    pass
+  else:
+    found = [cfg.ids[u] for u, a in block_addresses(ir).items() if a == address and u in cfg.ids]
+    if found:
+      return found
+  try:
+    uuid = base64.b64decode(start, validate=True)
+  except ValueError:
+    uuid = None
+  if uuid in cfg.ids:
+    return [cfg.ids[uuid]]
+  raise KeyError(f'no function, block address or block uuid {start!r}')
+
+def slice_semantics(ir: gts_reader.IR, uuids: collections.abc.Collection[bytes]) -> dict[str, dict[str, list]]:
+  """the semantics of the given blocks, by module name and base64 uuid."""
+  out = {}
+  for mod in ir.modules:
+    try:
+      sems = gts_ast.semantics(mod)
+    except KeyError:
+      continue
+    out[mod.name] = {
+      b64: sems[b64]
+      for blk in mod.code_blocks
+      if blk.uuid in uuids and (b64 := base64.b64encode(blk.uuid).decode('ascii')) in sems
+    }
+  return out
+
+def do_reach(ir: gts_reader.IR, args) -> int:
+  cfg = CFG.from_ir(ir)
+  calls = CallGraph(ir, cfg)
+  try:
+    starts = [i for s in args.starts for i in resolve(ir, cfg, calls, s)]
+  except KeyError as e:
+    print(e.args[0], file=sys.stderr)
+    return 1
+  types = INTRAPROCEDURAL if args.intraprocedural else INTERPROCEDURAL
+  ids = cfg.reachable(starts, types, args.backward)
+
+  addresses = block_addresses(ir)
+  uuids = [cfg.uuids[i] for i in ids.tolist() if cfg.uuids[i] in addresses]
+  uuids.sort(key=lambda u: (addresses[u] is None, addresses[u] or 0))
+  if args.export:
+    with open(args.export, 'w') as f:
+      json.dump(slice_semantics(ir, set(uuids)), f)
+  else:
+    for u in uuids:
+      f = calls.block_function[cfg.ids[u]]
+      addr = addresses[u]
+      print(f"{'?' if addr is None else f'0x{addr:08x}'}\t{base64.b64encode(u).decode('ascii')}\t"
+            f"{calls.names[f] if f >= 0 else ''}")
+  print(f'{len(uuids)} code blocks reachable', file=sys.stderr)
+  return 0
+
+def do_callgraph(ir: gts_reader.IR, args) -> int:
+  calls = CallGraph(ir, CFG.from_ir(ir))
+  if args.functions:
+    missing = [f for f in args.functions if f not in calls.by_name]
+    if missing:
+      print(f'unknown functions: {missing}', file=sys.stderr)
+      return 1
+    funcs = calls.reachable((calls.by_name[f] for f in args.functions), args.backward)
+    for f in funcs.tolist():
+      print(calls.names[f])
+  else:
+    for f in range(len(calls)):
+      print(calls.names[f] + ': ' + ', '.join(calls.names[g] for g in calls.callees(f).tolist()))
+  return 0
+
+def main():
+  argp = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  sub = argp.add_subparsers(dest='cmd', required=True)
+
+  reach = sub.add_parser('reach', help='list (or export the semantics of) reachable blocks',
+                         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  reach.add_argument('input', help='.gtirb or .gts file')
+  reach.add_argument('starts', nargs='+', metavar='START', help='function name, block address, or base64 block uuid')
+  reach.add_argument('--backward', action='store_true', help='find the blocks which reach the start blocks')
+  reach.add_argument('--intraprocedural', action='store_true', help='follow only branch and fallthrough edges')
+  reach.add_argument('--export', metavar='JSON', help='write the semantics of the reachable blocks')
+
+  cg = sub.add_parser('callgraph', help='print the call graph, or the functions reachable through calls',
+                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  cg.add_argument('input', help='.gtirb or .gts file')
+  cg.add_argument('functions', nargs='*', metavar='FUNCTION')
+  cg.add_argument('--backward', action='store_true', help='find the functions which call into the given functions')
+
+  args = argp.parse_args()
+  ir = gts_reader.load(args.input, AUX_KEYS)
+  return do_reach(ir, args) if args.cmd == 'reach' else do_callgraph(ir, args)
+
+if __name__ == '__main__':
+  sys.exit(main())
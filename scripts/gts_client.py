@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# vim: ts=2 sts=2 et sw=2
+
+# /// script
+# requires-python = ">=3.11"
+# dependencies = [
+#   "protobuf",
+# ]
+# ///
+
+"""
+gts_client.py lift OPCODE@ADDRESS...
+gts_client.py file INPUT.gtirb OUTPUT.gts...
+
+An asyncio client for a warm `gtirb_semantics --serve-json` server.
+
+The client keeps a pool of connections open to the server's domain socket
+(GTIRB_SEM_JSON_SOCKET) and pipelines requests over them, so many opcode
+batches or whole files can be lifted without starting a gtirb_semantics
+process for each. The server lifts them concurrently when it forwards to a
+`--serve` server (`gtirb_semantics --serve-json --client`); on its own it
+lifts one request at a time.
+
+example:
+
+  async with Client() as c:
+    sems = await c.lift([(0xd503201f, 0x400000)])
+    asts = await c.lift_gtirb('a.gtirb')  # {b64 uuid: semantics} per module
+    await c.lift_file('b.gtirb', 'b.gts')  # written by the server
+"""
+
+import os
+import sys
+import json
+import base64
+import asyncio
+import tempfile
+import argparse
+import itertools
+import collections.abc
+
+import gts_reader
+
+SOCKET_ENV = 'GTIRB_SEM_JSON_SOCKET'
+SOCKET_NAME = 'gtirb_semantics_json.sock'
+ISN_SIZE = 4
+
+# responses can contain the semantics of a large batch on one line.
+LINE_LIMIT = 1 << 30
+
+def default_socket() -> str:
+  """the socket path used by `gtirb_semantics --serve-json`."""
+  return os.environ.get(SOCKET_ENV) or os.path.join(tempfile.gettempdir(), SOCKET_NAME)
+
+class ServerError(Exception):
+  """an error reported by the server for a single request."""
+
+class _Connection:
+  def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    self.reader = reader
+    self.writer = writer
+    self.pending: dict[int, asyncio.Future] = {}
+    self.task = asyncio.create_task(self._read())
+
+  async def _read(self):
+    try:
+      while line := await self.reader.readline():
+        resp = json.loads(line)
+        fut = self.pending.pop(resp.get('id'), None)
+        if fut is None or fut.done():
+          continue
+        if 'error' in resp:
+          fut.set_exception(ServerError(resp['error']))
+        else:
+          fut.set_result(resp['result'])
+      err = ConnectionError('server closed the connection')
+    except Exception as e:
+      err = e
+    for fut in self.pending.values():
+      if not fut.done():
+        fut.set_exception(err)
+    self.pending.clear()
+
+  async def request(self, id: int, method: str, params: dict) -> object:
+    if self.task.done():
+      raise ConnectionError('connection to server is closed')
+    fut = asyncio.get_running_loop().create_future()
+    self.pending[id] = fut
+    self.writer.write(json.dumps({'id': id, 'method': method, **params}).encode() + b'\n')
+    await self.writer.drain()
+    return await fut
+
+  async def close(self):
+    self.writer.close()
+    try:
+      await self.writer.wait_closed()
+    except OSError:
+      pass
+    await self.task
+
+class Client:
+  """
+  a pool of `connections` connections to the server. each request is sent on
+  the least busy connection, with at most `max_inflight` requests awaiting
+  responses across the pool.
+  """
+
+  def __init__(self, path: str | None = None, connections: int = 4, max_inflight: int = 64):
+    self.path = path or default_socket()
+    self.size = connections
+    self.conns: list[_Connection] = []
+    self.ids = itertools.count()
+    self.slots = asyncio.Semaphore(max_inflight)
+
+  async def connect(self):
+    for _ in range(self.size - len(self.conns)):
+      r, w = await asyncio.open_unix_connection(self.path, limit=LINE_LIMIT)
+      self.conns.append(_Connection(r, w))
+
+  async def close(self):
+    conns, self.conns = self.conns, []
+    await asyncio.gather(*(c.close() for c in conns))
+
+  async def __aenter__(self):
+    await self.connect()
+    return self
+
+  async def __aexit__(self, *_):
+    await self.close()
+
+  async def call(self, method: str, **params) -> object:
+    async with self.slots:
+      if not self.conns:
+        await self.connect()
+      conn = min(self.conns, key=lambda c: len(c.pending))
+      return await conn.request(next(self.ids), method, params)
+
+  async def lift(self, opcodes: collections.abc.Iterable[tuple[int, int]]) -> list:
+    """
+    lifts (instruction word, address) pairs, returning one list of statements
+    (or a {'decode_error': ...} object) per pair, as in the `ast` auxdata.
+    """
+    return await self.call('lift', opcodes=[[f'{op:08x}', addr] for op, addr in opcodes])
+
+  async def lift_many(self, batches: collections.abc.Iterable[list[tuple[int, int]]]) -> list[list]:
+    """lifts many batches concurrently, returning their results in order."""
+    return await asyncio.gather(*(self.lift(b) for b in batches))
+
+  async def lift_block(self, contents: bytes, address: int, byteorder: str = 'little') -> list:
+    return await self.lift(block_opcodes(contents, address, byteorder))
+
+  async def lift_module(self, mod, batch_size: int = 4096) -> dict[str, list]:
+    """
+    lifts every code block of a gts_reader.Module, returning the module's
+    `ast` table: semantics keyed by base64 block uuid. blocks are packed
+    into batches of about `batch_size` instructions.
+    """
+    byteorder = 'big' if mod.byte_order == 'BigEndian' else 'little'
+    blocks = [blk for blk in mod.code_blocks if blk.address is not None]
+
+    batches = [[]]
+    n = 0
+    for blk in blocks:
+      batches[-1].append(blk)
+      n += blk.size // ISN_SIZE
+      if n >= batch_size:
+        batches.append([])
+        n = 0
+
+    async def go(batch):
+      ops = [block_opcodes(blk.contents, blk.address, byteorder) for blk in batch]
+      sems = await self.lift(itertools.chain.from_iterable(ops))
+      out = {}
+      i = 0
+      for blk, o in zip(batch, ops):
+        out[base64.b64encode(blk.uuid).decode('ascii')] = sems[i:i+len(o)]
+        i += len(o)
+      return out
+
+    out = {}
+    for part in await asyncio.gather(*(go(b) for b in batches if b)):
+      out.update(part)
+    return out
+
+  async def lift_gtirb(self, path) -> list[dict[str, list]]:
+    """lifts a .gtirb file, returning the `ast` table of each module."""
+    ir = await asyncio.to_thread(gts_reader.load, path, ())
+    return await asyncio.gather(*(self.lift_module(m) for m in ir.modules))
+
+  async def lift_file(self, input, output) -> str:
+    """has the server lift a .gtirb file and write the .gts output itself."""
+    res = await self.call('lift_file', input=os.path.abspath(input), output=os.path.abspath(output))
+    return res['output']
+
+def block_opcodes(contents: bytes, address: int, byteorder: str = 'little') -> list[tuple[int, int]]:
+  n = len(contents) // ISN_SIZE
+  return [(int.from_bytes(contents[i*ISN_SIZE:(i+1)*ISN_SIZE], byteorder), address + i*ISN_SIZE)
+          for i in range(n)]
+
+def parse_opcode(s: str) -> tuple[int, int]:
+  op, _, addr = s.partition('@')
+  return int(op, 16), int(addr or '0', 0)
+
+async def amain(args) -> int:
+  async with Client(args.socket, args.connections) as c:
+    if args.cmd == 'lift':
+      json.dump(await c.lift(map(parse_opcode, args.opcodes)), sys.stdout, indent=2)
+      sys.stdout.write('\n')
+      return 0
+
+    if len(args.files) % 2:
+      print('expected INPUT OUTPUT pairs', file=sys.stderr)
+      return 1
+    pairs = list(zip(args.files[::2], args.files[1::2]))
+    results = await asyncio.gather(*(c.lift_file(i, o) for i, o in pairs), return_exceptions=True)
+    ret = 0
+    for (i, o), r in zip(pairs, results):
+      if isinstance(r, Exception):
+        print(f'{i}: {r}', file=sys.stderr)
+        ret = 1
+      else:
+        print(f'{i} -> {r}', file=sys.stderr)
+    return ret
+
+def main():
+  argp = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  argp.add_argument('--socket', default=default_socket(), help=f'server socket (${SOCKET_ENV})')
+  argp.add_argument('--connections', type=int, default=4, help='number of pooled connections')
+  sub = argp.add_subparsers(dest='cmd', required=True)
+
+  l = sub.add_parser('lift', help='lift opcodes and print their semantics as JSON')
+  l.add_argument('opcodes', nargs='+', help='hex instruction word, optionally @ADDRESS (e.g. d503201f@0x400000)')
+
+  f = sub.add_parser('file', help='lift .gtirb files to .gts on the server')
+  f.add_argument('files', nargs='+', metavar='INPUT OUTPUT', help='input and output file pairs')
+
+  args = argp.parse_args()
+  return asyncio.run(amain(args))
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+# vim: ts=2 sts=2 et sw=2
+
+# /// script
+# requires-python = ">=3.11"
+# dependencies = [
+#   "protobuf",
+# ]
+# ///
+
+"""
+gts_diff.py OLD NEW
+
+Compares the semantics of two .gts files, or of two directories of .gts
+files (matched by relative path), e.g. before and after an ASLp upgrade.
+
+Code blocks are matched by uuid, then by address for blocks whose uuid
+only appears on one side. A module whose code blocks and semantics table
+are byte-for-byte identical on both sides is skipped without decoding its
+semantics, so a corpus with few changes is compared in about the time it
+takes to read it. Files are loaded and compared in parallel, one pair per
+worker process, with a bounded number of pairs queued at a time.
+Within a module with `ast` semantics on both sides, only the blocks whose
+semantics differ as JSON text are decoded (`astCompact` tables, whose
+blocks share statements, are decoded whole).
+
+The report lists changed, added and removed blocks, and within changed
+blocks, each instruction whose opcode or semantics differ:
+
+  ~ 0x00400688 d65f03c0     semantics changed
+  ! 0x0040068c d503201f     newly a decode_error
+  * 0x00400690 d503201f     no longer a decode_error
+  + / -                     instruction added or removed
+
+The exit status is 0 if there are no differences, 1 if there are, and 2 if
+some file could not be read.
+"""
+
+import os
+import sys
+import json
+import base64
+import difflib
+import pathlib
+import argparse
+import dataclasses
+import concurrent.futures
+
+import gts_ast
+import gts_reader
+import ast_index
+
+ISN_SIZE = 4
+AUX_KEYS = (gts_ast.AST_KEY, gts_ast.COMPACT_KEY)
+
+@dataclasses.dataclass
+class ModuleSems:
+  """the parts of a module compared by the diff."""
+  name: str
+  byteorder: str
+  blocks: dict[str, tuple[int | None, bytes]]  # base64 uuid -> (address, contents)
+  key: str | None  # the semantics auxdata table, if any
+  data: bytes
+
+  def same(self, other: 'ModuleSems') -> bool:
+    return self.key == other.key and self.data == other.data and self.blocks == other.blocks
+
+def module_sems(mod: gts_reader.Module) -> ModuleSems:
+  key = next((k for k in AUX_KEYS if k in mod.aux_data), None)
+  return ModuleSems(
+    name=mod.name,
+    byteorder='big' if mod.byte_order == 'BigEndian' else 'little',
+    blocks={base64.b64encode(blk.uuid).decode('ascii'): (blk.address, bytes(blk.contents))
+            for blk in mod.code_blocks},
+    key=key,
+    data=bytes(mod.aux_data[key].data) if key else b'',
+  )
+
+def load(path) -> list[ModuleSems]:
+  return [module_sems(m) for m in gts_reader.load(path, AUX_KEYS).modules]
+
+class BlockSems:
+  """
+  the semantics of each block of a module, by base64 uuid. an `ast` table is
+  split into the JSON text of each block, which is decoded only on request.
+  """
+
+  def __init__(self, m: ModuleSems):
+    self.slices: dict[str, memoryview] | None = None
+    self.table: dict[str, list] = {}
+    if m.key == gts_ast.AST_KEY:
+      data = memoryview(m.data)
+      self.slices = {base64.b64encode(u).decode('ascii'): data[s:e]
+                     for u, (s, e) in ast_index.ast_spans(m.data, 0, len(m.data)).items()}
+    elif m.key:
+      self.table = dict(gts_ast.load_semantics(m.key, m.data))
+
+  def raw(self, uuid: str) -> memoryview | None:
+    """the JSON text of a block's semantics, if split."""
+    return self.slices.get(uuid) if self.slices is not None else None
+
+  def get(self, uuid: str) -> list:
+    if self.slices is None:
+      return self.table.get(uuid, [])
+    raw = self.slices.get(uuid)
+    return json.loads(str(raw, 'utf-8')) if raw is not None else []
+
+def is_error(isn) -> bool:
+  return isinstance(isn, dict)
+
+def format_address(addr: int | None) -> str:
+  return '?' if addr is None else f'0x{addr:08x}'
+
+def diff_isns(address: int | None, old: tuple[bytes, list], new: tuple[bytes, list], byteorder: str) -> list[dict]:
+  """the differing instructions of a matched pair of blocks."""
+  (old_bytes, old_sems), (new_bytes, new_sems) = old, new
+  out = []
+  for i in range(max(len(old_sems), len(new_sems))):
+    o = old_sems[i] if i < len(old_sems) else None
+    n = new_sems[i] if i < len(new_sems) else None
+    old_op = old_bytes[i*ISN_SIZE:(i+1)*ISN_SIZE]
+    new_op = new_bytes[i*ISN_SIZE:(i+1)*ISN_SIZE]
+    if o == n and old_op == new_op:
+      continue
+    if o is None:
+      kind = 'added'
+    elif n is None:
+      kind = 'removed'
+    elif is_error(n) and not is_error(o):
+      kind = 'decode_error'
+    elif is_error(o) and not is_error(n):
+      kind = 'fixed'
+    else:
+      kind = 'changed'
+    op = new_op or old_op
+    out.append({
+      'kind': kind,
+      'address': None if address is None else address + i * ISN_SIZE,
+      'opcode': f'{int.from_bytes(op, byteorder):08x}' if len(op) == ISN_SIZE else None,
+      'old_opcode': f'{int.from_bytes(old_op, byteorder):08x}' if old_op != new_op and old_op else None,
+      'old': o,
+      'new': n,
+    })
+  return out
+
+def diff_module(file: str, old: ModuleSems, new: ModuleSems) -> dict:
+  """
+  compares a pair of modules, returning a report with lists of changed,
+  added and removed blocks. only blocks whose contents or semantics differ
+  are included.
+  """
+  old_sems, new_sems = BlockSems(old), BlockSems(new)
+
+  # match by uuid, then by address among the blocks left over.
+  pairs = [(u, u) for u in old.blocks if u in new.blocks]
+  old_only = {u: v for u, v in old.blocks.items() if u not in new.blocks}
+  new_only = {u: v for u, v in new.blocks.items() if u not in old.blocks}
+  by_address = {addr: u for u, (addr, _) in new_only.items() if addr is not None}
+  for u, (addr, _) in list(old_only.items()):
+    if addr in by_address:
+      v = by_address.pop(addr)
+      pairs.append((u, v))
+      del old_only[u], new_only[v]
+
+  changed = []
+  for u, v in pairs:
+    (addr, old_bytes), (_, new_bytes) = old.blocks[u], new.blocks[v]
+    if old_bytes == new_bytes:
+      # identical JSON text is identical semantics, without decoding.
+      o_raw, n_raw = old_sems.raw(u), new_sems.raw(v)
+      if o_raw is not None and o_raw == n_raw:
+        continue
+    o, n = old_sems.get(u), new_sems.get(v)
+    if old_bytes == new_bytes and o == n:
+      continue
+    changed.append({
+      'uuid': v,
+      'old_uuid': u if u != v else None,
+      'address': addr,
+      'instructions': diff_isns(addr, (old_bytes, o), (new_bytes, n), new.byteorder),
+    })
+
+  def summary(blocks: dict[str, tuple[int | None, bytes]], sems: BlockSems) -> list[dict]:
+    return [{'uuid': u, 'address': addr, 'instructions': len(sems.get(u))}
+            for u, (addr, _) in blocks.items()]
+
+  key = lambda b: (b['address'] is None, b['address'] or 0)
+  return {
+    'file': file,
+    'module': new.name,
+    'changed': sorted(changed, key=key),
+    'added': sorted(summary(new_only, new_sems), key=key),
+    'removed': sorted(summary(old_only, old_sems), key=key),
+  }
+
+def counts(report: dict) -> dict[str, int]:
+  out = {'changed': len(report['changed']), 'added': len(report['added']), 'removed': len(report['removed'])}
+  for k in ('decode_error', 'fixed'):
+    out[k] = sum(1 for b in report['changed'] for i in b['instructions'] if i['kind'] == k)
+  return out
+
+def different(report: dict) -> bool:
+  return bool(report['changed'] or report['added'] or report['removed'])
+
+def format_isn(isn) -> list[str]:
+  if is_error(isn):
+    err = isn.get('decode_error', isn)
+    return [f"decode_error: {err.get('error')}"]
+  return list(isn)
+
+MARKS = {'changed': '~', 'decode_error': '!', 'fixed': '*', 'added': '+', 'removed': '-'}
+
+def write_text(f, report: dict, stat: bool):
+  c = counts(report)
+  f.write(f"{report['file']} [{report['module']}]: {c['changed']} changed, {c['added']} added, "
+          f"{c['removed']} removed blocks; {c['decode_error']} new decode errors, {c['fixed']} fixed\n")
+  if stat:
+    return
+  for b in report['changed']:
+    renamed = f" (was {b['old_uuid']})" if b['old_uuid'] else ''
+    f.write(f"~ block {format_address(b['address'])} {b['uuid']}{renamed}\n")
+    for i in b['instructions']:
+      opcode = i['opcode'] if not i['old_opcode'] else f"{i['old_opcode']} -> {i['opcode']}"
+      f.write(f"  {MARKS[i['kind']]} {format_address(i['address'])} {opcode}\n")
+      old = format_isn(i['old']) if i['old'] is not None else []
+      new = format_isn(i['new']) if i['new'] is not None else []
+      for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, old, new, autojunk=False).get_opcodes():
+        if tag == 'equal':
+          continue
+        f.writelines(f'    - {s}\n' for s in old[i1:i2])
+        f.writelines(f'    + {s}\n' for s in new[j1:j2])
+  for mark, blocks in (('+', report['added']), ('-', report['removed'])):
+    for b in blocks:
+      f.write(f"{mark} block {format_address(b['address'])} {b['uuid']} ({b['instructions']} instructions)\n")
+
+def pairs(old: str, new: str, pattern: str) -> list[tuple[str, pathlib.Path | None, pathlib.Path | None]]:
+  """(name, old file, new file) pairs to compare. a file missing on one side is None."""
+  if not (os.path.isdir(old) and os.path.isdir(new)):
+    return [(f'{old} -> {new}', pathlib.Path(old), pathlib.Path(new))]
+  olds = {p.relative_to(old): p for p in pathlib.Path(old).rglob(pattern) if p.is_file()}
+  news = {p.relative_to(new): p for p in pathlib.Path(new).rglob(pattern) if p.is_file()}
+  return [(str(rel), olds.get(rel), news.get(rel)) for rel in sorted(olds.keys() | news.keys())]
+
+def diff_file(name: str, old_path: pathlib.Path, new_path: pathlib.Path) -> tuple[list[dict], int]:
+  """
+  loads and compares a pair of files, returning the reports of their
+  compared, added and removed modules and the number of identical modules.
+  """
+  old, new = load(old_path), load(new_path)
+  reports = []
+  unchanged = 0
+  # modules are matched by name, in order for repeated names.
+  new_by_name: dict[str, list[ModuleSems]] = {}
+  for m in new:
+    new_by_name.setdefault(m.name, []).append(m)
+  for m in old:
+    match = new_by_name.get(m.name)
+    if not match:
+      reports.append({'file': name, 'module': m.name, 'removed': True})
+    elif m.same(n := match.pop(0)):
+      unchanged += 1
+    else:
+      reports.append(diff_module(name, m, n))
+  for ms in new_by_name.values():
+    reports += [{'file': name, 'module': m.name, 'added': True} for m in ms]
+  return reports, unchanged
+
+def run(args) -> int:
+  files = pairs(args.old, args.new, args.pattern)
+  reports = []
+  unchanged = errors = 0
+
+  def collect(done):
+    nonlocal unchanged, errors
+    for f in done:
+      name = pending.pop(f)
+      try:
+        rs, n = f.result()
+      except Exception as e:
+        print(f'{name}: error: {e}', file=sys.stderr)
+        errors += 1
+        continue
+      reports.extend(rs)
+      unchanged += n
+
+  with concurrent.futures.ProcessPoolExecutor(args.jobs) as pool:
+    pending = {}
+    for name, old_path, new_path in files:
+      if old_path is None or new_path is None:
+        which = 'added' if old_path is None else 'removed'
+        reports.append({'file': name, which: True})
+        continue
+      pending[pool.submit(diff_file, name, old_path, new_path)] = name
+      # keep a couple of pairs queued per worker, not the whole corpus.
+      if len(pending) > 2 * args.jobs:
+        done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        collect(done)
+    collect(list(pending))
+
+  differ = 0
+  out = args.output
+  for r in sorted(reports, key=lambda r: (r['file'], r.get('module', ''))):
+    if r.get('added') is True or r.get('removed') is True:
+      differ += 1
+      what = f"{r['file']} [{r['module']}]" if 'module' in r else r['file']
+      state = 'added' if r.get('added') is True else 'removed'
+      out.write(json.dumps(r) + '\n' if args.json else f'{what}: {state}\n')
+    elif different(r):
+      differ += 1
+      if args.json:
+        out.write(json.dumps(r, separators=(',', ':')) + '\n')
+      else:
+        write_text(out, r, args.stat)
+
+  print(f'{differ} modules differ, {unchanged + len(reports) - differ} unchanged'
+        + (f', {errors} files could not be read' if errors else ''), file=sys.stderr)
+  return 2 if errors else 1 if differ else 0
+
+def main():
+  argp = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  argp.add_argument('old', help='.gts file or directory')
+  argp.add_argument('new', help='.gts file or directory')
+  argp.add_argument('-o', '--output', type=argparse.FileType('w'), default=sys.stdout, help='report file')
+  argp.add_argument('--json', action='store_true', help='write one JSON object per differing module')
+  argp.add_argument('--stat', action='store_true', help='only summarise each differing module')
+  argp.add_argument('--pattern', default='*.gts', help='file pattern matched in directories')
+  argp.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1, help='number of worker processes')
+  args = argp.parse_args()
+  return run(args)
+
+if __name__ == '__main__':
+  sys.exit(main())
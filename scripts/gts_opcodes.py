@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# vim: ts=2 sts=2 et sw=2
+
+# /// script
+# requires-python = ">=3.11"
+# dependencies = [
+#   "numpy",
+#   "protobuf",
+# ]
+# ///
+
+"""
+gts_opcodes.py [--top N] FILE
+
+Vectorised extraction of AArch64 opcodes from the code blocks of .gtirb
+and .gts files, and a histogram of the opcodes in a file.
+
+Each code block's bytes are viewed (not copied) as an array of uint32
+instruction words in the module's byte order. Unique opcodes and their
+counts are found with numpy over all blocks at once.
+
+example:
+
+  ir = gts_reader.load('a.gts')
+  words = {blk.uuid: gts_opcodes.block_words(blk, mod.byte_order) for blk in mod.code_blocks}
+  uniq, counts = gts_opcodes.unique_counts(words.values())
+  gts_opcodes.to_bytes(uniq)  # little-endian instruction bytes, e.g. for llvm-mc
+"""
+
+import sys
+import argparse
+import collections.abc
+
+import numpy as np
+
+import gts_reader
+
+ISN_SIZE = 4
+LITTLE = np.dtype('<u4')
+BIG = np.dtype('>u4')
+
+def word_dtype(byte_order: str) -> np.dtype:
+  """the uint32 dtype for a module's byte order (gts_reader or gtirb naming)."""
+  return BIG if byte_order.startswith('Big') else LITTLE
+
+def words(buf, offset: int, size: int, byte_order: str = 'LittleEndian') -> np.ndarray:
+  """
+  views the instructions in buf[offset:offset+size] as uint32 words. a
+  trailing partial instruction is ignored.
+  """
+  return np.frombuffer(buf, dtype=word_dtype(byte_order), count=size // ISN_SIZE, offset=offset)
+
+def block_words(blk: gts_reader.CodeBlock, byte_order: str) -> np.ndarray:
+  contents = blk.interval.contents
+  assert 0 <= blk.offset and blk.offset + blk.size <= len(contents)
+  return words(contents, blk.offset, blk.size, byte_order)
+
+def unique_counts(arrays: collections.abc.Iterable[np.ndarray]) -> tuple[np.ndarray, np.ndarray]:
+  """the distinct opcodes among arrays, in ascending order, and how often each occurs."""
+  arrays = [a for a in arrays if len(a)]
+  if not arrays:
+    return np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.intp)
+  # byte-swapping to native order is part of the concatenation.
+  return np.unique(np.concatenate(arrays, dtype=np.uint32), return_counts=True)
+
+def to_bytes(ops: np.ndarray, dtype: np.dtype = LITTLE) -> list[bytes]:
+  """encodes each opcode as instruction bytes."""
+  buf = ops.astype(dtype).tobytes()
+  return [buf[i:i+ISN_SIZE] for i in range(0, len(buf), ISN_SIZE)]
+
+def histogram(ir: gts_reader.IR) -> tuple[np.ndarray, np.ndarray]:
+  """opcodes of every code block in the IR, most frequent first, and their counts."""
+  ops, counts = unique_counts(
+    block_words(blk, mod.byte_order) for mod in ir.modules for blk in mod.code_blocks)
+  order = np.argsort(-counts, kind='stable')
+  return ops[order], counts[order]
+
+def main():
+  argp = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  argp.add_argument('input', help='.gtirb or .gts file')
+  argp.add_argument('--top', type=int, default=0, help='print only the N most frequent opcodes (0 for all)')
+  args = argp.parse_args()
+
+  ir = gts_reader.load(args.input, ())
+  ops, counts = histogram(ir)
+  total = int(counts.sum())
+  print(f'{total} instructions, {len(ops)} distinct opcodes', file=sys.stderr)
+  if args.top:
+    ops, counts = ops[:args.top], counts[:args.top]
+  for op, n in zip(ops.tolist(), counts.tolist()):
+    print(f'{op:08x}\t{n}\t{100 * n / total:.2f}%')
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,130 @@
+# vim: ts=2 sts=2 et sw=2
+
+"""
+Per-phase profiling for the scripts in this directory, written as a Chrome
+trace-event file (viewable in chrome://tracing or https://ui.perfetto.dev).
+
+Each phase records its wall time, the CPU time of its thread and of any
+child processes which exited during it, and the process's resident memory.
+
+example:
+
+  gts_profile.enable()
+  with gts_profile.phase('parse', module='libc.so'):
+    ...
+  gts_profile.write('trace.json')
+
+When profiling has not been enabled, phase() returns a shared no-op context
+manager, so instrumented code pays only for the call.
+"""
+
+import os
+import json
+import time
+import resource
+import threading
+import contextlib
+
+_NULL = contextlib.nullcontext()
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+def rss_bytes() -> int:
+  """the current resident set size, or the peak where that is unavailable."""
+  try:
+    with open('/proc/self/statm', 'rb') as f:
+      return int(f.read().split()[1]) * _PAGE_SIZE
+  except (OSError, ValueError, IndexError):
+    return peak_rss_bytes()
+
+def peak_rss_bytes() -> int:
+  # ru_maxrss is in kilobytes on linux and bytes on macos.
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+def _children_cpu() -> float:
+  ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+  return ru.ru_utime + ru.ru_stime
+
+class _Phase:
+  __slots__ = ('profiler', 'name', 'args', 'wall', 'cpu', 'children', 'rss')
+
+  def __init__(self, profiler: 'Profiler', name: str, args: dict):
+    self.profiler = profiler
+    self.name = name
+    self.args = args
+
+  def __enter__(self):
+    self.rss = rss_bytes()
+    self.children = _children_cpu()
+    self.cpu = time.thread_time()
+    self.wall = time.perf_counter_ns()
+    return self
+
+  def __exit__(self, *_):
+    end = time.perf_counter_ns()
+    cpu = time.thread_time() - self.cpu
+    children = _children_cpu() - self.children
+    rss = rss_bytes()
+    self.profiler.complete(self.name, self.wall, end, {
+      **self.args,
+      'cpu_ms': round(cpu * 1e3, 3),
+      'children_cpu_ms': round(children * 1e3, 3),
+      'rss_mb': round(rss / 2**20, 2),
+      'rss_delta_mb': round((rss - self.rss) / 2**20, 2),
+    })
+
+class Profiler:
+  def __init__(self):
+    self.pid = os.getpid()
+    self.start = time.perf_counter_ns()
+    self.events: list[dict] = []
+    self.threads: dict[int, str] = {}
+
+  def phase(self, name: str, args: dict) -> _Phase:
+    return _Phase(self, name, args)
+
+  def _us(self, ns: int) -> float:
+    return (ns - self.start) / 1e3
+
+  def complete(self, name: str, start: int, end: int, args: dict):
+    tid = threading.get_native_id()
+    if tid not in self.threads:
+      self.threads[tid] = threading.current_thread().name
+    # list.append is atomic, so worker threads may record phases too.
+    self.events.append({'name': name, 'cat': 'phase', 'ph': 'X', 'pid': self.pid, 'tid': tid,
+                        'ts': self._us(start), 'dur': (end - start) / 1e3, 'args': args})
+    self.events.append({'name': 'memory', 'ph': 'C', 'pid': self.pid, 'tid': tid,
+                        'ts': self._us(end), 'args': {'rss_mb': args['rss_mb']}})
+
+  def trace(self) -> dict:
+    meta = [{'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid, 'args': {'name': name}}
+            for tid, name in self.threads.items()]
+    return {
+      'traceEvents': meta + self.events,
+      'displayTimeUnit': 'ms',
+      'otherData': {'peak_rss_mb': round(peak_rss_bytes() / 2**20, 2)},
+    }
+
+_profiler: Profiler | None = None
+
+def enable() -> Profiler:
+  global _profiler
+  if _profiler is None:
+    _profiler = Profiler()
+  return _profiler
+
+def enabled() -> bool:
+  return _profiler is not None
+
+def phase(name: str, **args):
+  """a context manager recording a phase, or a no-op if profiling is disabled."""
+  if _profiler is None:
+    return _NULL
+  return _profiler.phase(name, args)
+
+def write(path):
+  """writes the recorded phases as a Chrome trace-event JSON file."""
+  if _profiler is None:
+    return
+  with open(path, 'w') as f:
+    json.dump(_profiler.trace(), f)
@@ -0,0 +1,495 @@
+# vim: ts=2 sts=2 et sw=2
+
+"""
+A lightweight reader for .gtirb and .gts files.
+
+This decodes the raw protobuf with the bundled GTIRB descriptor set
+(see gtirb_fdset.py) and keeps only what our scripts need: code blocks,
+byte interval contents, CFG edges, symbol names, and a chosen subset of
+auxdata tables. This avoids building the `gtirb` package's full object
+graph, which is considerably slower and larger.
+
+Files are memory-mapped rather than read. Byte interval contents and
+auxdata tables are cut out of the serialised IR by offset before the rest
+is handed to protobuf, and are kept as memoryviews into the mapping, so a
+large file (e.g. a .gts with its semantics) is never copied whole.
+
+example:
+
+  ir = gts_reader.load('a.gts')
+  for mod in ir.modules:
+    for blk in mod.code_blocks:
+      print(blk.address, blk.contents.hex())
+    sems = json.loads(str(mod.ast, 'utf-8'))
+"""
+
+import io
+import os
+import mmap
+import enum
+import typing
+import functools
+import dataclasses
+import collections
+import collections.abc
+
+import google.protobuf.message_factory
+import google.protobuf.descriptor_pool
+import google.protobuf.descriptor_pb2
+
+import gts_profile
+from gtirb_fdset import gtirb_fdset_bytes
+
+GTIRB_MAGIC = b'GTIRB'
+MAGIC_SIZE = 8
+
+# auxdata tables decoded by default.
+DEFAULT_AUX = ('functionNames', 'functionEntries', 'functionBlocks', 'ast', 'astCompact')
+
+# fields which are never read by this module. they are removed from the
+# descriptors so the protobuf parser skips over them.
+SKIPPED_FIELDS = {
+  'gtirb.proto.ByteInterval': {'symbolic_expressions'},
+}
+
+class EdgeType(enum.IntEnum):
+  Branch = 0
+  Call = 1
+  Fallthrough = 2
+  Return = 3
+  Syscall = 4
+  Sysret = 5
+
+@functools.cache
+def message_classes() -> dict[str, type]:
+  fds = google.protobuf.descriptor_pb2.FileDescriptorSet.FromString(gtirb_fdset_bytes())
+  for f in fds.file:
+    for m in f.message_type:
+      skip = SKIPPED_FIELDS.get(f'{f.package}.{m.name}', set())
+      fields = [x for x in m.field if x.name not in skip]
+      del m.field[:]
+      m.field.extend(fields)
+  pool = google.protobuf.descriptor_pool.DescriptorPool()
+  return google.protobuf.message_factory.GetMessages(fds.file, pool=pool)
+
+@functools.cache
+def skipped_field_numbers(msg: str) -> frozenset[int]:
+  """the numbers of the fields of a message type which are in SKIPPED_FIELDS."""
+  fds = google.protobuf.descriptor_pb2.FileDescriptorSet.FromString(gtirb_fdset_bytes())
+  return frozenset(x.number for f in fds.file for m in f.message_type
+                   if f'{f.package}.{m.name}' == msg for x in m.field
+                   if x.name in SKIPPED_FIELDS.get(msg, ()))
+
+@dataclasses.dataclass(slots=True)
+class ByteInterval:
+  uuid: bytes
+  address: int | None
+  size: int
+  contents: memoryview  # into the file, as mapped by load()
+
+@dataclasses.dataclass(slots=True)
+class CodeBlock:
+  uuid: bytes
+  offset: int  # within the byte interval
+  size: int
+  interval: ByteInterval
+  section: str
+
+  @property
+  def address(self) -> int | None:
+    addr = self.interval.address
+    return None if addr is None else addr + self.offset
+
+  @property
+  def contents(self) -> memoryview:
+    return self.interval.contents[self.offset:self.offset + self.size]
+
+@dataclasses.dataclass(slots=True)
+class Edge:
+  source: bytes
+  target: bytes
+  type: EdgeType
+  conditional: bool
+  direct: bool
+
+  def label(self) -> str:
+    """formats the edge label in the same way as gtirb.Edge.Label."""
+    return (f'Edge.Label(type=Edge.Type.{self.type.name}, '
+            f'conditional={self.conditional!r}, direct={self.direct!r}, )')
+
+@dataclasses.dataclass(slots=True)
+class AuxData:
+  type_name: str
+  data: bytes | memoryview
+
+  def decode(self) -> object:
+    return decode_auxdata(self.type_name, self.data)
+
+@dataclasses.dataclass
+class Module:
+  uuid: bytes
+  name: str
+  byte_order: str  # name of the gtirb.proto.ByteOrder value, e.g. 'LittleEndian'
+  intervals: list[ByteInterval]
+  code_blocks: list[CodeBlock]
+  proxies: set[bytes]
+  symbol_names: dict[bytes, str]
+  # referent block uuid -> uuids of symbols referring to it, in module order.
+  references: dict[bytes, list[bytes]]
+  aux_data: dict[str, AuxData]
+
+  @functools.cached_property
+  def function_names(self) -> dict[bytes, bytes]:
+    """function uuid -> symbol uuid"""
+    return typing.cast(dict, self.aux_data['functionNames'].decode())
+
+  @functools.cached_property
+  def function_entries(self) -> dict[bytes, set[bytes]]:
+    """function uuid -> entry block uuids"""
+    return typing.cast(dict, self.aux_data['functionEntries'].decode())
+
+  @functools.cached_property
+  def function_blocks(self) -> dict[bytes, set[bytes]]:
+    """function uuid -> code block uuids"""
+    return typing.cast(dict, self.aux_data['functionBlocks'].decode())
+
+  @property
+  def ast(self) -> bytes | memoryview:
+    """the raw JSON semantics added by gtirb_semantics."""
+    return self.aux_data['ast'].data
+
+@dataclasses.dataclass
+class IR:
+  uuid: bytes
+  version: int
+  modules: list[Module]
+  vertices: list[bytes]
+  edges: list[Edge]
+
+  @functools.cached_property
+  def outgoing(self) -> dict[bytes, list[Edge]]:
+    """source block uuid -> outgoing edges, in CFG order."""
+    out = collections.defaultdict(list)
+    for e in self.edges:
+      out[e.source].append(e)
+    return out
+
+def magic_size(data) -> int:
+  """the size of the GTIRB magic prefix of data: MAGIC_SIZE if present, otherwise 0."""
+  return MAGIC_SIZE if bytes(data[:len(GTIRB_MAGIC)]) == GTIRB_MAGIC else 0
+
+def strip_magic(data: bytes) -> memoryview:
+  """returns the protobuf data, skipping the GTIRB magic prefix if present."""
+  data = memoryview(data)
+  return data[magic_size(data):]
+
+def map_file(file) -> memoryview:
+  """
+  maps a file (a path, or a binary file object) read-only and returns a view
+  of all of it. the mapping is closed once no views of it remain. files which
+  cannot be mapped (e.g. pipes, or empty files) are read instead.
+  """
+  if isinstance(file, (str, os.PathLike)):
+    with open(file, 'rb') as f:
+      return map_file(f)
+  try:
+    return memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+  except (OSError, ValueError):
+    return memoryview(file.read())
+
+def _module(m, contents: list[memoryview], aux_data: dict[str, AuxData]) -> Module:
+  ByteOrder = m.DESCRIPTOR.fields_by_name['byte_order'].enum_type
+
+  intervals = []
+  blocks = []
+  ivals = iter(contents)
+  for sec in m.sections:
+    for bi in sec.byte_intervals:
+      ival = ByteInterval(bi.uuid, bi.address if bi.has_address else None, bi.size, next(ivals))
+      intervals.append(ival)
+      for b in bi.blocks:
+        if b.WhichOneof('value') != 'code': continue
+        blocks.append(CodeBlock(b.code.uuid, b.offset, b.code.size, ival, sec.name))
+
+  symbol_names = {}
+  references = collections.defaultdict(list)
+  for sym in m.symbols:
+    symbol_names[sym.uuid] = sym.name
+    if sym.WhichOneof('optional_payload') == 'referent_uuid':
+      references[sym.referent_uuid].append(sym.uuid)
+
+  return Module(
+    uuid=m.uuid,
+    name=m.name,
+    byte_order=ByteOrder.values_by_number[m.byte_order].name,
+    intervals=intervals,
+    code_blocks=blocks,
+    proxies={p.uuid for p in m.proxies},
+    symbol_names=symbol_names,
+    references=dict(references),
+    aux_data=aux_data,
+  )
+
+def _profiled_module(m, contents: list[memoryview], aux_data: dict[str, AuxData]) -> Module:
+  with gts_profile.phase('index module', module=m.name):
+    return _module(m, contents, aux_data)
+
+def _split_module(buf, start: int, end: int, aux_keys: collections.abc.Container[str] | None):
+  """
+  splits the module serialised in buf[start:end] into the rest of the module,
+  as parts to be joined, and views of its byte interval contents (in order)
+  and of its auxdata tables named in aux_keys (or all, if None).
+  """
+  sections = field_number('gtirb.proto.Module', 'sections')
+  aux_data = field_number('gtirb.proto.Module', 'aux_data')
+  byte_intervals = field_number('gtirb.proto.Section', 'byte_intervals')
+  contents = field_number('gtirb.proto.ByteInterval', 'contents')
+  skipped = skipped_field_numbers('gtirb.proto.ByteInterval')
+
+  parts, cut = _cut_fields(buf, start, end, {sections, aux_data})
+  views = []
+  for s, e in cut[sections]:
+    sec, sec_cut = _cut_fields(buf, s, e, {byte_intervals})
+    for s, e in sec_cut[byte_intervals]:
+      bi, bi_cut = _cut_fields(buf, s, e, {contents, *skipped})
+      views.append(buf[slice(*bi_cut[contents][-1])] if bi_cut[contents] else buf[0:0])
+      sec += _enclose(byte_intervals, bi)
+    parts += _enclose(sections, sec)
+
+  tables = {}
+  for s, e in cut[aux_data]:
+    key, aux = aux_entry(buf, s, e)
+    if aux_keys is None or key in aux_keys:
+      tables[key] = aux
+  return parts, views, tables
+
+def parse(data: bytes, aux_keys: collections.abc.Container[str] | None = DEFAULT_AUX) -> IR:
+  """
+  parses .gtirb or .gts data. only the auxdata tables named in `aux_keys`
+  are kept, or all of them if `aux_keys` is None. byte interval contents and
+  auxdata are views into data, which must not change while they are in use.
+  """
+  msgs = message_classes()
+  modules = field_number('gtirb.proto.IR', 'modules')
+  aux_data = field_number('gtirb.proto.IR', 'aux_data')
+  buf = strip_magic(data)
+  with gts_profile.phase('protobuf parse', bytes=len(buf)):
+    rest, cut = _cut_fields(buf, 0, len(buf), {modules, aux_data})
+    ir = msgs['gtirb.proto.IR'].FromString(b''.join(rest))
+    mods = []
+    for s, e in cut[modules]:
+      parts, views, tables = _split_module(buf, s, e, aux_keys)
+      mods.append((msgs['gtirb.proto.Module'].FromString(b''.join(parts)), views, tables))
+
+  edges = [
+    Edge(e.source_uuid, e.target_uuid, EdgeType(e.label.type), e.label.conditional, e.label.direct)
+    for e in ir.cfg.edges
+  ]
+  return IR(
+    uuid=ir.uuid,
+    version=ir.version,
+    modules=[_profiled_module(*m) for m in mods],
+    vertices=list(ir.cfg.vertices),
+    edges=edges,
+  )
+
+def load(path, aux_keys: collections.abc.Container[str] | None = DEFAULT_AUX) -> IR:
+  with gts_profile.phase('read', path=str(path)):
+    data = map_file(path)
+  return parse(data, aux_keys)
+
+
+# scanning of the raw protobuf wire format. these find the byte offsets of
+# fields within the serialised IR without decoding it, which allows random
+# access into large files (e.g. through an mmap).
+
+def read_varint(buf, i: int) -> tuple[int, int]:
+  """returns the varint at buf[i] and the index following it."""
+  result = 0
+  shift = 0
+  while True:
+    b = buf[i]
+    i += 1
+    result |= (b & 0x7f) << shift
+    if b < 0x80:
+      return result, i
+    shift += 7
+
+def iter_fields(buf, start: int, end: int) -> collections.abc.Iterator[tuple[int, int, int, int]]:
+  """
+  yields (field number, wire type, start, end) for each field of the message
+  serialised in buf[start:end]. for length-delimited fields, start and end
+  delimit the payload; otherwise, they delimit the encoded value.
+  """
+  i = start
+  while i < end:
+    tag, i = read_varint(buf, i)
+    field, wire = tag >> 3, tag & 7
+    if wire == 0:
+      _, j = read_varint(buf, i)
+    elif wire == 1:
+      j = i + 8
+    elif wire == 2:
+      n, i = read_varint(buf, i)
+      j = i + n
+    elif wire == 5:
+      j = i + 4
+    else:
+      raise ValueError(f"unsupported protobuf wire type {wire} at offset {i}")
+    yield field, wire, i, j
+    i = j
+
+def encode_varint(n: int) -> bytes:
+  out = bytearray()
+  while n >= 0x80:
+    out.append(n & 0x7f | 0x80)
+    n >>= 7
+  out.append(n)
+  return bytes(out)
+
+def encode_field(number: int, payload) -> bytes:
+  """serialises a length-delimited field."""
+  return encode_varint(number << 3 | 2) + encode_varint(len(payload)) + bytes(payload)
+
+def _cut_fields(buf, start: int, end: int, fields: collections.abc.Container[int]) -> tuple[list, dict[int, list[tuple[int, int]]]]:
+  """
+  cuts the fields numbered in `fields` out of the message serialised in
+  buf[start:end]. returns the rest of the message, as a list of views to be
+  joined, and the payload spans of the fields cut out, by field number.
+  """
+  rest = []
+  cut = collections.defaultdict(list)
+  run = prev = start
+  for f, _, s, e in iter_fields(buf, start, end):
+    if f in fields:
+      if run < prev:
+        rest.append(buf[run:prev])
+      cut[f].append((s, e))
+      run = e
+    prev = e
+  if run < end:
+    rest.append(buf[run:end])
+  return rest, cut
+
+def _enclose(number: int, parts: list) -> list:
+  """parts of a message, as a length-delimited field."""
+  return [encode_varint(number << 3 | 2) + encode_varint(sum(map(len, parts))), *parts]
+
+def field_number(msg: str, field: str) -> int:
+  return message_classes()[msg].DESCRIPTOR.fields_by_name[field].number
+
+def aux_entry(buf, start: int, end: int) -> tuple[str, AuxData]:
+  """decodes an entry of an aux_data map, keeping a view of its data."""
+  # map entries are messages with key = 1 and value = 2.
+  entry = {f: (s, e) for f, _, s, e in iter_fields(buf, start, end)}
+  key = bytes(buf[slice(*entry.get(1, (0, 0)))]).decode('utf-8')
+  type_name = field_number('gtirb.proto.AuxData', 'type_name')
+  data = field_number('gtirb.proto.AuxData', 'data')
+  aux = {f: (s, e) for f, _, s, e in iter_fields(buf, *entry.get(2, (0, 0)))}
+  return key, AuxData(bytes(buf[slice(*aux.get(type_name, (0, 0)))]).decode('utf-8'),
+                      buf[slice(*aux.get(data, (0, 0)))])
+
+def aux_data_spans(buf, key: str) -> list[tuple[int, int] | None]:
+  """
+  returns, for each module, the (start, end) offsets within buf of the data of
+  the auxdata table with the given key, or None if the module does not have it.
+  buf may be a .gtirb or .gts file.
+  """
+  modules = field_number('gtirb.proto.IR', 'modules')
+  aux_data = field_number('gtirb.proto.Module', 'aux_data')
+  data = field_number('gtirb.proto.AuxData', 'data')
+  key_bytes = key.encode('utf-8')
+
+  out = []
+  for f, _, s, e in iter_fields(buf, magic_size(buf), len(buf)):
+    if f != modules: continue
+    span = None
+    for f, _, s, e in iter_fields(buf, s, e):
+      if f != aux_data: continue
+      # map entries are messages with key = 1 and value = 2.
+      entry = {f: (s, e) for f, _, s, e in iter_fields(buf, s, e)}
+      if 1 not in entry or bytes(buf[slice(*entry[1])]) != key_bytes: continue
+      s, e = entry.get(2, (0, 0))
+      span = (e, e)  # empty data is omitted from the wire
+      for f, _, s, e in iter_fields(buf, s, e):
+        if f == data:
+          span = (s, e)
+    out.append(span)
+  return out
+
+
+# decoding of gtirb's auxdata serialisation format.
+# see: https://grammatech.github.io/gtirb/md__aux_data.html
+
+@dataclasses.dataclass(frozen=True)
+class AuxType:
+  name: str
+  args: tuple['AuxType', ...] = ()
+
+def parse_aux_type(s: str) -> AuxType:
+  def go(i: int) -> tuple[AuxType, int]:
+    j = i
+    while j < len(s) and s[j] not in '<>,':
+      j += 1
+    name = s[i:j].strip()
+    args = []
+    if j < len(s) and s[j] == '<':
+      j += 1
+      while True:
+        arg, j = go(j)
+        args.append(arg)
+        if s[j] == '>':
+          j += 1
+          break
+        assert s[j] == ',', f"malformed auxdata type: {s!r}"
+        j += 1
+    return AuxType(name, tuple(args)), j
+
+  t, i = go(0)
+  assert i == len(s), f"malformed auxdata type: {s!r}"
+  return t
+
+_INTS = {
+  'uint64_t': (8, False), 'Addr': (8, False), 'int64_t': (8, True),
+  'uint32_t': (4, False), 'int32_t': (4, True),
+  'uint16_t': (2, False), 'int16_t': (2, True),
+  'uint8_t': (1, False), 'int8_t': (1, True),
+}
+
+def _decode(f: io.BytesIO, t: AuxType) -> object:
+  def u64() -> int:
+    return int.from_bytes(f.read(8), 'little')
+
+  if t.name in _INTS:
+    n, signed = _INTS[t.name]
+    return int.from_bytes(f.read(n), 'little', signed=signed)
+  elif t.name == 'UUID':
+    return f.read(16)
+  elif t.name == 'string':
+    return f.read(u64()).decode('utf-8')
+  elif t.name == 'bool':
+    return f.read(1) != b'\0'
+  elif t.name == 'Offset':
+    return (f.read(16), u64())
+  elif t.name == 'mapping':
+    k, v = t.args
+    return {_decode(f, k): _decode(f, v) for _ in range(u64())}
+  elif t.name == 'set':
+    x, = t.args
+    return {_decode(f, x) for _ in range(u64())}
+  elif t.name == 'sequence':
+    x, = t.args
+    return [_decode(f, x) for _ in range(u64())]
+  elif t.name == 'tuple':
+    return tuple(_decode(f, x) for x in t.args)
+  elif t.name == 'variant':
+    i = u64()
+    return (i, _decode(f, t.args[i]))
+  raise ValueError(f"unsupported auxdata type: {t.name!r}")
+
+def decode_auxdata(type_name: str, data: bytes) -> object:
+  """
+  decodes auxdata with the given type name. tuples are returned as tuples,
+  sets as sets, UUIDs as their 16 raw bytes, and Offsets as (uuid, displacement).
+  """
+  return _decode(io.BytesIO(data), parse_aux_type(type_name))
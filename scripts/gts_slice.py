@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# vim: ts=2 sts=2 et sw=2
+
+# /// script
+# requires-python = ">=3.11"
+# dependencies = [
+#   "protobuf",
+# ]
+# ///
+
+"""
+gts_slice.py slice INPUT.gtirb REDUCED.gtirb FUNCTION...
+gts_slice.py merge INPUT.gtirb LIFTED.gts OUTPUT.gts
+gts_slice.py lift INPUT.gtirb OUTPUT.gts FUNCTION... [-- GTIRB_SEMANTICS_ARGS...]
+
+Lifting of selected functions only.
+
+`slice` writes a reduced IR with only the code blocks of the given functions
+(by name, or by the address of any of their blocks), resolved through the
+functionNames and functionBlocks auxdata. Each byte interval is cut down to
+the span of its remaining blocks, and everything gtirb_semantics does not
+read (symbols, the CFG, symbolic expressions, auxdata) is left out.
+
+`merge` copies the semantics of the lifted reduced IR into the full IR,
+which is otherwise copied unchanged. Semantics already in the full IR
+(e.g. from an earlier merge) are kept unless lifted again.
+
+`lift` does both around a run of gtirb_semantics.
+"""
+
+import os
+import sys
+import argparse
+import tempfile
+import subprocess
+import collections.abc
+
+import gts_ast
+import gts_reader
+
+def function_names(m) -> dict[str, list[bytes]]:
+  """function name -> function uuids, from a protobuf Module."""
+  aux = {k: v for k, v in m.aux_data.items() if k == 'functionNames'}
+  if not aux:
+    return {}
+  symbols = {s.uuid: s.name for s in m.symbols}
+  out: dict[str, list[bytes]] = {}
+  names = gts_reader.decode_auxdata(aux['functionNames'].type_name, aux['functionNames'].data)
+  for func, sym in names.items():
+    out.setdefault(symbols.get(sym, ''), []).append(func)
+  return out
+
+def block_addresses(m) -> dict[bytes, tuple[int, int]]:
+  """code block uuid -> (address, size), from a protobuf Module."""
+  out = {}
+  for sec in m.sections:
+    for bi in sec.byte_intervals:
+      if not bi.has_address: continue
+      for b in bi.blocks:
+        if b.WhichOneof('value') == 'code':
+          out[b.code.uuid] = (bi.address + b.offset, b.code.size)
+  return out
+
+def select_blocks(m, functions: collections.abc.Iterable[str]) -> tuple[set[bytes], set[str]]:
+  """
+  the code blocks of the named functions in a protobuf Module, and the
+  function names and addresses which were found.
+  """
+  if 'functionBlocks' not in m.aux_data:
+    return set(), set()
+  fb = m.aux_data['functionBlocks']
+  blocks: dict[bytes, set[bytes]] = gts_reader.decode_auxdata(fb.type_name, fb.data)  # type: ignore
+  names = function_names(m)
+  addresses = block_addresses(m)
+
+  def containing(address: int) -> list[bytes]:
+    return [func for func, blks in blocks.items()
+            if any(addr <= address < addr + max(size, 1)
+                   for addr, size in (addresses[b] for b in blks if b in addresses))]
+
+  out = set()
+  found = set()
+  for f in functions:
+    funcs = names.get(f, [])
+    if not funcs:
+      try:
+        funcs = containing(int(f, 0))
+      except ValueError:
+        pass
+    if funcs:
+      found.add(f)
+    for func in funcs:
+      out |= blocks.get(func, set())
+  return out, found
+
+def reduce_interval(bi, keep: set[bytes]) -> bool:
+  """
+  removes all but the kept code blocks from a protobuf ByteInterval and
+  trims its contents to their span. returns whether any blocks remain.
+  """
+  blocks = [b for b in bi.blocks if b.WhichOneof('value') == 'code' and b.code.uuid in keep]
+  if not blocks:
+    return False
+  lo = min(b.offset for b in blocks)
+  hi = max(b.offset + b.code.size for b in blocks)
+  if not bi.has_address:
+    lo = 0
+  kept = [type(b)() for b in blocks]
+  for new, b in zip(kept, blocks):
+    new.CopyFrom(b)
+    new.offset -= lo
+  del bi.blocks[:]
+  bi.blocks.extend(kept)
+  if lo or hi < len(bi.contents):
+    bi.contents = bi.contents[lo:hi]
+  if bi.has_address:
+    bi.address += lo
+  bi.size = max(hi - lo, len(bi.contents))
+  return True
+
+def reduce(data: bytes, functions: list[str]) -> tuple[bytes, set[str], int]:
+  """
+  serialises the IR in data with only the code blocks of the given functions.
+  returns the reduced IR (without magic), the functions found, and the number
+  of code blocks kept.
+  """
+  ir = gts_reader.message_classes()['gtirb.proto.IR'].FromString(gts_reader.strip_magic(data))
+  # symbolic expressions are not in gts_reader's descriptors, so they are
+  # held as unknown fields; these are discarded along with them.
+  ir.DiscardUnknownFields()
+  ir.ClearField('cfg')
+  ir.ClearField('aux_data')
+  found = set()
+  count = 0
+  for m in ir.modules:
+    keep, f = select_blocks(m, functions)
+    found |= f
+    count += len(keep)
+    m.ClearField('aux_data')
+    m.ClearField('symbols')
+    m.ClearField('proxies')
+    if m.entry_point not in keep:
+      m.ClearField('entry_point')
+    sections = []
+    for sec in m.sections:
+      intervals = [bi for bi in sec.byte_intervals if reduce_interval(bi, keep)]
+      if intervals:
+        new = type(sec)()
+        new.CopyFrom(sec)
+        del new.byte_intervals[:]
+        new.byte_intervals.extend(intervals)
+        sections.append(new)
+    del m.sections[:]
+    m.sections.extend(sections)
+  return ir.SerializeToString(), found, count
+
+def lifted_semantics(path) -> list[dict[str, list]]:
+  """the semantics of each module of a lifted file, in the `ast` format."""
+  ir = gts_reader.load(path, (gts_ast.AST_KEY, gts_ast.COMPACT_KEY))
+  out = []
+  for mod in ir.modules:
+    try:
+      out.append(dict(gts_ast.semantics(mod)))
+    except KeyError:
+      out.append({})
+  return out
+
+def merge(data: bytes, lifted: list[dict[str, list]], compact: bool = False) -> bytes:
+  """
+  serialises the IR in data, adding the semantics of each module in lifted
+  to those it already has. the result has no magic, like gtirb_semantics output.
+  """
+  mods = iter(lifted)
+
+  def update(tables: dict[str, gts_reader.AuxData]) -> dict[str, gts_reader.AuxData]:
+    sems = next(mods)
+    for key in (gts_ast.COMPACT_KEY, gts_ast.AST_KEY):
+      old = tables.pop(key, None)
+      if old:
+        sems = dict(gts_ast.load_semantics(key, old.data)) | sems
+    if compact:
+      tables[gts_ast.COMPACT_KEY] = gts_reader.AuxData(gts_ast.COMPACT_KEY, gts_ast.dumps(gts_ast.compact(sems)))
+    else:
+      tables[gts_ast.AST_KEY] = gts_reader.AuxData(gts_ast.AST_KEY, gts_ast.dumps(sems))
+    return tables
+
+  out = gts_ast.rewrite_aux_data(data, update)
+  if next(mods, None) is not None:
+    raise ValueError('the lifted file has more modules than the input')
+  return bytes(gts_reader.strip_magic(out))
+
+def do_slice(input: str, output: str, functions: list[str]) -> int:
+  data = gts_reader.map_file(input)
+  reduced, found, count = reduce(data, functions)
+  missing = [f for f in functions if f not in found]
+  if missing:
+    print(f'error: functions not found: {", ".join(missing)}', file=sys.stderr)
+    return 1
+  with open(output, 'wb') as f:
+    # keep the magic of the input, if it had one.
+    f.write(bytes(data[:gts_reader.magic_size(data)]) + reduced)
+  print(f'{output}: {count} code blocks, {len(reduced)} of {len(data)} bytes', file=sys.stderr)
+  return 0
+
+def do_merge(input: str, lifted: str, output: str, compact: bool) -> int:
+  data = gts_reader.map_file(input)
+  sems = lifted_semantics(lifted)
+  out = merge(data, sems, compact)
+  with open(output, 'wb') as f:
+    f.write(out)
+  print(f'{output}: merged semantics of {sum(map(len, sems))} blocks', file=sys.stderr)
+  return 0
+
+def main():
+  argp = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  sub = argp.add_subparsers(dest='cmd', required=True)
+
+  s = sub.add_parser('slice', help='write a reduced IR with only the given functions')
+  s.add_argument('input', help='.gtirb input file')
+  s.add_argument('output', help='reduced .gtirb output file')
+  s.add_argument('functions', nargs='+', metavar='FUNCTION', help='function name or address')
+
+  m = sub.add_parser('merge', help='add the semantics of a lifted reduced IR to the full IR')
+  m.add_argument('input', help='.gtirb (or .gts) input file, as given to slice')
+  m.add_argument('lifted', help='.gts output of gtirb_semantics for the reduced IR')
+  m.add_argument('output', help='.gts output file')
+  m.add_argument('--compact', action='store_true', help=f'write semantics as `{gts_ast.COMPACT_KEY}`')
+
+  lift = sub.add_parser('lift', help='slice, lift with gtirb_semantics, and merge')
+  lift.add_argument('input', help='.gtirb input file')
+  lift.add_argument('output', help='.gts output file')
+  lift.add_argument('functions', nargs='+', metavar='FUNCTION', help='function name or address')
+  lift.add_argument('--gtirb-semantics', default='gtirb_semantics', help='gtirb_semantics executable')
+  lift.add_argument('--compact', action='store_true', help=f'write semantics as `{gts_ast.COMPACT_KEY}`')
+
+  args, extra = argp.parse_known_args()
+  if extra and args.cmd != 'lift':
+    argp.error(f'unrecognized arguments: {" ".join(extra)}')
+  extra = [x for x in extra if x != '--']
+
+  if args.cmd == 'slice':
+    return do_slice(args.input, args.output, args.functions)
+  if args.cmd == 'merge':
+    return do_merge(args.input, args.lifted, args.output, args.compact)
+
+  with tempfile.TemporaryDirectory(prefix='gts_slice') as tmp:
+    reduced = os.path.join(tmp, 'reduced.gtirb')
+    lifted = os.path.join(tmp, 'reduced.gts')
+    if ret := do_slice(args.input, reduced, args.functions):
+      return ret
+    proc = subprocess.run([args.gtirb_semantics, reduced, lifted, *extra])
+    if proc.returncode:
+      print(f'error: {args.gtirb_semantics} exited with status {proc.returncode}', file=sys.stderr)
+      return proc.returncode
+    return do_merge(args.input, lifted, args.output, args.compact)
+
+if __name__ == '__main__':
+  sys.exit(main())
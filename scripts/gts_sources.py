@@ -0,0 +1,43 @@
+# vim: ts=2 sts=2 et sw=2
+
+"""
+expansion of the input sources given to the batch modes of the scripts in
+this directory (proto-json.py --batch, gts_batch.py).
+"""
+
+import os
+import glob
+import logging
+import pathlib
+
+log = logging.getLogger(__name__)
+
+def batch_sources(sources: list[str], pattern: str) -> list[tuple[pathlib.Path, pathlib.Path]]:
+  """
+  expands sources into (input path, output path relative to the output
+  directory) pairs. directories are searched recursively for files matching
+  pattern and mirrored below the directory. other inputs (files, globs, and
+  @list files with one path per line) are mirrored relative to their common
+  parent.
+  """
+  out = []
+  loose = []
+  for src in sources:
+    if src.startswith('@'):
+      with open(src[1:]) as f:
+        loose += [pathlib.Path(x.strip()) for x in f if x.strip()]
+    elif os.path.isdir(src):
+      root = pathlib.Path(src)
+      out += [(p, p.relative_to(root)) for p in sorted(root.rglob(pattern)) if p.is_file()]
+    elif os.path.exists(src):
+      loose.append(pathlib.Path(src))
+    else:
+      matches = sorted(glob.glob(src, recursive=True))
+      if not matches:
+        log.warning(f"source matched nothing: {src!r}")
+      loose += [pathlib.Path(x) for x in matches if os.path.isfile(x)]
+
+  if loose:
+    root = pathlib.Path(os.path.commonpath([p.resolve().parent for p in loose]))
+    out += [(p, p.resolve().relative_to(root)) for p in loose]
+  return out
@@ -0,0 +1,438 @@
+#!/usr/bin/env python3
+# vim: ts=2 sts=2 et sw=2
+
+# /// script
+# requires-python = ">=3.11"
+# dependencies = [
+#   "numpy",
+#   "protobuf",
+# ]
+# ///
+
+"""
+gts_store.py harvest FILE_OR_DIR...
+gts_store.py lookup OPCODE[@ADDRESS]...
+gts_store.py lift INPUT.gtirb OUTPUT.gts
+gts_store.py prewarm [--top N]
+
+A persistent opcode -> semantics store, harvested from existing .gts files,
+so that the semantics lifted for one binary can be reused for the next
+instead of living only as long as one `gtirb_semantics --serve` process.
+
+`harvest` pairs the instructions of each code block with its `ast` (or
+`astCompact`) entries and adds them to the store. `lookup` prints stored
+semantics in the format of `gts_client.py lift`. `lift` writes a .gts for a
+.gtirb file from the store, lifting only the missing instructions with a
+`--serve-json` server and adding them to the store. `prewarm` has a fresh
+server lift the most common stored opcodes, so its own cache is warm.
+
+Semantics are kept per (opcode, address) until the opcode has been seen at
+two or more addresses, always with the same semantics, and are then kept
+per opcode. PC-relative instructions (ADR/ADRP, branches, BLR and its
+authenticated forms, and literal loads) and opcodes seen with differing
+semantics are always kept by address, so a lookup at a new address misses
+rather than returns the semantics of another. Decode errors are not
+stored, so that a newer lifter may retry them.
+
+Each distinct statement is stored once, and each distinct instruction as a
+list of statement ids, as in the `astCompact` format. The store records no
+lifter version; use a separate store (--store) for each version of ASLp.
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import asyncio
+import pathlib
+import sqlite3
+import argparse
+import itertools
+import collections
+import collections.abc
+
+import numpy as np
+
+import gts_ast
+import gts_client
+import gts_opcodes
+import gts_reader
+
+STORE_VERSION = 2
+AUX_KEYS = (gts_ast.AST_KEY, gts_ast.COMPACT_KEY)
+ISN_SIZE = gts_opcodes.ISN_SIZE
+
+# (mask, value) of the PC-relative encodings: ADR/ADRP, B/BL, B.cond and
+# BC.cond, CBZ/CBNZ, TBZ/TBNZ, load literal (including PRFM), and BLR,
+# BLRAA/BLRAB and BLRAAZ/BLRABZ, which set X30 to PC + 4.
+PC_RELATIVE = (
+  (0x1f000000, 0x10000000),
+  (0x7c000000, 0x14000000),
+  (0xff000000, 0x54000000),
+  (0x7e000000, 0x34000000),
+  (0x7e000000, 0x36000000),
+  (0x3b000000, 0x18000000),
+  (0xfffffc1f, 0xd63f0000),
+  (0xfffff800, 0xd73f0800),
+  (0xfffff81f, 0xd63f081f),
+)
+
+def default_store_path() -> pathlib.Path:
+  base = os.environ.get('XDG_CACHE_HOME') or pathlib.Path.home() / '.cache'
+  return pathlib.Path(base) / 'gtirb-semantics' / 'semantics.sqlite3'
+
+def pc_relative(ops: np.ndarray) -> np.ndarray:
+  """whether each opcode is a PC-relative instruction."""
+  ops = ops.astype(np.uint32)
+  out = np.zeros(len(ops), dtype=bool)
+  for mask, value in PC_RELATIVE:
+    out |= (ops & mask) == value
+  return out
+
+def chunks(xs: list, n: int) -> collections.abc.Iterator[list]:
+  for i in range(0, len(xs), n):
+    yield xs[i:i+n]
+
+class Store:
+  """
+  an opcode -> semantics store in an sqlite database. see the module
+  docstring for how entries are keyed.
+  """
+
+  def __init__(self, path: pathlib.Path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    self.path = path
+    self.db = sqlite3.connect(path)
+    with self.db:
+      self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+      version = self.db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+      if version and version[0] != STORE_VERSION:
+        raise ValueError(f'{path} has store version {version[0]}, expected {STORE_VERSION}. delete it to rebuild')
+      self.db.execute("INSERT OR IGNORE INTO meta VALUES ('version', ?)", (STORE_VERSION,))
+      self.db.execute('CREATE TABLE IF NOT EXISTS stmts (id INTEGER PRIMARY KEY, stmt TEXT UNIQUE)')
+      self.db.execute('CREATE TABLE IF NOT EXISTS sems (id INTEGER PRIMARY KEY, stmts TEXT UNIQUE)')
+      # sem is set once an opcode's semantics are known not to depend on the
+      # address; until then, they are in `located`. varies is 1 for opcodes
+      # whose semantics do (or may) depend on the address.
+      self.db.execute('CREATE TABLE IF NOT EXISTS opcodes '
+                      '(opcode INTEGER PRIMARY KEY, sem INTEGER, varies INTEGER, count INTEGER)')
+      self.db.execute('CREATE TABLE IF NOT EXISTS located '
+                      '(opcode INTEGER, address INTEGER, sem INTEGER, PRIMARY KEY (opcode, address)) WITHOUT ROWID')
+      self.db.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER)')
+    self._stmt_ids: dict[str, int] | None = None
+    self._sem_ids: dict[tuple[int, ...], int] | None = None
+    self._sems: dict[int, list[str]] = {}
+    self._new_stmts: list[tuple[int, str]] = []
+    self._new_sems: list[tuple[int, str]] = []
+
+  def close(self):
+    self.db.close()
+
+  def _intern(self, isn: list[str]) -> int:
+    """the id of an instruction's semantics, queueing it to be added if new."""
+    # ids are assigned here, in order, as rows are never deleted.
+    if self._stmt_ids is None or self._sem_ids is None:
+      self._stmt_ids = {s: i for i, s in self.db.execute('SELECT id, stmt FROM stmts')}
+      self._sem_ids = {tuple(json.loads(s)): i for i, s in self.db.execute('SELECT id, stmts FROM sems')}
+    ids = []
+    for s in isn:
+      i = self._stmt_ids.get(s)
+      if i is None:
+        i = self._stmt_ids[s] = len(self._stmt_ids) + 1
+        self._new_stmts.append((i, s))
+      ids.append(i)
+    key = tuple(ids)
+    sem = self._sem_ids.get(key)
+    if sem is None:
+      sem = self._sem_ids[key] = len(self._sem_ids) + 1
+      self._new_sems.append((sem, json.dumps(ids)))
+    return sem
+
+  def add(self, isns: collections.abc.Iterable[tuple[int, int, list]]) -> int:
+    """
+    adds (opcode, address, semantics) triples, returning the number of
+    opcodes which were not in the store. decode errors are skipped.
+    """
+    located: dict[int, dict[int, int]] = collections.defaultdict(dict)
+    counts: collections.Counter[int] = collections.Counter()
+    try:
+      with self.db:
+        for op, addr, isn in isns:
+          if isinstance(isn, dict): continue
+          located[op][addr] = self._intern(isn)
+          counts[op] += 1
+        self.db.executemany('INSERT INTO stmts VALUES (?, ?)', self._new_stmts)
+        self.db.executemany('INSERT INTO sems VALUES (?, ?)', self._new_sems)
+
+        ops = list(located)
+        relative = dict(zip(ops, pc_relative(np.array(ops, dtype=np.uint32)).tolist()))
+        old = {}
+        for x in chunks(ops, 500):
+          q = 'SELECT opcode, sem, varies, count FROM opcodes WHERE opcode IN ({})'.format(','.join('?' * len(x)))
+          old |= {op: (sem, varies, count) for op, sem, varies, count in self.db.execute(q, x)}
+        # the addresses of opcodes seen at only one address so far.
+        pending = [op for op, (sem, varies, _) in old.items() if sem is None and not varies]
+        prior: dict[int, dict[int, int]] = collections.defaultdict(dict)
+        for x in chunks(pending, 500):
+          q = 'SELECT opcode, address, sem FROM located WHERE opcode IN ({})'.format(','.join('?' * len(x)))
+          for op, addr, sem in self.db.execute(q, x):
+            prior[op][addr] = sem
+
+        rows = []
+        by_address = []
+        promoted = []
+        for op, addrs in located.items():
+          sem, varies, count = old.get(op, (None, 0, 0))
+          count += counts[op]
+          if sem is not None:
+            if set(addrs.values()) == {sem}:
+              rows.append((op, sem, 0, count))
+              continue
+            # earlier addresses of the opcode are not kept, so lookups there miss.
+            sem, varies = None, 1
+          seen = prior[op] | addrs
+          sems = set(seen.values())
+          varies = varies or relative[op] or len(sems) > 1
+          if not varies and len(seen) > 1:
+            rows.append((op, sems.pop(), 0, count))
+            promoted.append((op,))
+          else:
+            rows.append((op, None, int(varies), count))
+            by_address += [(op, addr, s) for addr, s in addrs.items()]
+        self.db.executemany('INSERT OR REPLACE INTO opcodes VALUES (?, ?, ?, ?)', rows)
+        self.db.executemany('INSERT OR REPLACE INTO located VALUES (?, ?, ?)', by_address)
+        self.db.executemany('DELETE FROM located WHERE opcode = ?', promoted)
+    except BaseException:
+      # the ids interned since the transaction began were rolled back.
+      self._stmt_ids = self._sem_ids = None
+      raise
+    finally:
+      self._new_stmts.clear()
+      self._new_sems.clear()
+    return sum(1 for op in located if op not in old)
+
+  def _decode(self, sem_ids: collections.abc.Iterable[int]) -> dict[int, list[str]]:
+    missing = list({i for i in sem_ids if i not in self._sems})
+    rows = []
+    for x in chunks(missing, 500):
+      q = 'SELECT id, stmts FROM sems WHERE id IN ({})'.format(','.join('?' * len(x)))
+      rows += [(i, json.loads(s)) for i, s in self.db.execute(q, x)]
+    stmt_ids = list({s for _, ids in rows for s in ids})
+    stmts = {}
+    for x in chunks(stmt_ids, 500):
+      q = 'SELECT id, stmt FROM stmts WHERE id IN ({})'.format(','.join('?' * len(x)))
+      stmts |= dict(self.db.execute(q, x))
+    for i, ids in rows:
+      self._sems[i] = [stmts[s] for s in ids]
+    return self._sems
+
+  def get(self, isns: collections.abc.Sequence[tuple[int, int]]) -> list[list[str] | None]:
+    """the semantics of each (opcode, address) pair, or None if it is not stored."""
+    ops = list({op for op, _ in isns})
+    generic = {}
+    for x in chunks(ops, 500):
+      q = 'SELECT opcode, sem FROM opcodes WHERE opcode IN ({})'.format(','.join('?' * len(x)))
+      generic |= dict(self.db.execute(q, x))
+    varying = [op for op, sem in generic.items() if sem is None]
+    located = {}
+    for x in chunks(varying, 500):
+      q = 'SELECT opcode, address, sem FROM located WHERE opcode IN ({})'.format(','.join('?' * len(x)))
+      located |= {(op, addr): sem for op, addr, sem in self.db.execute(q, x)}
+
+    ids = [generic.get(op) or located.get((op, addr)) for op, addr in isns]
+    sems = self._decode(i for i in ids if i is not None)
+    return [None if i is None else sems[i] for i in ids]
+
+  def top(self, n: int) -> list[int]:
+    """the n most common opcodes whose semantics do not depend on the address (all if n is 0)."""
+    q = 'SELECT opcode FROM opcodes WHERE sem IS NOT NULL ORDER BY count DESC' + (' LIMIT ?' if n else '')
+    return [op for op, in self.db.execute(q, (n,) if n else ())]
+
+  def stats(self) -> dict[str, int]:
+    one = lambda q: self.db.execute(q).fetchone()[0]
+    return {
+      'opcodes': one('SELECT COUNT(*) FROM opcodes WHERE sem IS NOT NULL'),
+      'located': one('SELECT COUNT(*) FROM located'),
+      'instructions': one('SELECT COUNT(*) FROM sems'),
+      'statements': one('SELECT COUNT(*) FROM stmts'),
+      'files': one('SELECT COUNT(*) FROM files'),
+    }
+
+  def harvested(self, path: pathlib.Path) -> bool:
+    """whether the file has been harvested since it last changed."""
+    st = path.stat()
+    row = self.db.execute('SELECT size, mtime FROM files WHERE path = ?', (str(path.resolve()),)).fetchone()
+    return row == (st.st_size, st.st_mtime_ns)
+
+  def mark_harvested(self, path: pathlib.Path):
+    st = path.stat()
+    with self.db:
+      self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?)', (str(path.resolve()), st.st_size, st.st_mtime_ns))
+
+def block_isns(blk: gts_reader.CodeBlock, byte_order: str) -> list[tuple[int, int]]:
+  """(opcode, address) of each instruction of a code block."""
+  words = gts_opcodes.block_words(blk, byte_order).tolist()
+  return [(op, blk.address + i * ISN_SIZE) for i, op in enumerate(words)]
+
+def module_semantics(mod: gts_reader.Module) -> collections.abc.Iterator[tuple[int, int, list]]:
+  """(opcode, address, semantics) of each lifted instruction of a module."""
+  try:
+    sems = gts_ast.semantics(mod)
+  except KeyError:
+    return
+  for blk in mod.code_blocks:
+    isns = sems.get(base64.b64encode(blk.uuid).decode('ascii'))
+    if isns is None or blk.address is None: continue
+    for (op, addr), isn in zip(block_isns(blk, mod.byte_order), isns):
+      yield op, addr, isn
+
+def harvest_files(paths: list[str], pattern: str) -> list[pathlib.Path]:
+  out = []
+  for p in map(pathlib.Path, paths):
+    out += sorted(x for x in p.rglob(pattern) if x.is_file()) if p.is_dir() else [p]
+  return out
+
+def do_harvest(store: Store, args) -> int:
+  errors = added = skipped = 0
+  files = harvest_files(args.inputs, args.pattern)
+  for path in files:
+    try:
+      if not args.force and store.harvested(path):
+        skipped += 1
+        continue
+      ir = gts_reader.load(path, AUX_KEYS)
+      n = sum(store.add(module_semantics(mod)) for mod in ir.modules)
+      store.mark_harvested(path)
+    except Exception as e:
+      print(f'{path}: error: {e}', file=sys.stderr)
+      errors += 1
+      continue
+    added += n
+    print(f'{path}: {n} new opcodes', file=sys.stderr)
+  stats = store.stats()
+  print(f'harvested {len(files) - skipped - errors} files ({skipped} unchanged, {errors} failed), '
+        f'{added} new opcodes; the store has {stats["opcodes"]} opcodes and {stats["located"]} '
+        f'located instructions', file=sys.stderr)
+  return 2 if errors else 0
+
+def do_lookup(store: Store, args) -> int:
+  isns = [gts_client.parse_opcode(s) for s in args.opcodes]
+  json.dump(store.get(isns), sys.stdout, indent=2)
+  sys.stdout.write('\n')
+  return 0
+
+async def lift_missing(args, isns: list[tuple[int, int]]) -> list:
+  async with gts_client.Client(args.socket, args.connections) as c:
+    parts = await c.lift_many(chunks(isns, args.batch_size))
+  return list(itertools.chain.from_iterable(parts))
+
+def do_lift(store: Store, args) -> int:
+  data = gts_reader.map_file(args.input)
+  ir = gts_reader.parse(data, ())
+
+  tables = []
+  hits = total = 0
+  for mod in ir.modules:
+    blocks = [blk for blk in mod.code_blocks if blk.address is not None]
+    isns = [block_isns(blk, mod.byte_order) for blk in blocks]
+    flat = list(itertools.chain.from_iterable(isns))
+    sems = store.get(flat)
+    missing = [i for i, s in enumerate(sems) if s is None]
+    hits += len(flat) - len(missing)
+    total += len(flat)
+
+    if missing:
+      try:
+        lifted = asyncio.run(lift_missing(args, [flat[i] for i in missing]))
+      except OSError as e:
+        print(f'error: {len(missing)} instructions are not in the store, '
+              f'and the server at {args.socket} is unavailable: {e}', file=sys.stderr)
+        return 1
+      except gts_client.ServerError as e:
+        print(f'error: {e}', file=sys.stderr)
+        return 1
+      for i, s in zip(missing, lifted):
+        sems[i] = s
+      if not args.no_update:
+        store.add((*flat[i], s) for i, s in zip(missing, lifted))
+
+    table = {}
+    i = 0
+    for blk, ops in zip(blocks, isns):
+      table[base64.b64encode(blk.uuid).decode('ascii')] = sems[i:i+len(ops)]
+      i += len(ops)
+    tables.append(table)
+
+  mods = iter(tables)
+  def update(aux: dict[str, gts_reader.AuxData]) -> dict[str, gts_reader.AuxData]:
+    sems = next(mods)
+    for key in AUX_KEYS:
+      aux.pop(key, None)
+    if args.compact:
+      aux[gts_ast.COMPACT_KEY] = gts_reader.AuxData(gts_ast.COMPACT_KEY, gts_ast.dumps(gts_ast.compact(sems)))
+    else:
+      aux[gts_ast.AST_KEY] = gts_reader.AuxData(gts_ast.AST_KEY, gts_ast.dumps(sems))
+    return aux
+
+  out = gts_ast.rewrite_aux_data(data, update)
+  with open(args.output, 'wb') as f:
+    # gtirb_semantics writes .gts files without the magic.
+    f.write(gts_reader.strip_magic(out))
+  rate = hits / total if total else 1.0
+  print(f'{args.output}: {hits} of {total} instructions from the store ({rate:f} hit rate)', file=sys.stderr)
+  return 0
+
+def do_prewarm(store: Store, args) -> int:
+  ops = store.top(args.top)
+  start = time.perf_counter()
+  try:
+    sems = asyncio.run(lift_missing(args, [(op, 0) for op in ops]))
+  except OSError as e:
+    print(f'error: the server at {args.socket} is unavailable: {e}', file=sys.stderr)
+    return 1
+  except gts_client.ServerError as e:
+    print(f'error: {e}', file=sys.stderr)
+    return 1
+  errors = sum(1 for s in sems if isinstance(s, dict))
+  print(f'lifted {len(ops)} opcodes in {time.perf_counter() - start:.2f}s ({errors} decode errors)', file=sys.stderr)
+  return 0
+
+def main():
+  argp = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  argp.add_argument('--store', type=pathlib.Path, default=default_store_path(), help='store database')
+  sub = argp.add_subparsers(dest='cmd', required=True)
+
+  h = sub.add_parser('harvest', help='add the semantics of .gts files to the store')
+  h.add_argument('inputs', nargs='+', metavar='FILE_OR_DIR', help='.gts files, or directories of them')
+  h.add_argument('--pattern', default='*.gts', help='file pattern matched in directories')
+  h.add_argument('--force', action='store_true', help='harvest files even if unchanged since last harvested')
+
+  l = sub.add_parser('lookup', help='print the stored semantics of opcodes as JSON (null if not stored)')
+  l.add_argument('opcodes', nargs='+', help='hex instruction word, optionally @ADDRESS (e.g. d503201f@0x400000)')
+
+  server = argparse.ArgumentParser(add_help=False)
+  server.add_argument('--socket', default=gts_client.default_socket(), help=f'server socket (${gts_client.SOCKET_ENV})')
+  server.add_argument('--connections', type=int, default=4, help='number of pooled connections')
+  server.add_argument('--batch-size', type=int, default=4096, help='instructions per lift request')
+
+  f = sub.add_parser('lift', parents=[server], formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                     help='lift a .gtirb file from the store, and the server for instructions not stored')
+  f.add_argument('input', help='.gtirb input file')
+  f.add_argument('output', help='.gts output file')
+  f.add_argument('--compact', action='store_true', help=f'write semantics as `{gts_ast.COMPACT_KEY}`')
+  f.add_argument('--no-update', action='store_true', help='do not add the semantics lifted by the server to the store')
+
+  p = sub.add_parser('prewarm', parents=[server], formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                     help="have a server lift the most common stored opcodes, warming its cache")
+  p.add_argument('--top', type=int, default=0, help='number of opcodes to lift (0 for all)')
+
+  args = argp.parse_args()
+  store = Store(args.store)
+  try:
+    return {'harvest': do_harvest, 'lookup': do_lookup, 'lift': do_lift, 'prewarm': do_prewarm}[args.cmd](store, args)
+  finally:
+    store.close()
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -4,54 +4,52 @@
 # /// script
 # requires-python = ">=3.11"
 # dependencies = [
-#   "gtirb~=2.0.0",
+#   "protobuf",
 # ]
 # ///
 
+# Requirements:
+#  protobuf
+#  gtirb (only for --auxdata)
+# gts_reader.py, gts_profile.py, gts_sources.py and gtirb_fdset.py are
+# imported from beside this script, so it must stay in scripts/ with them.
+
 import google.protobuf.message_factory
 import google.protobuf.descriptor_pool
 import google.protobuf.descriptor_pb2
 import google.protobuf.json_format
 import google.protobuf.descriptor
 import google.protobuf.message
+import concurrent.futures
+import collections.abc
+import dataclasses
 import subprocess
 import argparse
 import tempfile
 import logging
+import hashlib
 import pathlib
 import typing
 import base64
+import shutil
 import shlex
 import uuid
 import json
-import zlib
+import time
+import math
 import sys
+import os
 
-'''
-to generate GTIRB_FDSET:
-  protoc --include_imports -o /dev/stdout -I lib lib/*.proto | python3 -c 'import sys,zlib,base64,pprint; d=sys.stdin.buffer.read(); pprint.pprint(base64.b64encode(zlib.compress(d)), width=160)'
-'''
-GTIRB_FDSET = \
-(b'eJy1GMuOI0lx7fIz/MqunofXLOqhJQS0htG2Z3d2tQgJv7rb4B5b6R5mblbZle0uTdllVZVX3Wi1EhJCcOGE4MpzgQtCnHhJXLlw4P1+LSCxEgfEFxCRWeV2dddIvnDockRkRGRkRGREZMObUGosz9uGb9xb'
- b'uI7v6IWpb7ljhey+BtlgVX8X5P2LhRjNjZmoJu4k3p/nOSI8RFzXIWUiUzWJ9CKXcPMFqE2c2b2pa8xmhi8mZ/fWNI8z8uc+/CcBlZZjiqbtTJ7GmfAG5FfrtM9yaZlyf9yHYKJ51idEVUNaiktYfxUKppig'
- b'2GiGn2oKl8r12+sG3GvL9WP842Cu4I+mckmm8axhmq7wvL27AJeMegUKDdsetcWpsbR99pxegnyDH49OzpazMUtseOTP4JHJpc88chPyq/VNj3zF8A1N+TFAdXgxGzu2NemcL0jScuZxNh1BCRmHvjF52nLm'
- b'nq/fgoxzeuoJX1qW5gGm70DBkxpH0myVEaBIj5CyewhF1NRAO+MUaZsr+mQCCoEm+tNvQNqbGLYI9ChkTX0yov49UFS69pV+TeoPttynDS5Z6ooltc5Slza8kwD9ugP11wAoEKMJnVBuXKg/H0m/dRccPcfz'
- b'xsofr4BERvSRVhXq1ThR+kPJnBGevwkVw/dda7z0xejUNqYeWqxh4l/fOWTj5ZXEAQk0s5B+3bCXlE4JlsSzUsDVMfb+nVaRCyX0LGiH/RO8BnlIIzBosYQOkEGwf3DAkgHMOz2mEe+gd8JSRESAGNIkN2jR'
- b'eobIw46Es8R70huyHK0jcNhm+QDstRkQqwSPWUEvQBbhVqPXY8UAaXeGLVaSAgPSV1Yg7Vgh2bYiswAm+hbBDxWsB/Tjfptt6zlIDRqHHXaDlBNELDeJLPe8pWcg2euz2/R71GVVEj7qHh51OHueRCQ8PGE1'
- b'vQx5dEawyb+yhHcftgP8HTp08vBF9rOKBPbZzxVQZ79QwH32y4pehOyjwaDD9x+wX0ms138ssV9X8JCpXn+/zn4Tgi+z34bgS+x3EjzqIsPvA7C+z/5QQbsTQ/ZHucfgkP1JAg9b7M8VPKPWaA7ZXyS7dNlf'
- b'K3ikDIH399nfpAEnDX7YOdlnb69hdfZ3cnR62CShf0ghGbA++2doxgP2vduBcQ/Y928T+6Hc4weS3O4OB+yHEuwfoPt+RA5OHLEv7dBvj315h+w8arCv7CiFh0fsqzukhcAG+9oOmaMC0WBf38FCnQtC0WBv'
- b'ycWTfqvZGHbYN3bopIixb0oFD/sEf2tnwwr6hTTozQtfdOe+cPHqxNTO2tUGV7ta/mvPLMK7n0pAWjWCaJ1MrQrZXUhRgwqqzK3IXV9tjIVCchG37NRaDPfKKuKWPTwsB7uf1aC4fszYtrQHmTGJe2iLhtr1'
- b'iHapmQccuoAbXnDmkVgd2kO7SLIelVz373VPeZ25717wbe/6CjWRM8MbBV1RVvAcByQ1FEWvQtgyq2np1hBdNdnM2lxRgxzWQl/Mfa+alSdf4bVpXCtVtukMtKfiIggcgfrLgWeDsO1cLdFX9HDF/Vry1U2n'
- b'jC+mcHA6OIzr5QvId8yp6BljYet3oIBHMC0fdzFsaWKOr5Mo8UzLFRPVyHI8wPQPQIoGQJlK5frNyAlI/wkucsmy+/kEpIgkm7qzdCditJY9oEiy5yKDb7hT4Ue6viJJhruQtslwGa6rGbw6FldM2MY0lsJv'
- b'iqV5duw4tjDmPGthyKbC3X0CGrqIovq6cH1rIlT+YVRDXH8fpAUqDVN669p2XK0HDTNI7z0fcqELaGqk31HTNeaTMzU1SkLLsG1smTeASfQAUf/MdZbTM2yeoRQX/tKdYwdlUJSE4QUNNja20pAFKa7wWXrD'
- b'zJgCG7jO+cUz5887AJcMcTd9w43e0nBoxEyJHylrMXVz96cJyAYiz5p85QMkKR8gEtY/AuUxahpZgSq6ydq1gWt9M14ar2Ge/mEoeWrTYG7KyLnpytilOGhO4kXvEvGiSRaUD1Uw9t7EEfWSVb8JWwE6ejQ3'
- b'xak1FyYmRBFyXBimMbYF5gNij13Ll1gS5wTonIvJUuEaDRg9xzBRTiZAd47X1LBxLxMHKsqIMxdV9RzMEZbZMFD/TcjJDmtOXDp8O4GzmVyNDcmt9UqWwtahUP29UHLFqXCxOKq7TBe2iOvFkPxoPaLaWkRv'
- b'QsbwR2JuyuKb42nD78zNpg7MWaiiNFoYFza6IfB60fMd15iK0VNrvml2fjcPRXzVLW0Rl5zRV3Ht2o2pRTO7FvHf7ttpyCjdsS7DIje25oZ7gcfwz4JkBkUaIAV9V15IL7nCvHwIpHhpRZUTPz5QXDE2PDEy'
- b'hY1NPSVfOAVFaxOJXsKnlo3vAcdFX8gYXH0JH+D6gVzmcLqC9V3QLM+QESjXWUSiO2xwWlwFL7sWvA9CVnVir5qX93A7prfxkEffhywunFtYYplkjxp36Xce8ukvQi64f161KGVuxN1UvuLSPwQ5Y3k+kpPP'
- b'lpS4E5EI8iCIuZonskbwnw+MliDKaOFgianqqiVJ0oAo2MtBFiDHNYVb3ZYOu3Wt+PRplefHIVgbQHF9w/UhIa+GhL3okBA9ZSC7NhngZcixPH6BFfBbYEX8llgZv2VWwW+FMV62ZnRRpMEzY6EGPb61Gsac'
- b'hcA+ZXpcDz1Gzz/fwFLlhu2Na5PT6d4bAJepQ11MQZHKRg8leuAk6FHX6dGrEF9Kgw4WMixsXdPA+LbH9+tYzNbwBy+px+ETKZsh8LjROuqrtyFvPGa5vU8nQMM81LeghD9XN+02UGdCPjAHLQSTJPgE9cqX'
- b'aIMf44a3YfvjWDnN5tJ/NPeWi4Xj+rKKKilkljsjM4JZKrzH3cEQleVCGOn5vQ7kV+ElnSskYhP2/KY1xSpmGXM0DJt5z/J9WwSU5IZF6zsa5Lp8g4J1OfvVIlVu9ydJSHZ5bFnCmzuTrOEYvh1zSXjIo7+y'
- b'dqlUx30hWiX4My4Uztw4X9FYK6tLiYco1RzMLFlOCldqDp5Hpt3/5dokmRZ0kozssx4vzzDjR+qoI8uMuw0bhuxz2Fz78qkW11w/Bhm1qL8bQNhiRu1yFZd8QOma6JqiaXkL25hIiuq2PELbzKD/AWGON5k=')
+try:
+  import gts_reader
+  import gts_profile
+  import gts_sources
+  from gtirb_fdset import gtirb_fdset_bytes
+except ModuleNotFoundError as e:
+  if e.name in ('gts_reader', 'gts_profile', 'gts_sources', 'gtirb_fdset'):
+    print(f'ERROR: {e.name}.py not found. proto-json.py imports it from the gtirb-semantics scripts/ '
+          'directory, so it must be run from there rather than copied elsewhere.', file=sys.stderr)
+  raise
 
 log = logging.getLogger(__name__)
 
@@ -61,28 +59,498 @@ def die(*args) -> typing.NoReturn:
   log.error(' ' + ' '.join(map(str,args)))
   sys.exit(1)
 
+def proto_cache_dir() -> pathlib.Path:
+  base = os.environ.get('XDG_CACHE_HOME') or pathlib.Path.home() / '.cache'
+  return pathlib.Path(base) / 'gtirb-semantics' / 'proto-json'
+
+def protos_key(protodir: pathlib.Path, protos: list[pathlib.Path], protoc: str) -> str:
+  """
+  hashes the .proto files' names and contents, along with the identity of the
+  protoc binary. the binary is identified by its path, size and mtime, to
+  avoid running protoc just to ask its version.
+  """
+  h = hashlib.sha256()
+  st = os.stat(protoc)
+  h.update(f'{os.path.realpath(protoc)}\0{st.st_size}\0{st.st_mtime_ns}\0'.encode('utf-8'))
+  for p in sorted(protos):
+    h.update(str(p.relative_to(protodir)).encode('utf-8') + b'\0')
+    h.update(p.read_bytes() + b'\0')
+  return h.hexdigest()
+
+def compile_protos(protodir: pathlib.Path, cachedir: pathlib.Path | None) -> bytes:
+  """
+  compiles the .proto files in protodir to a serialised FileDescriptorSet.
+  if cachedir is given, the result is cached there by the hash of the
+  inputs so repeated runs skip protoc.
+  """
+  protoc = shutil.which('protoc')
+  if not protoc:
+    die("could not find protoc in PATH")
+  protos = sorted(protodir.glob('**/*.proto'))
+
+  cached = None
+  if cachedir:
+    cached = cachedir / (protos_key(protodir, protos, protoc) + '.fdset')
+    try:
+      data = cached.read_bytes()
+      debug('using cached fdset:', cached)
+      return data
+    except FileNotFoundError:
+      pass
+
+  with tempfile.TemporaryDirectory(prefix='proto_to_json.') as tmpdir:
+    tmpdir = pathlib.Path(tmpdir)
+    fdsetfile = tmpdir / 'fdset'
+    debug('tmpdir:', tmpdir)
+    cmd = \
+      [protoc,  '--include_imports', '-I', protodir, '-o', fdsetfile] + \
+      list(map(str, protos))
+    debug('subprocess:', *(shlex.quote(str(x)) for x in cmd))
+    subprocess.check_call(cmd, stdout=subprocess.DEVNULL)
+
+    with open(fdsetfile, 'rb') as f:
+      data = f.read()
+
+  if cached:
+    try:
+      cached.parent.mkdir(parents=True, exist_ok=True)
+      tmp = cached.with_suffix(f'.{os.getpid()}.tmp')
+      tmp.write_bytes(data)
+      os.replace(tmp, cached)
+    except OSError as e:
+      log.warning(f"could not write fdset cache {str(cached)!r}: {e}")
+  return data
+
+def auxdata_to_json(x):
+  """
+  converts a value decoded by gtirb's Serialization into JSON-compatible types.
+  requires the `gtirb` python package.
+  """
+  import gtirb
+
+  def process_keys(x):
+    if isinstance(x, tuple):
+      return str(tuple(process_keys(y) for y in x))
+    else:
+      return process_auxdata(x)
+
+  def process_auxdata(x):
+    if isinstance(x, bytes):
+      try:
+        return json.loads(x.decode('ascii'))
+      except Exception:
+        return str(x)
+    elif isinstance(x, list):
+      return [process_auxdata(y) for y in x]
+    elif isinstance(x, dict):
+      return dict((process_keys(k), process_auxdata(v)) for k,v in x.items())
+    elif isinstance(x, uuid.UUID):
+      return base64.b64encode(x.bytes).decode('ascii')
+    elif isinstance(x, gtirb.offset.Offset):
+      return str(x)
+    elif x is None or isinstance(x, (str, int, float, bool, bytes)):
+      return x
+    elif isinstance(x, tuple):
+      return tuple(process_auxdata(y) for y in x)
+    elif isinstance(x, set):
+      return [process_auxdata(y) for y in x]
+    else:
+      assert False, "unsup type " + repr(x)
+
+  return process_auxdata(x)
+
+_serialization = None
+
+def decode_auxdata_table(type_name: str, data: bytes) -> dict:
+  """decodes one AuxData table. this is run within the worker processes."""
+  global _serialization
+  if _serialization is None:
+    import gtirb
+    _serialization = gtirb.serialization.Serialization()
+  return {
+    'type_name': type_name,
+    '_decoded': auxdata_to_json(_serialization.decode(data, type_name)),
+  }
+
+def is_auxdata_dict(x) -> bool:
+  return isinstance(x, dict) and set(x.keys()) == {'type_name', 'data'}
+
+class AuxDataDecoder:
+  """
+  decodes GTIRB AuxData tables, optionally only those with the given keys.
+  with jobs > 1, tables are decoded concurrently across a process pool.
+  tables are identified by their contents, so identical tables (e.g. the
+  same table in two modules) are decoded once.
+  """
+
+  def __init__(self, keys: collections.abc.Collection[str] | None = None, jobs: int = 1):
+    self.keys = keys
+    self.pool = concurrent.futures.ProcessPoolExecutor(jobs) if jobs > 1 else None
+    self.futures: dict[tuple[str, bytes], concurrent.futures.Future | dict] = {}
+
+  def wanted(self, key: str) -> bool:
+    return self.keys is None or key in self.keys
+
+  def submit(self, type_name: str, data: bytes) -> tuple[str, bytes]:
+    k = (type_name, hashlib.sha1(data).digest())
+    if k not in self.futures:
+      if self.pool:
+        self.futures[k] = self.pool.submit(decode_auxdata_table, type_name, bytes(data))
+      else:
+        self.futures[k] = decode_auxdata_table(type_name, bytes(data))
+    return k
+
+  def result(self, type_name: str, data: bytes) -> dict:
+    x = self.futures[self.submit(type_name, data)]
+    return x.result() if isinstance(x, concurrent.futures.Future) else x
+
+  def prefetch(self, message):
+    """starts decoding the wanted tables of a gtirb.proto.IR message."""
+    if message.DESCRIPTOR.full_name != 'gtirb.proto.IR' or not self.pool: return
+    for table in [message.aux_data] + [m.aux_data for m in message.modules]:
+      for k, v in table.items():
+        if self.wanted(k):
+          self.submit(v.type_name, v.data)
+
+  def decode_tree(self, msgdict):
+    """decodes, in place, the wanted tables of a message_to_dict() tree."""
+    tables = []
+    def walk(x):
+      if isinstance(x, dict):
+        for k, v in x.items():
+          if is_auxdata_dict(v):
+            if self.wanted(k):
+              tables.append((x, k, base64.b64decode(v['data'])))
+          else:
+            walk(v)
+      elif isinstance(x, list):
+        for v in x: walk(v)
+    walk(msgdict)
+
+    for parent, k, data in tables:
+      self.submit(parent[k]['type_name'], data)
+    for parent, k, data in tables:
+      parent[k] = self.result(parent[k]['type_name'], data)
+    return msgdict
+
+  def close(self):
+    if self.pool:
+      self.pool.shutdown()
+
+def message_to_dict(message) -> dict:
+  # see: https://github.com/protocolbuffers/protobuf/blob/main/python/google/protobuf/json_format.py
+  # and: https://protobuf.dev/programming-guides/proto3/#json
+  return google.protobuf.json_format.MessageToDict(
+    message,
+    always_print_fields_with_no_presence=True,
+    preserving_proto_field_name=True
+  )
+
+FieldDescriptor = google.protobuf.descriptor.FieldDescriptor
+INT64_TYPES = (FieldDescriptor.CPPTYPE_INT64, FieldDescriptor.CPPTYPE_UINT64)
+CONTENTS_FIELD = 'gtirb.proto.ByteInterval.contents'
+MODULES_FIELD = 'gtirb.proto.IR.modules'
+
+def is_repeated(f) -> bool:
+  # FieldDescriptor.label is removed in newer protobuf versions.
+  if hasattr(f, 'is_repeated'):
+    return f.is_repeated
+  return f.label == FieldDescriptor.LABEL_REPEATED
+
+class JsonStreamWriter:
+  """
+  writes a message as JSON while walking it, producing the same text as
+  json.dumps(message_to_dict(message), indent=2, sort_keys=True) without
+  building the dictionary or the output string in memory.
+
+  byte interval contents can be inlined as base64 (as message_to_dict does),
+  omitted, or written to a sidecar binary file and referenced by offset.
+  """
+
+  def __init__(self, out: typing.BinaryIO, contents: str = 'inline',
+               sidecar: typing.BinaryIO | None = None, sidecar_name: str = '',
+               auxdata: AuxDataDecoder | None = None):
+    assert contents != 'sidecar' or sidecar
+    self.out = out
+    self.contents = contents
+    self.sidecar = sidecar
+    self.sidecar_name = sidecar_name
+    self.sidecar_offset = 0
+    self.auxdata = auxdata
+    self.buf: list[str] = []
+    self.buflen = 0
+
+  def write(self, s: str):
+    self.buf.append(s)
+    self.buflen += len(s)
+    if self.buflen >= 1 << 16:
+      self.flush()
+
+  def flush(self):
+    self.out.write(''.join(self.buf).encode('utf-8'))
+    self.buf.clear()
+    self.buflen = 0
+
+  def subtree(self, x, indent: str):
+    self.write(json.dumps(x, indent=2, sort_keys=True, default=str).replace('\n', '\n' + indent))
+
+  def message(self, msg, indent: str = ''):
+    name = msg.DESCRIPTOR.full_name
+    if name.startswith('google.protobuf.'):
+      # well-known types have special JSON forms, so these are converted as a whole.
+      self.subtree(message_to_dict(msg), indent)
+      return
+
+    fields = {f.name: (f, v) for f, v in msg.ListFields()}
+    for f in msg.DESCRIPTOR.fields:
+      if f.name not in fields and not f.has_presence:
+        fields[f.name] = (f, None)
+
+    if not fields:
+      self.write('{}')
+      return
+    inner = indent + '  '
+    for i, k in enumerate(sorted(fields)):
+      self.write((',\n' if i else '{\n') + inner + json.dumps(k) + ': ')
+      self.field(*fields[k], inner)
+    self.write('\n' + indent + '}')
+
+  def field(self, f, v, indent: str):
+    inner = indent + '  '
+    if f.message_type and f.message_type.GetOptions().map_entry:
+      vf = f.message_type.fields_by_name['value']
+      items = sorted((('true' if k else 'false') if isinstance(k, bool) else str(k), v[k]) for k in v or ())
+      if not items:
+        self.write('{}')
+        return
+      is_aux = self.auxdata and vf.message_type and vf.message_type.full_name == 'gtirb.proto.AuxData'
+      for i, (k, x) in enumerate(items):
+        self.write((',\n' if i else '{\n') + inner + json.dumps(k) + ': ')
+        if is_aux and self.auxdata.wanted(k):
+          self.subtree(self.auxdata.result(x.type_name, x.data), inner)
+        else:
+          self.value(vf, x, inner)
+      self.write('\n' + indent + '}')
+    elif is_repeated(f):
+      if not v:
+        self.write('[]')
+        return
+      per_module = f.full_name == MODULES_FIELD
+      for i, x in enumerate(v):
+        self.write((',\n' if i else '[\n') + inner)
+        if per_module:
+          with gts_profile.phase('write module', module=x.name):
+            self.value(f, x, inner)
+        else:
+          self.value(f, x, inner)
+      self.write('\n' + indent + ']')
+    else:
+      self.value(f, f.default_value if v is None else v, indent)
+
+  def value(self, f, v, indent: str):
+    if f.cpp_type == FieldDescriptor.CPPTYPE_MESSAGE:
+      self.message(v, indent)
+    elif f.full_name == CONTENTS_FIELD and self.contents == 'omit':
+      self.subtree({'omitted': True, 'size': len(v)}, indent)
+    elif f.full_name == CONTENTS_FIELD and self.contents == 'sidecar':
+      assert self.sidecar
+      self.sidecar.write(v)
+      self.subtree({'file': self.sidecar_name, 'offset': self.sidecar_offset, 'size': len(v)}, indent)
+      self.sidecar_offset += len(v)
+    elif f.cpp_type == FieldDescriptor.CPPTYPE_ENUM:
+      e = f.enum_type.values_by_number.get(v)
+      self.write(json.dumps(e.name if e else v))
+    elif f.type == FieldDescriptor.TYPE_BYTES:
+      self.write(json.dumps(base64.b64encode(v).decode('utf-8')))
+    elif f.cpp_type in INT64_TYPES:
+      self.write(json.dumps(str(v)))
+    elif f.cpp_type in (FieldDescriptor.CPPTYPE_FLOAT, FieldDescriptor.CPPTYPE_DOUBLE) and not math.isfinite(v):
+      self.write(json.dumps('NaN' if math.isnan(v) else 'Infinity' if v > 0 else '-Infinity'))
+    else:
+      self.write(json.dumps(v))
+
+@dataclasses.dataclass
+class Options:
+  """conversion settings, shared by single-file and --batch conversion."""
+  fr: str
+  to: str
+  idem: str | None
+  seek: int
+  detect_magic: bool  # whether to skip a GTIRB magic prefix, if present, instead of seek
+  stream: bool
+  contents: str
+  contents_file: pathlib.Path | None
+  auxdata: bool
+  auxdata_keys: set[str] | None
+  jobs: int
+
+def convert(opts: Options, ProtoMessage, input: typing.BinaryIO, output: typing.BinaryIO):
+  with gts_profile.phase('read'):
+    # map the input rather than reading a copy of it, where possible.
+    buf = gts_reader.map_file(input)
+    input.close()
+    seek = gts_reader.magic_size(buf) if opts.detect_magic and opts.fr == 'proto' else opts.seek
+    prefix = bytes(buf[:seek])
+    data = buf[seek:] if opts.fr == 'proto' else bytes(buf[seek:])
+  message = None
+  if opts.fr == 'proto':
+    with gts_profile.phase('protobuf parse', bytes=len(data)):
+      message = ProtoMessage().FromString(data)
+  elif opts.fr == 'json':
+    with gts_profile.phase('json parse', bytes=len(data)):
+      message = ProtoMessage()
+      message = google.protobuf.json_format.Parse(data, message)
+
+  assert message
+  if output.fileno() not in (0, 1):  # not stdin or stdout
+    output.truncate(0)
+
+  if opts.idem:
+    output.write(prefix)
+
+  auxdata = None
+  if opts.to == 'json' and opts.auxdata:
+    auxdata = AuxDataDecoder(opts.auxdata_keys, opts.jobs)
+    with gts_profile.phase('auxdata prefetch'):
+      auxdata.prefetch(message)
+
+  if opts.to == 'proto':
+    with gts_profile.phase('protobuf serialize'):
+      data = message.SerializeToString(deterministic=True)
+    with gts_profile.phase('write'):
+      output.write(data)
+  elif opts.to == 'json' and opts.stream:
+    sidecar = None
+    if opts.contents == 'sidecar':
+      assert opts.contents_file
+      sidecar = open(opts.contents_file, 'wb')
+    writer = JsonStreamWriter(output, opts.contents, sidecar, str(opts.contents_file), auxdata)
+    writer.message(message)
+    writer.flush()
+    if sidecar:
+      sidecar.close()
+  elif opts.to == 'json':
+    with gts_profile.phase('message_to_dict'):
+      msgdict = message_to_dict(message)
+
+    if auxdata:
+      with gts_profile.phase('auxdata decode'):
+        msgdict = auxdata.decode_tree(msgdict)
+
+    with gts_profile.phase('json.dumps'):
+      data = json.dumps(msgdict, indent=2, sort_keys=True, default=str)
+    with gts_profile.phase('write'):
+      output.write(data.encode('utf-8'))
+
+  if auxdata:
+    auxdata.close()
+
+# message class prepared by the parent process. this is inherited by forked
+# workers, and rebuilt by _batch_init otherwise.
+_batch_message = None
+
+def _prepare_message(fdsetdata: bytes, msgtype: str):
+  fds = google.protobuf.descriptor_pb2.FileDescriptorSet.FromString(fdsetdata)
+  msgclasses = google.protobuf.message_factory.GetMessages(fds.file)
+  return msgclasses.get(msgtype)
+
+def _batch_init(fdsetdata: bytes, msgtype: str):
+  global _batch_message
+  if _batch_message is None:
+    _batch_message = _prepare_message(fdsetdata, msgtype)
+
+def _batch_one(opts: Options, src: pathlib.Path, dst: pathlib.Path) -> tuple[float, str | None]:
+  start = time.perf_counter()
+  # written alongside dst and moved into place once complete, so a failed
+  # conversion leaves no partial output. the sidecar is named in the output,
+  # so it is written in place and removed on failure.
+  tmp = dst.with_name(dst.name + '.tmp')
+  try:
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    if opts.contents == 'sidecar':
+      opts = dataclasses.replace(opts, contents_file=pathlib.Path(str(dst) + '.contents.bin'))
+    with open(src, 'rb') as i, open(tmp, 'wb') as o:
+      convert(opts, _batch_message, i, o)
+    os.replace(tmp, dst)
+  except Exception as e:
+    tmp.unlink(missing_ok=True)
+    if opts.contents_file:
+      opts.contents_file.unlink(missing_ok=True)
+    return time.perf_counter() - start, f'{type(e).__name__}: {e}'
+  return time.perf_counter() - start, None
+
+def batch(opts: Options, fdsetdata: bytes, msgtype: str, pairs: list[tuple[pathlib.Path, pathlib.Path]],
+          outdir: pathlib.Path, suffix: str, jobs: int) -> int:
+  # auxdata is decoded within each worker, rather than by a nested pool.
+  opts = dataclasses.replace(opts, jobs=1)
+  jobs = max(1, min(jobs, len(pairs)))
+
+  failed = 0
+  start = time.perf_counter()
+  with concurrent.futures.ProcessPoolExecutor(jobs, initializer=_batch_init, initargs=(fdsetdata, msgtype)) as pool:
+    futures = {
+      pool.submit(_batch_one, opts, src, outdir / rel.with_suffix(suffix)): src
+      for src, rel in pairs
+    }
+    for fut in concurrent.futures.as_completed(futures):
+      elapsed, err = fut.result()
+      src = futures[fut]
+      if err:
+        failed += 1
+        log.error(f' {src}: {err}')
+      else:
+        debug(f'{src}: {elapsed:.3f}s')
+
+  elapsed = time.perf_counter() - start
+  print(f'converted {len(pairs) - failed}/{len(pairs)} files in {elapsed:.2f}s', file=sys.stderr)
+  return 1 if failed else 0
+
+# defaults for --proto and --msgtype, selecting the bundled GTIRB descriptors.
+_gtirb = ['__gtirb__']
+_gtirb_ir_type = 'gtirb.proto.IR'
+
 def main():
   logging.basicConfig(level=logging.WARN)
 
-  _gtirb = ['__gtirb__']
-  _gtirb_ir_type = 'gtirb.proto.IR'
-
   argp = argparse.ArgumentParser(description='protobuf <-> json converter.')
-  argp.add_argument('--seek', '-s', type=int, default=0, help='number of bytes to skip at start of input (default: 0) (note: use -s8 with .gtirb files)')
+  argp.add_argument('--seek', '-s', type=int, default=None, help='number of bytes to skip at start of input (default: the GTIRB magic prefix, if present, when converting the bundled gtirb.proto.IR, otherwise 0)')
   g = argp.add_argument_group(title="input/output settings")
   g = g.add_mutually_exclusive_group()
   g.add_argument('--from', '-i', dest='fr', choices=['json', 'proto'], default=None, help='type of input (default: proto). if given, --to is set to the other type.')
   g.add_argument('--to', '-o', choices=['json', 'proto'], default=None, help='type of output (default: json). if given, --from is set to the other type.')
   g.add_argument('--idem', choices=['json', 'proto'], default=None, help='instead of converting, perform an idempotent normalisation of the given file type')
   argp.add_argument('--proto', '-p', type=str, default=_gtirb, help='directory of .proto files (default: bundled GTIRB .proto files)')
+  argp.add_argument('--no-proto-cache', action='store_true', help='always run protoc for --proto, instead of caching the compiled descriptors (default: false)')
   argp.add_argument('--msgtype', '-m', type=str, default=_gtirb_ir_type, help='protobuf message type (default: gtirb.proto.IR)')
   argp.add_argument('--auxdata', action='store_true', help='decode GTIRB AuxData (requires `gtirb` python package) (default: false)')
+  argp.add_argument('--auxdata-keys', type=str, default=None, help='comma-separated AuxData keys to decode, e.g. functionBlocks,functionNames,ast. implies --auxdata. (default: all)')
+  argp.add_argument('--profile', metavar='TRACE_JSON', default=None, help='write per-phase timings and memory use as a Chrome trace-event file (default: none)')
+  argp.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1, help='number of processes used to decode AuxData, or to convert files with --batch (default: number of cpus)')
+  g = argp.add_argument_group(title="streaming json output")
+  g.add_argument('--stream', action='store_true', help='write json incrementally while walking the decoded message, instead of building it in memory (default: false)')
+  g.add_argument('--contents', choices=['inline', 'omit', 'sidecar'], default='inline', help='how to write byte interval contents. other than inline, implies --stream. (default: inline)')
+  g.add_argument('--contents-file', type=pathlib.Path, default=None, help='binary file for --contents sidecar (default: OUTPUT.contents.bin)')
+  g = argp.add_argument_group(title="batch conversion")
+  g.add_argument('--batch', nargs='+', metavar='SOURCE', default=None, help='convert many files in one process. each SOURCE is a file, a directory (searched recursively), a glob, or @FILE listing one path per line. input/output arguments are ignored.')
+  g.add_argument('--outdir', type=pathlib.Path, default=None, help='output directory for --batch, mirroring the layout of the inputs')
+  g.add_argument('--batch-pattern', default=None, help='file pattern for directory sources (default: *.gtirb, or *.json with --from json)')
+  g.add_argument('--batch-suffix', default=None, help='suffix of output files (default: .json, or .proto with --to proto)')
   argp.add_argument('input', nargs='?', type=argparse.FileType('rb'), default=sys.stdin.buffer, help='input file path (default: stdin)')
   argp.add_argument('output', nargs='?', type=argparse.FileType('ab+'), default=sys.stdout.buffer, help='output file path (default: stdout)')
 
   args = argp.parse_args()
   debug(args)
 
+  if args.profile:
+    gts_profile.enable()
+  try:
+    return run(args)
+  finally:
+    if args.profile:
+      gts_profile.write(args.profile)
+      print(f'wrote profile to {args.profile}', file=sys.stderr)
+
+def run(args) -> int:
   def other(a: str):
     if a == 'json': return 'proto'
     if a == 'proto': return 'json'
@@ -97,118 +565,61 @@ def main():
   else:
     args.fr, args.to = 'proto', 'json'
 
+  if args.contents != 'inline':
+    args.stream = True
+  if args.stream and args.to != 'json':
+    die("--stream and --contents are only supported with json output")
+  if args.batch and not args.outdir:
+    die("--batch requires --outdir")
+  if args.contents == 'sidecar' and not args.contents_file and not args.batch:
+    if args.output.fileno() in (0, 1):
+      die("--contents sidecar writing to stdout requires --contents-file")
+    args.contents_file = pathlib.Path(args.output.name + '.contents.bin')
+
+  if args.auxdata_keys is not None:
+    args.auxdata = True
+
   if args.auxdata and args.proto != _gtirb:
     log.warning("using --auxdata with non-default protobuf spec may behave unexpectedly")
 
   if args.proto == _gtirb:
-    fdsetdata = zlib.decompress(base64.b64decode(GTIRB_FDSET))
+    fdsetdata = gtirb_fdset_bytes()
   else:
     args.proto = pathlib.Path(args.proto)
     if not args.proto.exists():
       die(f"protodir does not exist: {args.proto}")
 
-    with tempfile.TemporaryDirectory(prefix='proto_to_json.') as tmpdir:
-      tmpdir = pathlib.Path(tmpdir)
-      fdsetfile = tmpdir / 'fdset'
-      debug('tmpdir:', tmpdir)
-      cmd = \
-        ['protoc',  '--include_imports', '-I', args.proto, '-o', fdsetfile] + \
-        list(map(str,args.proto.glob('**/*.proto')))
-      debug('subprocess:', *(shlex.quote(str(x)) for x in cmd))
-      subprocess.check_call(cmd, stdout=subprocess.DEVNULL)
-
-      with open(fdsetfile, 'rb') as f:
-        fdsetdata = f.read()
-
-  fds = google.protobuf.descriptor_pb2.FileDescriptorSet.FromString(fdsetdata)
-
-  msgclasses = google.protobuf.message_factory.GetMessages(fds.file)
+    fdsetdata = compile_protos(args.proto, None if args.no_proto_cache else proto_cache_dir())
 
-  ProtoMessage = msgclasses.get(args.msgtype)
+  ProtoMessage = _prepare_message(fdsetdata, args.msgtype)
   debug('proto message type:', ProtoMessage)
   if not ProtoMessage:
     die(f"message type '{args.msgtype}' not found.")
 
-  prefix = args.input.read(args.seek)
-  data = args.input.read()
-  args.input.close()
-  message = None
-  if args.fr == 'proto':
-    try:
-      message = ProtoMessage().FromString(data)
-    except Exception as e:
-      if (args.proto, args.msgtype, args.seek) == (_gtirb, _gtirb_ir_type, 0):
-        hint = 'failed to decode gtirb.  NOTE: .gtirb files have a magic prefix and need --seek 8 to decode properly.'
-        if args.proto == _gtirb and args.seek == 0: raise UserWarning(hint) from e
-      raise
-  elif args.fr == 'json':
-    message = ProtoMessage()
-    message = google.protobuf.json_format.Parse(data, message)
-
-  assert message
-  if args.output.fileno() not in (0, 1):  # not stdin or stdout
-    args.output.truncate(0)
-
-  if args.idem:
-    args.output.write(prefix)
-
-  if args.to == 'proto':
-    data = message.SerializeToString(deterministic=True)
-    args.output.write(data)
-  elif args.to == 'json':
-    # see: https://github.com/protocolbuffers/protobuf/blob/main/python/google/protobuf/json_format.py
-    # and: https://protobuf.dev/programming-guides/proto3/#json
-    msgdict = google.protobuf.json_format.MessageToDict(
-      message,
-      always_print_fields_with_no_presence=True,
-      preserving_proto_field_name=True
-    )
-
-    if args.auxdata:
-      import gtirb
-      ser = gtirb.serialization.Serialization()
-
-      def process_keys(x):
-        if isinstance(x, tuple):
-          return str(tuple(process_keys(y) for y in x))
-        else:
-          return process_auxdata(x)
-
-      def process_auxdata(x):
-        if isinstance(x, bytes):
-          try:
-            return json.loads(x.decode('ascii'))
-          except Exception:
-            return str(x)
-        elif isinstance(x, list):
-          return [process_auxdata(y) for y in x]
-        elif isinstance(x, dict):
-          if set(x.keys()) == {'type_name', 'data'}:
-            data = base64.b64decode(x['data'])
-            return process_auxdata({
-              'type_name': x['type_name'],
-              '_decoded': ser.decode(data, x['type_name'])
-            })
-          return dict((process_keys(k), process_auxdata(v)) for k,v in x.items())
-        elif isinstance(x, uuid.UUID):
-          return base64.b64encode(x.bytes).decode('ascii')
-        elif isinstance(x, gtirb.offset.Offset):
-          return str(x)
-        elif x is None or isinstance(x, (str, int, float, bool, bytes)):
-          return x
-        elif isinstance(x, tuple):
-          return tuple(process_auxdata(y) for y in x)
-        elif isinstance(x, set):
-          return [process_auxdata(y) for y in x]
-        else:
-          assert False, "unsup type " + repr(x)
-
-      msgdict = process_auxdata(msgdict)
-      # print(msgdict)
+  opts = Options(
+    fr=args.fr,
+    to=args.to,
+    idem=args.idem,
+    seek=args.seek or 0,
+    detect_magic=(args.proto, args.msgtype, args.seek) == (_gtirb, _gtirb_ir_type, None),
+    stream=args.stream,
+    contents=args.contents,
+    contents_file=args.contents_file,
+    auxdata=args.auxdata,
+    auxdata_keys=None if args.auxdata_keys is None else set(filter(None, args.auxdata_keys.split(','))),
+    jobs=args.jobs,
+  )
 
-    data = json.dumps(msgdict, indent=2, sort_keys=True, default=str)
-    args.output.write(data.encode('utf-8'))
+  if args.batch:
+    global _batch_message
+    _batch_message = ProtoMessage
+    pattern = args.batch_pattern or ('*.json' if args.fr == 'json' else '*.gtirb')
+    suffix = args.batch_suffix or ('.json' if args.to == 'json' else '.proto')
+    pairs = gts_sources.batch_sources(args.batch, pattern)
+    return batch(opts, fdsetdata, args.msgtype, pairs, args.outdir, suffix, args.jobs)
 
+  convert(opts, ProtoMessage, args.input, args.output)
+  return 0
 
 if __name__ == '__main__':
-  main()
+  sys.exit(main())
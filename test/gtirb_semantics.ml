@@ -0,0 +1,117 @@
+(* Starts `gtirb_semantics --serve-json`, both lifting in-process with
+   --offline and forwarding to a `--serve` server with --client, and checks
+   its responses to a few requests on one connection. *)
+
+let exe = Sys.argv.(1)
+
+let temp_socket name =
+  let path = Filename.temp_file name ".sock" in
+  Sys.remove path;
+  path
+
+let json_socket = temp_socket "gtirb_semantics_test_json"
+let lift_socket = temp_socket "gtirb_semantics_test"
+
+let start args =
+  let env =
+    Array.append
+      [|
+        "GTIRB_SEM_JSON_SOCKET=" ^ json_socket;
+        "GTIRB_SEM_SOCKET=" ^ lift_socket;
+      |]
+      (Unix.environment ())
+  in
+  let null = Unix.openfile "/dev/null" [ Unix.O_WRONLY ] 0 in
+  let pid =
+    Unix.create_process_env exe (Array.of_list (exe :: args)) env Unix.stdin
+      null Unix.stderr
+  in
+  Unix.close null;
+  pid
+
+let stop pid =
+  Unix.kill pid Sys.sigterm;
+  ignore (Unix.waitpid [] pid)
+
+let rec connect socket tries =
+  let fd = Unix.socket Unix.PF_UNIX Unix.SOCK_STREAM 0 in
+  match Unix.connect fd (Unix.ADDR_UNIX socket) with
+  | () -> fd
+  | exception Unix.Unix_error ((Unix.ENOENT | Unix.ECONNREFUSED), _, _)
+    when tries > 0 ->
+      Unix.close fd;
+      Unix.sleepf 0.1;
+      connect socket (tries - 1)
+
+let check name cond = if not cond then failwith ("failed: " ^ name)
+
+let check_server name =
+  let fd = connect json_socket 600 in
+  let ic = Unix.in_channel_of_descr fd and oc = Unix.out_channel_of_descr fd in
+  List.iter
+    (fun req -> output_string oc (Yojson.Safe.to_string req ^ "\n"))
+    [
+      `Assoc
+        [
+          ("id", `Int 1);
+          ("method", `String "lift");
+          ( "opcodes",
+            `List
+              [
+                `List [ `String "91000400"; `Int 0x1000 ];
+                `List [ `String "d503201f"; `Int 0x1004 ];
+              ] );
+        ];
+      `Assoc
+        [
+          ("id", `Int 2);
+          ("method", `String "lift");
+          ("opcodes", `List [ `List [ `String "zz"; `Int 0 ] ]);
+        ];
+      `Assoc [ ("id", `Int 3); ("method", `String "nonsense") ];
+    ];
+  flush oc;
+
+  let responses =
+    List.init 3 (fun _ -> Yojson.Safe.from_string (input_line ic))
+  in
+  let open Yojson.Safe.Util in
+  let response id = List.find (fun r -> member "id" r = `Int id) responses in
+
+  (match member "result" (response 1) with
+  | `List [ `List (_ :: _); `List _ ] -> ()
+  | r ->
+      failwith
+        (Printf.sprintf "%s: unexpected lift result: %s" name
+           (Yojson.Safe.to_string r)));
+  check (name ^ ": invalid opcode") (member "error" (response 2) <> `Null);
+  check (name ^ ": unknown method") (member "error" (response 3) <> `Null);
+  close_out oc
+
+(* Starts each server in turn, waiting for it to accept connections on its
+   socket before starting the next. *)
+let with_servers servers f =
+  let pids = ref [] in
+  Fun.protect
+    ~finally:(fun () ->
+      List.iter stop !pids;
+      List.iter
+        (fun s -> try Sys.remove s with Sys_error _ -> ())
+        [ json_socket; lift_socket ])
+    (fun () ->
+      List.iter
+        (fun (args, socket) ->
+          pids := start args :: !pids;
+          Unix.close (connect socket 600))
+        servers;
+      f ())
+
+let () =
+  with_servers
+    [ ([ "--serve-json"; "--offline" ], json_socket) ]
+    (fun () -> check_server "--serve-json --offline");
+  with_servers
+    [
+      ([ "--serve" ], lift_socket); ([ "--serve-json"; "--client" ], json_socket);
+    ]
+    (fun () -> check_server "--serve-json --client")